@@ -1,64 +1,6 @@
 __name__ = "mcspy"
 __package__ = "mcspy"
 
-from .indexing import dfindex
-from .defs import MCS_DATA_PATH
-from .loaders import (
-    load_H2Oice,
-    load_mix_dframe,
-    load_mix_dframe_years,
-    load_mix_var,
-    load_mix_vars,
-    load_mix_var_years,
-    load_mix_vars_years,
-    load_H2Oice_err,
-    load_H2Ovap,
-    load_H2Ovap_err,
-    load_altitude,
-    load_dust,
-    load_dust_err,
-    load_prof_var,
-    load_prof_var_years,
-    load_calc_var,
-    load_calc_var_years,
-    load_pressure,
-    load_temperature,
-    load_temperature_err,
-    load_Ls,
-    load_SZA,
-    load_MY,
-    load_LST,
-    load_lat,
-    load_lon,
-    load_Ls2,
-)
-from .indexing import (
-    qday,
-    qnight,
-    qtempe,
-    qmarci_mdgm,
-    qgds_MY28,
-    qgds_MY34,
-    lxgds_MY28,
-    lxgds_MY34,
-    lxday,
-    lxgds,
-    lxregion,
-    lxtempe,
-    lxmarci_mdgm,
-)
-from .parsing import parse_tab_file, load_tab_file
-from .util import mcs_tab_path, calc_Ls2
-from .calc import (
-    potential_temperature,
-    profdiff,
-    nan2val,
-    inf2nan,
-    logmean,
-    logstd,
-    logvar,
-)
-
 """
 mcspy is for working with data from the [Mars Climate Sounder](https://mars.nasa.gov/mro/mission/instruments/mcs/), an instrument aboard the NASA [Mars Reconnaisance Orbiter](https://mars.nasa.gov/mro/mission/overview/).
 
@@ -66,4 +8,189 @@ MCS data is publicly available on the [Planetary Data System (PDS) Atmospheres n
 
 Working with the data in this form is inefficient, so mcspy makes it easy to download data from a range of dates, and then save the metadata and the profiles in binary numpy array files.
 
+Submodules are imported the first time one of their names is used, so
+`import mcspy` doesn't load pandas, requests, or the config file.
 """
+
+# public names and the submodule each one is loaded from
+_lazy_names = {
+    "defs": [
+        "MCS_DATA_PATH",
+    ],
+    "loaders": [
+        "load_H2Oice",
+        "load_mix_dframe",
+        "load_mix_dframe_years",
+        "load_mix_var",
+        "load_mix_vars",
+        "load_mix_var_years",
+        "load_mix_vars_years",
+        "load_H2Oice_err",
+        "load_H2Ovap",
+        "load_H2Ovap_err",
+        "load_altitude",
+        "load_dust",
+        "load_dust_err",
+        "load_prof_var",
+        "load_prof_var_years",
+        "load_calc_var",
+        "load_calc_var_years",
+        "load_pressure",
+        "load_temperature",
+        "load_temperature_err",
+        "load_Ls",
+        "load_SZA",
+        "load_MY",
+        "load_LST",
+        "load_lat",
+        "load_lon",
+        "load_Ls2",
+        "load_summary",
+        "load_summary_years",
+    ],
+    "indexing": [
+        "get_index",
+        "reload_index",
+        "qday",
+        "qnight",
+        "qtempe",
+        "qmarci_mdgm",
+        "qgds_MY28",
+        "qgds_MY34",
+        "lxgds_MY28",
+        "lxgds_MY34",
+        "lxday",
+        "lxgds",
+        "lxregion",
+        "lxtempe",
+        "lxmarci_mdgm",
+        "lxranges",
+    ],
+    "parsing": [
+        "parse_tab_file",
+        "load_tab_file",
+    ],
+    "util": [
+        "mcs_tab_path",
+        "calc_Ls2",
+    ],
+    "calc": [
+        "potential_temperature",
+        "profdiff",
+        "interp_profiles",
+        "nan2val",
+        "inf2nan",
+        "logmean",
+        "logstd",
+        "logvar",
+        "RunningStats",
+        "LogStats",
+    ],
+    "binning": [
+        "binned_stats",
+        "BinnedStats",
+        "climatology",
+        "anomaly",
+    ],
+    "derived": [
+        "register_calc_var",
+        "update_calc_vars",
+    ],
+    "syncing": [
+        "sync",
+    ],
+    "pipeline": [
+        "ingest",
+    ],
+}
+_lazy_lookup = {
+    name: module for module, names in _lazy_names.items() for name in names
+}
+# the names `from mcspy import *` imports, each one loaded when it's
+# imported like any other use of it
+__all__ = list(_lazy_lookup) + ["dfindex"]
+_submodules = [
+    "backend",
+    "binning",
+    "calc",
+    "defs",
+    "derived",
+    "downloader",
+    "ids",
+    "importer",
+    "indexing",
+    "loaders",
+    "marsdate",
+    "parsing",
+    "pipeline",
+    "syncing",
+    "util",
+]
+
+# target for the wall time of `python -c "import mcspy"`, checked by
+# _test_import_time
+IMPORT_TIME_TARGET = 0.05
+
+# modules that importing mcspy must not load
+_slow_imports = ["numpy", "pandas", "requests", "ftplib", "astropy"]
+
+
+def __getattr__(name):
+    from importlib import import_module
+
+    # the cumulative index is parsed the first time mcspy.dfindex is
+    # used instead of when mcspy is imported
+    if name == "dfindex":
+        return import_module(".indexing", __package__).get_index()
+    if name in _submodules:
+        return import_module("." + name, __package__)
+    if name in _lazy_lookup:
+        module = import_module("." + _lazy_lookup[name], __package__)
+        value = getattr(module, name)
+        # cache the value so __getattr__ isn't called again
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(
+        list(globals()) + list(_lazy_lookup) + _submodules + ["dfindex"]
+    )
+
+
+def _test_import_time(target=IMPORT_TIME_TARGET, repeat=5):
+    """Check that `import mcspy` in a fresh interpreter doesn't load
+    any of the modules in `_slow_imports` and that the fastest of
+    `repeat` imports takes less than `target` seconds. Returns the
+    import time."""
+    import sys
+    import subprocess
+    from os.path import dirname
+
+    def run(code):
+        return subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=dirname(dirname(__file__)),
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+
+    code = (
+        "import sys, time; t = time.perf_counter(); {}; "
+        + "print(time.perf_counter() - t); print(' '.join(sys.modules))"
+    )
+    times = []
+    for _ in range(repeat):
+        dt, modules = run(code.format("import mcspy")).splitlines()
+        times.append(float(dt))
+    loaded = [m for m in _slow_imports if m in modules.split()]
+    if loaded:
+        raise AssertionError(f"import mcspy loaded {loaded}")
+    dt = min(times)
+    if dt > target:
+        raise AssertionError(
+            f"import mcspy took {dt:.3f} s, the target is {target} s"
+        )
+    return dt
@@ -0,0 +1,366 @@
+__package__ = "mcspy"
+
+import numpy as np
+from time import perf_counter
+
+__all__ = [
+    "BACKENDS",
+    "get_backend",
+    "set_backend",
+    "numba_available",
+    "kepler_newton",
+    "diff_rows",
+    "ddz_rows",
+    "bin_accumulate",
+    "interp_rows",
+]
+
+__doc__ = """
+Kernels for the hot loops that don't vectorize well in numpy, with a
+numpy version and an optional numba version of each.
+
+The numba versions are compiled the first time they're used, and only
+if numba is installed. The backend is chosen with `set_backend("numpy")`
+or `set_backend("numba")`, or with the "backend" setting in ~/.mcspy
+("auto", the default, uses numba if it's installed). Both backends
+give the same results to rounding error, which is checked by
+`_test_backend_parity`, and `_test_backend_benchmark` times them.
+"""
+
+BACKENDS = ("numpy", "numba")
+
+# the selected backend, resolved from the config file on first use
+_backend = None
+# compiled numba kernels, made the first time they're needed
+_numba_kernels = None
+
+
+def numba_available():
+    try:
+        import numba  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_backend():
+    """Name of the backend used by the kernels, "numpy" or "numba"."""
+    if _backend is None:
+        from .defs import get_config
+
+        name = get_config("backend")
+        if name == "auto":
+            name = "numba" if numba_available() else "numpy"
+        set_backend(name)
+    return _backend
+
+
+def set_backend(name):
+    """Use the "numpy" or "numba" versions of the kernels."""
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError(f"backend can be one of {BACKENDS}.")
+    if name == "numba" and not numba_available():
+        raise ImportError("The numba backend needs numba to be installed.")
+    _backend = name
+
+
+def _kernels(backend=None):
+    """The dict of kernels for `backend` (the current backend by
+    default)."""
+    if backend is None:
+        backend = get_backend()
+    if backend == "numpy":
+        return _numpy_kernels
+    global _numba_kernels
+    if _numba_kernels is None:
+        _numba_kernels = _make_numba_kernels()
+    return _numba_kernels
+
+
+def kepler_newton(xref, e, tol=1e-9, backend=None):
+    """Solve Kepler's equation x - e * sin(x) = xref for the eccentric
+    anomaly x with Newton iterations, starting from
+    xref + e * sin(xref). Returns a float array shaped like `xref`."""
+    xref = np.asarray(xref, dtype=float)
+    return _kernels(backend)["kepler_newton"](xref.ravel(), e, tol).reshape(
+        xref.shape
+    )
+
+
+def diff_rows(var, out, backend=None):
+    """Difference along the last axis of 2-D `var`, written into
+    `out[:, :-1]`, with `out[:, -1] = nan`."""
+    return _kernels(backend)["diff_rows"](var, out)
+
+
+def ddz_rows(alt, var, out, backend=None):
+    """Derivative of 2-D `var` with respect to `alt` along the last
+    axis, written into `out[:, :-1]`, with `out[:, -1] = nan`."""
+    return _kernels(backend)["ddz_rows"](alt, var, out)
+
+
+def bin_accumulate(cell, values, count, sums, sumsq, backend=None):
+    """Add the count, sum, and sum of squares of the finite `values`
+    to the flat arrays `count`, `sums`, and `sumsq` at the indexes
+    `cell` (1-D, negative indexes are skipped)."""
+    return _kernels(backend)["bin_accumulate"](
+        cell, values, count, sums, sumsq
+    )
+
+
+def interp_rows(x, y, xnew, out, backend=None):
+    """Linear interpolation of each row of `y`, on the coordinate in
+    the same row of `x`, to the coordinates in the same row of `xnew`,
+    written into `out` (2-D arrays). nans in `x` or `y` are skipped,
+    and targets outside of the valid points of a row are nan. Each
+    row of `x` must be monotonic (increasing or decreasing)."""
+    return _kernels(backend)["interp_rows"](x, y, xnew, out)
+
+
+# numpy versions
+
+
+def _np_kepler_newton(xref, e, tol):
+    x = xref + e * np.sin(xref)
+    # only iterate on the elements that haven't converged yet
+    ix = np.arange(x.size)
+    while ix.size > 0:
+        x0 = x[ix]
+        dx = -(x0 - e * np.sin(x0) - xref[ix]) / (1.0 - e * np.cos(x0))
+        x[ix] = x0 + dx
+        ix = ix[np.abs(dx) >= tol]
+    return x
+
+
+def _np_diff_rows(var, out):
+    np.subtract(var[:, 1:], var[:, :-1], out=out[:, :-1])
+    out[:, -1] = np.nan
+    return out
+
+
+def _np_ddz_rows(alt, var, out):
+    _np_diff_rows(var, out)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        np.divide(out[:, :-1], np.diff(alt, axis=1), out=out[:, :-1])
+    return out
+
+
+def _np_bin_accumulate(cell, values, count, sums, sumsq):
+    ok = (cell >= 0) & np.isfinite(values)
+    if not ok.all():
+        cell, values = cell[ok], values[ok]
+    size = count.size
+    count += np.bincount(cell, minlength=size)
+    sums += np.bincount(cell, values, minlength=size)
+    sumsq += np.bincount(cell, values * values, minlength=size)
+    return count, sums, sumsq
+
+
+def _np_interp_rows(x, y, xnew, out):
+    nrows = x.shape[0]
+    valid = np.isfinite(x) & np.isfinite(y)
+    nvalid = valid.sum(axis=1)
+    if not nvalid.any():
+        out[...] = np.nan
+        return out
+    # the valid points of all of the rows, one after the other, and the
+    # first and last one of each row
+    xv, yv = x[valid], y[valid]
+    end = np.cumsum(nvalid)
+    ia = np.minimum(end - nvalid, xv.size - 1)
+    ib = np.maximum(end - 1, 0)
+    # flip decreasing rows so every row increases
+    sign = np.where(xv[ib] < xv[ia], -1.0, 1.0)
+    lo, hi = sign * xv[ia], sign * xv[ib]
+    # shift the rows apart, so one np.interp over all of them gives the
+    # position of each target among the points of its row, which is
+    # then used to interpolate with the unshifted values
+    shift = np.arange(nrows) * (np.max(hi - lo) + 1.0) - lo
+    rowv = np.repeat(np.arange(nrows), nvalid)
+    xt = sign[:, None] * xnew
+    with np.errstate(invalid="ignore", divide="ignore"):
+        pos = np.interp(
+            xt + shift[:, None],
+            sign[rowv] * xv + shift[rowv],
+            np.arange(xv.size, dtype=float),
+        )
+        i0 = np.clip(
+            pos.astype(np.intp), ia[:, None], np.maximum(ib - 1, ia)[:, None]
+        )
+        slope = np.diff(yv, append=np.nan) / np.diff(xv, append=np.nan)
+        ok = (xt >= lo[:, None]) & (xt <= hi[:, None]) & (nvalid >= 2)[:, None]
+        out[...] = np.where(ok, yv[i0] + (xnew - xv[i0]) * slope[i0], np.nan)
+    return out
+
+
+_numpy_kernels = {
+    "kepler_newton": _np_kepler_newton,
+    "diff_rows": _np_diff_rows,
+    "ddz_rows": _np_ddz_rows,
+    "bin_accumulate": _np_bin_accumulate,
+    "interp_rows": _np_interp_rows,
+}
+
+
+# numba versions
+
+
+def _make_numba_kernels():
+    import numba
+    from math import sin, cos, isfinite, nan
+
+    @numba.njit(parallel=True, cache=True)
+    def kepler_newton(xref, e, tol):
+        x = np.empty_like(xref)
+        for ii in numba.prange(xref.size):
+            x0 = xref[ii] + e * sin(xref[ii])
+            dx = 1.0
+            while abs(dx) >= tol:
+                dx = -(x0 - e * sin(x0) - xref[ii]) / (1.0 - e * cos(x0))
+                x0 = x0 + dx
+            x[ii] = x0
+        return x
+
+    @numba.njit(parallel=True, cache=True)
+    def diff_rows(var, out):
+        nlev = var.shape[1]
+        for ii in numba.prange(var.shape[0]):
+            for jj in range(nlev - 1):
+                out[ii, jj] = var[ii, jj + 1] - var[ii, jj]
+            out[ii, nlev - 1] = nan
+        return out
+
+    # error_model="numpy" makes division by zero give inf or nan
+    @numba.njit(parallel=True, cache=True, error_model="numpy")
+    def ddz_rows(alt, var, out):
+        nlev = var.shape[1]
+        for ii in numba.prange(var.shape[0]):
+            for jj in range(nlev - 1):
+                dz = alt[ii, jj + 1] - alt[ii, jj]
+                out[ii, jj] = (var[ii, jj + 1] - var[ii, jj]) / dz
+            out[ii, nlev - 1] = nan
+        return out
+
+    @numba.njit(cache=True)
+    def bin_accumulate(cell, values, count, sums, sumsq):
+        for ii in range(cell.size):
+            cc = cell[ii]
+            vv = values[ii]
+            if cc >= 0 and isfinite(vv):
+                count[cc] += 1
+                sums[cc] += vv
+                sumsq[cc] += vv * vv
+        return count, sums, sumsq
+
+    @numba.njit(parallel=True, cache=True, error_model="numpy")
+    def interp_rows(x, y, xnew, out):
+        nlev = x.shape[1]
+        for ii in numba.prange(x.shape[0]):
+            # valid points of the row, and the direction of x
+            jx = np.empty(nlev, dtype=np.int64)
+            nvalid = 0
+            for jj in range(nlev):
+                if isfinite(x[ii, jj]) and isfinite(y[ii, jj]):
+                    jx[nvalid] = jj
+                    nvalid += 1
+            sign = 1.0
+            if nvalid > 1 and x[ii, jx[nvalid - 1]] < x[ii, jx[0]]:
+                sign = -1.0
+            for kk in range(xnew.shape[1]):
+                xt = sign * xnew[ii, kk]
+                out[ii, kk] = nan
+                for mm in range(nvalid - 1):
+                    x0 = sign * x[ii, jx[mm]]
+                    x1 = sign * x[ii, jx[mm + 1]]
+                    if x0 <= xt <= x1:
+                        t = (xt - x0) / (x1 - x0)
+                        y0 = y[ii, jx[mm]]
+                        out[ii, kk] = y0 + t * (y[ii, jx[mm + 1]] - y0)
+                        break
+        return out
+
+    return {
+        "kepler_newton": kepler_newton,
+        "diff_rows": diff_rows,
+        "ddz_rows": ddz_rows,
+        "bin_accumulate": bin_accumulate,
+        "interp_rows": interp_rows,
+    }
+
+
+def _test_inputs(n, seed=None):
+    """Random inputs for each kernel, with about `n` values each."""
+    rng = np.random.default_rng(seed)
+    nprof = max(1, n // 105)
+    var = rng.normal(200, 20, size=(nprof, 105))
+    var[rng.random(var.shape) < 0.05] = np.nan
+    alt = np.cumsum(rng.uniform(0.5, 1.5, size=(nprof, 105)), axis=1)
+    cell = rng.integers(-1, 1000, size=n)
+    return {
+        "kepler_newton": (rng.uniform(0, np.pi, n), 0.0934, 1e-9),
+        "diff_rows": (var, np.empty_like(var)),
+        "ddz_rows": (alt, var, np.empty_like(var)),
+        "interp_rows": (
+            alt,
+            var,
+            np.broadcast_to(np.linspace(0, 100, 51), (nprof, 51)),
+            np.empty((nprof, 51)),
+        ),
+        "bin_accumulate": (
+            cell,
+            rng.normal(size=n),
+            np.zeros(1000, dtype=np.int64),
+            np.zeros(1000),
+            np.zeros(1000),
+        ),
+    }
+
+
+def _copy_args(args):
+    return tuple(a.copy() if isinstance(a, np.ndarray) else a for a in args)
+
+
+def _test_backend_parity(n=100000, seed=None):
+    """Check that the numba kernels give the same results as the numpy
+    kernels. Returns False without checking if numba isn't installed."""
+    if not numba_available():
+        print("numba is not installed, only the numpy backend is available")
+        return False
+    inputs = _test_inputs(n, seed)
+    for name, args in inputs.items():
+        expected = _kernels("numpy")[name](*_copy_args(args))
+        result = _kernels("numba")[name](*_copy_args(args))
+        if not isinstance(expected, tuple):
+            expected, result = (expected,), (result,)
+        for ee, rr in zip(expected, result):
+            assert np.allclose(ee, rr, rtol=1e-12, equal_nan=True), name
+    return True
+
+
+def _test_backend_benchmark(n=1000000, repeat=3, seed=None):
+    """Time each kernel with each available backend and print the
+    speedup of numba over numpy. Returns a dict of
+    {kernel: {backend: best time in seconds}}."""
+    backends = [bb for bb in BACKENDS if bb == "numpy" or numba_available()]
+    inputs = _test_inputs(n, seed)
+    times = {}
+    for name, args in inputs.items():
+        times[name] = {}
+        for bb in backends:
+            kernel = _kernels(bb)[name]
+            # the first call compiles the numba version
+            kernel(*_copy_args(args))
+            best = np.inf
+            for _ in range(repeat):
+                cargs = _copy_args(args)
+                t0 = perf_counter()
+                kernel(*cargs)
+                best = min(best, perf_counter() - t0)
+            times[name][bb] = best
+        line = ", ".join(f"{bb} {tt:.4f} s" for bb, tt in times[name].items())
+        if "numba" in times[name]:
+            speedup = times[name]["numpy"] / times[name]["numba"]
+            line += f" ({speedup:.1f}x)"
+        print(f"{name}: {line}")
+    return times
@@ -0,0 +1,453 @@
+__package__ = "mcspy"
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from os.path import exists, dirname
+from . import backend
+from .defs import mix_cols
+from .util import allyears
+
+__all__ = [
+    "binned_stats",
+    "BinnedStats",
+    "bin_index",
+    "climatology",
+    "climatology_path",
+    "anomaly",
+]
+
+__doc__ = """
+Gridded statistics (count, mean, and standard deviation) of profile
+variables on grids of metadata and vertical coordinates, for example
+temperature binned by (Ls2, lat, LST, pressure).
+
+The statistics are accumulated chunk by chunk as the yearly profile
+files are read, so memory use depends on the size of the grid and the
+chunk size and not on the amount of data.
+
+Grids are given as an ordered dict of {coordinate name: bin edges}.
+A coordinate can be
+    - a metadata index variable like "Ls2", "lat", "lon", or "LST",
+      which has the same value at every level of a profile,
+    - "pressure", the fixed pressure grid of the profiles,
+    - any other profile variable, like "altitude".
+Bin edges must be increasing, and bins include their lower edge and
+exclude their upper edge.
+
+`climatology` saves the BinnedStats for a grid in
+"DATA/climatology/", keyed by the grid and selection, and only rescans
+the yearly files when one of them has changed. `anomaly` subtracts the
+climatological mean of the bin of each value.
+"""
+
+
+def bin_index(x, edges):
+    """
+    Index of the bin in `edges` that contains each value in `x`, or
+    -1 for values outside of the edges and nan. Evenly spaced edges
+    are indexed arithmetically, other edges with searchsorted.
+    """
+    edges = np.asarray(edges, dtype=float)
+    nbins = edges.size - 1
+    dx = np.diff(edges)
+    if nbins < 1 or not (dx > 0).all():
+        raise ValueError("Bin edges must be increasing.")
+    x = np.asarray(x, dtype=float)
+    with np.errstate(invalid="ignore"):
+        # only relative tolerance, tiny bins differ by more than the
+        # default absolute one allows
+        if np.allclose(dx, dx[0], rtol=1e-9, atol=0):
+            ix = np.floor((x - edges[0]) / dx[0])
+            # rounding in the division can put a value on an edge in
+            # the bin next to the one that has it as its lower edge
+            ix = np.clip(np.nan_to_num(ix), 0, nbins - 1).astype(np.intp)
+            ix = ix - (x < edges[ix]) + (x >= edges[ix + 1])
+        else:
+            ix = np.searchsorted(edges, x, side="right") - 1
+        valid = (ix >= 0) & (ix < nbins) & ~np.isnan(x)
+    return np.where(valid, ix, -1).astype(np.intp)
+
+
+class BinnedStats(object):
+    """
+    Count, sum, and sum of squares of one or more variables on a grid.
+    `mean`, `std`, `var`, and `counts` return arrays with shape
+    `shape`, one dimension for each coordinate in `dims`. Results for
+    different chunks, years, or processes can be combined with
+    `merge`, and `to_xarray` makes an xarray Dataset if xarray is
+    installed.
+    """
+
+    def __init__(self, bins, varnames):
+        """
+        bins: ordered dict of {coordinate name: bin edges}
+        varnames: names of the variables to accumulate
+        """
+        self.dims = list(bins)
+        self.edges = {
+            k: np.asarray(v, dtype=float) for k, v in bins.items()
+        }
+        self.shape = tuple(e.size - 1 for e in self.edges.values())
+        self.varnames = list(varnames)
+        size = int(np.prod(self.shape))
+        self._count = {
+            vn: np.zeros(size, dtype=np.int64) for vn in varnames
+        }
+        self._sum = {vn: np.zeros(size) for vn in varnames}
+        self._sumsq = {vn: np.zeros(size) for vn in varnames}
+
+    @property
+    def strides(self):
+        """Multiplier of each dimension's bin index in the flat index."""
+        shape = self.shape
+        return [int(np.prod(shape[ix+1:])) for ix in range(len(shape))]
+
+    @property
+    def coords(self):
+        """Bin centers for each dimension."""
+        return {k: (e[1:] + e[:-1]) / 2 for k, e in self.edges.items()}
+
+    def add(self, varname, cell, values):
+        """Add `values` of `varname` to the grid cells with flat indexes
+        `cell`. Values with a negative cell index are ignored."""
+        backend.bin_accumulate(
+            np.asarray(cell, dtype=np.intp).ravel(),
+            np.asarray(values, dtype=float).ravel(),
+            self._count[varname],
+            self._sum[varname],
+            self._sumsq[varname],
+        )
+
+    def merge(self, other):
+        """Add the accumulated values from another BinnedStats on the
+        same grid. Returns self."""
+        if self.dims != other.dims or not all(
+            np.array_equal(self.edges[k], other.edges[k]) for k in self.dims
+        ):
+            raise ValueError("BinnedStats grids do not match.")
+        for vn in other.varnames:
+            if vn not in self.varnames:
+                self.varnames.append(vn)
+                self._count[vn] = other._count[vn].copy()
+                self._sum[vn] = other._sum[vn].copy()
+                self._sumsq[vn] = other._sumsq[vn].copy()
+                continue
+            self._count[vn] += other._count[vn]
+            self._sum[vn] += other._sum[vn]
+            self._sumsq[vn] += other._sumsq[vn]
+        return self
+
+    def counts(self, varname):
+        return self._count[varname].reshape(self.shape)
+
+    def mean(self, varname):
+        """Mean of `varname` in each cell, nan for empty cells."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self._sum[varname] / self._count[varname]
+        return mean.reshape(self.shape)
+
+    def var(self, varname, ddof=0):
+        """Variance of `varname` in each cell, nan for cells with
+        `ddof` or fewer values."""
+        n = self._count[varname]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self._sum[varname] / n
+            var = (self._sumsq[varname] - n * mean * mean) / (n - ddof)
+        var = np.where(n > ddof, np.maximum(var, 0), np.nan)
+        return var.reshape(self.shape)
+
+    def std(self, varname, ddof=0):
+        """Standard deviation of `varname` in each cell."""
+        return np.sqrt(self.var(varname, ddof))
+
+    def save(self, fname, **attrs):
+        """Save the grid and the accumulated values to the numpy file
+        `fname` (.npz), with optional JSON-compatible `attrs`."""
+        arrays = {
+            f"edges_{ix}": self.edges[k] for ix, k in enumerate(self.dims)
+        }
+        for vn in self.varnames:
+            arrays[f"count_{vn}"] = self._count[vn]
+            arrays[f"sum_{vn}"] = self._sum[vn]
+            arrays[f"sumsq_{vn}"] = self._sumsq[vn]
+        meta = {"dims": self.dims, "varnames": self.varnames, "attrs": attrs}
+        np.savez_compressed(fname, meta=json.dumps(meta), **arrays)
+
+    @classmethod
+    def load(cls, fname):
+        """Load BinnedStats saved with `save`. The attrs are in the
+        `attrs` attribute."""
+        with np.load(fname, allow_pickle=False) as fin:
+            meta = json.loads(str(fin["meta"]))
+            bins = {k: fin[f"edges_{ix}"] for ix, k in enumerate(meta["dims"])}
+            stats = cls(bins, meta["varnames"])
+            for vn in stats.varnames:
+                stats._count[vn] = fin[f"count_{vn}"]
+                stats._sum[vn] = fin[f"sum_{vn}"]
+                stats._sumsq[vn] = fin[f"sumsq_{vn}"]
+        stats.attrs = meta["attrs"]
+        return stats
+
+    def to_xarray(self, ddof=0):
+        """Return an xarray Dataset with the mean, std, and count of
+        each variable on the grid (requires xarray)."""
+        import xarray as xr
+
+        data = {}
+        for vn in self.varnames:
+            data[f"{vn}_mean"] = (self.dims, self.mean(vn))
+            data[f"{vn}_std"] = (self.dims, self.std(vn, ddof))
+            data[f"{vn}_count"] = (self.dims, self.counts(vn))
+        ds = xr.Dataset(data, coords=self.coords)
+        for k, e in self.edges.items():
+            ds[k].attrs["bin_edges"] = e
+        return ds
+
+
+def _cell_index(values, bins, stats):
+    """Flat cell index of the dimensions in `bins` (a list of names)
+    for the arrays in the dict `values`, and whether all of the values
+    are inside the grid. Returns (0, True) if `bins` is empty."""
+    cell, valid = 0, True
+    for name, stride in zip(stats.dims, stats.strides):
+        if name not in bins:
+            continue
+        ix = bin_index(values[name], stats.edges[name])
+        cell = cell + ix * stride
+        valid = valid & (ix >= 0)
+    return cell, valid
+
+
+def binned_stats(
+    varnames, bins, years=None, select=None, chunksize=4096, quiet=True
+):
+    """
+    Read the profile variable(s) `varnames` from the yearly data files
+    in chunks and accumulate their count, mean, and standard deviation
+    on the grid `bins`, an ordered dict of {coordinate: bin edges}
+    (see `mcspy.binning.__doc__` for the possible coordinates).
+
+    years: the years to read (default is all years)
+    select: optional dict of {metadata variable: (min, max)}, to only
+        use profiles with min <= value <= max, like
+        `indexing.lxranges`. Either limit can be None for no limit.
+    chunksize: number of profiles to read at a time
+
+    returns: BinnedStats
+
+    Example:
+        stats = binned_stats(
+            "temperature",
+            {
+                "Ls2": np.arange(0, 360 * 12 + 1, 5),
+                "lat": np.arange(-90, 91, 5),
+                "pressure": np.logspace(-3, 3, 31),
+            },
+            select={"solar_zen": (0, 90)},
+        )
+        stats.mean("temperature")
+    """
+    from .loaders import load_mix_vars, iter_prof_vars, load_prof_var
+    from .loaders import zone_blocks, in_range
+
+    if isinstance(varnames, str):
+        varnames = [varnames]
+    if years is None:
+        years = allyears
+    select = {} if select is None else select
+    stats = BinnedStats(bins, varnames)
+    mixdims = [d for d in stats.dims if d in mix_cols]
+    profdims = [d for d in stats.dims if d not in mixdims + ["pressure"]]
+    # pressure is the same for every profile
+    levcell, levvalid = _cell_index(
+        {"pressure": load_prof_var(None, "pressure")[0]}, ["pressure"], stats
+    )
+    mixnames = list(dict.fromkeys(mixdims + list(select)))
+    readnames = list(dict.fromkeys(varnames + profdims))
+
+    for year in years:
+        # skip years where the zone map rules out every profile
+        blocks = zone_blocks(year, select) if select else None
+        if blocks is not None and not blocks.any():
+            continue
+        try:
+            mix = load_mix_vars(
+                year, mixnames + ["profidint"], quiet=quiet, output_tuple=False
+            )
+        except FileNotFoundError:
+            if not quiet:
+                print(f"No data for {year}")
+            continue
+        nprof = mix["profidint"].size
+        # cell index for the metadata dimensions of each profile
+        profcell, profvalid = _cell_index(mix, mixdims, stats)
+        profcell = np.broadcast_to(profcell, (nprof,))
+        profvalid = np.broadcast_to(profvalid, (nprof,))
+        for name, (lo, hi) in select.items():
+            profvalid = profvalid & in_range(mix[name], lo, hi)
+
+        # chunks without any selected profiles aren't read
+        start = 0
+        for chunk in iter_prof_vars(
+            year, readnames, chunksize, rows=profvalid
+        ):
+            if chunk is None:
+                start += min(chunksize, nprof - start)
+                continue
+            nn = len(chunk[readnames[0]])
+            sl = slice(start, start + nn)
+            start += nn
+            cell = profcell[sl, None] + levcell
+            valid = profvalid[sl, None] & levvalid
+            if profdims:
+                pcell, pvalid = _cell_index(chunk, profdims, stats)
+                cell, valid = cell + pcell, valid & pvalid
+            cell = np.where(valid, cell, -1)
+            cell = np.broadcast_to(cell, chunk[readnames[0]].shape)
+            for vn in varnames:
+                stats.add(vn, cell, chunk[vn])
+        if start != nprof:
+            raise IndexError(
+                f"Index and profile sizes do not match for {year}."
+            )
+    return stats
+
+
+def _climatology_spec(varnames, bins, years, select):
+    """JSON-compatible description of a climatology, used for its key."""
+    return {
+        # 2: select limits are inclusive
+        "version": 2,
+        "varnames": sorted(varnames),
+        "bins": {
+            k: np.asarray(v, dtype=float).tolist() for k, v in bins.items()
+        },
+        "years": [int(yy) for yy in years],
+        "select": {
+            k: [_spec_value(vv) for vv in v] for k, v in select.items()
+        },
+    }
+
+
+def _spec_value(value):
+    """A range limit for `_climatology_spec`: None, a number, or the
+    string of anything else (like a date)."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float, np.number)):
+        return float(value)
+    return str(value)
+
+
+def _data_version(varnames, bins, years):
+    """Size and modification time of every file a climatology is
+    calculated from, or None for files that don't exist."""
+    from .loaders import MCS_DATA_PATH, prof_var_path
+
+    profnames = [
+        vn for vn in list(varnames) + list(bins) if vn not in mix_cols
+    ]
+    version = {}
+    for yy in years:
+        files = [MCS_DATA_PATH + f"DATA/{yy}/indexdata/{yy}_mixvars.npz"]
+        files += [
+            prof_var_path(yy, vn) for vn in profnames if vn != "pressure"
+        ]
+        for fn in files:
+            if exists(fn):
+                st = os.stat(fn)
+                version[fn] = [st.st_size, st.st_mtime_ns]
+            else:
+                version[fn] = None
+    return version
+
+
+def climatology_path(spec):
+    """Path of the cached climatology file for the spec returned by
+    `_climatology_spec`."""
+    from .loaders import MCS_DATA_PATH
+
+    key = hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+    return MCS_DATA_PATH + f"DATA/climatology/{key[:16]}.npz"
+
+
+def climatology(
+    varnames, bins, years=None, select=None, reload=False, quiet=True
+):
+    """
+    Climatological count, mean, and standard deviation of `varnames` on
+    the grid `bins`, as a BinnedStats (see `binned_stats` for the
+    arguments). The result is saved in "DATA/climatology/" the first
+    time, keyed by the variables, grid, years, and selection, and is
+    read from there after that unless one of the yearly files it was
+    calculated from has changed (or `reload` is True).
+
+    Example:
+        clim = climatology(
+            "temperature",
+            {
+                "Ls": np.arange(0, 361, 10),
+                "lat": np.arange(-90, 91, 5),
+                "pressure": np.logspace(-3, 3, 31),
+            },
+        )
+        dT = anomaly("temperature", rows, clim)
+    """
+    if isinstance(varnames, str):
+        varnames = [varnames]
+    years = allyears if years is None else years
+    select = {} if select is None else select
+    spec = _climatology_spec(varnames, bins, years, select)
+    fname = climatology_path(spec)
+    version = _data_version(varnames, bins, years)
+    if exists(fname) and not reload:
+        stats = BinnedStats.load(fname)
+        if stats.attrs.get("data_version") == version:
+            if not quiet:
+                print(f"loaded {fname}")
+            return stats
+    stats = binned_stats(varnames, bins, years, select, quiet=quiet)
+    os.makedirs(dirname(fname), exist_ok=True)
+    # a temporary file of its own, in case several processes (or
+    # threads) build the same climatology at once
+    tmp = fname[:-len(".npz")] + f".{os.getpid()}.{threading.get_ident()}"
+    try:
+        stats.save(tmp + ".tmp.npz", spec=spec, data_version=version)
+        os.replace(tmp + ".tmp.npz", fname)
+    finally:
+        if exists(tmp + ".tmp.npz"):
+            os.unlink(tmp + ".tmp.npz")
+    stats.attrs = {"spec": spec, "data_version": version}
+    if not quiet:
+        print(f"wrote {fname}")
+    return stats
+
+
+def anomaly(var, rows, clim):
+    """
+    Difference between the values of the variable `var` and the
+    climatological mean of their bins in `clim` (a BinnedStats, for
+    example from `climatology`).
+
+    rows: dict or DataFrame with the values of `var` and of each
+        coordinate of the grid, as arrays that broadcast together,
+        like profile arrays of shape (nprof, 105) and metadata columns
+        of shape (nprof, 1). The fixed pressure grid is used for
+        "pressure" if it isn't in `rows`.
+
+    returns: array of anomalies, nan where the values are outside of
+        the grid or the bin is empty
+    """
+    values = {k: np.asarray(rows[k]) for k in clim.dims + [var] if k in rows}
+    if "pressure" in clim.dims and "pressure" not in values:
+        from .loaders import load_prof_var
+
+        values["pressure"] = load_prof_var(None, "pressure")[0]
+    cell, valid = _cell_index(values, clim.dims, clim)
+    mean = clim.mean(var).reshape(-1)
+    with np.errstate(invalid="ignore"):
+        anom = values[var] - mean[np.where(valid, cell, 0)]
+    return np.where(valid, anom, np.nan)
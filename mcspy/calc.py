@@ -1,26 +1,87 @@
 import numpy as np
+from . import backend
 
 __all__ = [
     "potential_temperature",
     "profdiff",
     "profddz",
+    "interp_profiles",
     "logmean",
     "logmedian",
     "logquantile",
     "logstd",
+    "logvar",
     "inf2nan",
+    "RunningStats",
+    "LogStats",
+    "LogHistogram",
 ]
 
 
-def potential_temperature(prs, temp, p_ref=610):
+# size of the blocks of rows processed at a time by the kernels below,
+# small enough that a block of each array stays in the CPU cache
+BLOCK_BYTES = 2**18
+
+
+def _out_array(x, shape, out):
+    """Check or allocate the output array for a kernel. The output has
+    the dtype of `x` if it's floating point (so float32 stays
+    float32) and float64 otherwise."""
+    if out is None:
+        dtype = x.dtype if np.issubdtype(x.dtype, np.floating) else float
+        return np.empty(shape, dtype=dtype)
+    if out.shape != tuple(shape):
+        raise ValueError(f"out has shape {out.shape}, expected {shape}")
+    return out
+
+
+def _blocks(x):
+    """Slices of the first axis of `x` in blocks of about
+    BLOCK_BYTES."""
+    if x.ndim < 2:
+        return [slice(None)]
+    rowbytes = max(1, x[:1].size * x.itemsize)
+    step = max(1, BLOCK_BYTES // rowbytes)
+    return [slice(ix, ix + step) for ix in range(0, x.shape[0], step)]
+
+
+def _use_rows_kernel(var, axis):
+    """Whether to use the numba kernels in mcspy.backend, which work on
+    the last axis of 2-D arrays."""
+    return (
+        var.ndim == 2
+        and axis in (-1, 1)
+        and backend.get_backend() == "numba"
+    )
+
+
+def potential_temperature(prs, temp, p_ref=610, out=None):
     """
     Calculate potential temperature from pressure and temperature
-    vectors with a reference pressure of `p_ref`.
+    vectors with a reference pressure of `p_ref`. `prs` and `temp`
+    are broadcast together, the result is written into `out` if it's
+    given (which can be `temp` itself), and float32 temperatures give
+    a float32 result.
     """
+    temp = np.asarray(temp)
+    shape = np.broadcast_shapes(np.shape(prs), temp.shape)
+    if shape == ():
+        return temp * (p_ref / prs) ** 0.25
+    out = _out_array(temp, shape, out)
+    prs = np.broadcast_to(prs, shape)
+    temp = np.broadcast_to(temp, shape)
     # acc to eq (1) in Hinson et al. 2019
-    pr = p_ref / prs
-    theta = temp * pr ** (0.25)
-    return theta
+    for sl in _blocks(out):
+        ob = out[sl]
+        tb = temp[sl]
+        if np.may_share_memory(ob, tb):
+            # temp is being overwritten
+            np.multiply(tb, np.power(p_ref / prs[sl], 0.25), out=ob)
+            continue
+        np.divide(p_ref, prs[sl], out=ob)
+        np.power(ob, 0.25, out=ob)
+        np.multiply(ob, tb, out=ob)
+    return out
 
 
 def nan2val(x, val):
@@ -38,36 +99,75 @@ def inf2nan(x, val=np.nan):
     return np.where(np.isinf(x), val, x)
 
 
-def profdiff(var, axis=-1):
+def profdiff(var, axis=-1, out=None):
     """
     Find the first order difference of `var` along the axis `axis`.
+    The result has the same shape as `var`, with nan at the end of
+    `axis`, and is written into `out` if it's given.
     """
-    # calculate the difference (along axis)
-    dvar = np.diff(var, axis=axis)
-    # move difference axis to the last position
-    dvar = np.moveaxis(dvar, axis, -1)
-    # make an array of nans to append on dvar
-    z = np.zeros(dvar.shape[:-1])[..., None] + np.nan
-    # concatenate arrays so (output.shape == input.shape).all()
-    dvar = np.concatenate((dvar, z), axis=-1)
-    # finally, move axis back to its original position
-    return np.moveaxis(dvar, -1, axis)
+    var = np.asarray(var)
+    out = _out_array(var, var.shape, out)
+    if _use_rows_kernel(var, axis):
+        return backend.diff_rows(var, out)
+    # move the difference axis to the last position (views, no copies)
+    vin = np.moveaxis(var, axis, -1)
+    vout = np.moveaxis(out, axis, -1)
+    np.subtract(vin[..., 1:], vin[..., :-1], out=vout[..., :-1])
+    vout[..., -1] = np.nan
+    return out
 
 
-def profddz(altitude, var, axis=-1):
+def profddz(altitude, var, axis=-1, out=None):
     """
     Find the derivative of `var` with respect to `altitude` along
-    the axis `axis`.
+    the axis `axis`. The result has the same shape as `var`, with nan
+    at the end of `axis`, and is written into `out` if it's given.
     """
-    # calculate the derivative
-    dvar = np.diff(var, axis=axis)
-    daltitude = np.diff(altitude, axis=axis)
-    dtdz = dvar / daltitude
-    # adtdz a block of nan's on the end to keep the same size
-    dtdz = np.moveaxis(dtdz, axis, -1)
-    z = np.zeros(dtdz.shape[:-1])[..., None] + np.nan
-    dtdz = np.concatenate((dtdz, z), axis=-1)
-    return np.moveaxis(dtdz, -1, axis)
+    var = np.asarray(var)
+    if _use_rows_kernel(var, axis):
+        alt = np.broadcast_to(altitude, var.shape)
+        out = _out_array(var, var.shape, out)
+        return backend.ddz_rows(alt, var, out)
+    out = profdiff(var, axis=axis, out=out)
+    vout = np.moveaxis(out, axis, -1)
+    alt = np.moveaxis(np.broadcast_to(altitude, var.shape), axis, -1)
+    # divide by the altitude difference one block at a time, reusing
+    # the same buffer for each block
+    buf = None
+    for sl in _blocks(vout):
+        ab = alt[sl]
+        if buf is None:
+            buf = np.empty(ab[..., 1:].shape, dtype=out.dtype)
+        dz = buf[: len(ab)] if ab.ndim > 1 else buf
+        np.subtract(ab[..., 1:], ab[..., :-1], out=dz)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            np.divide(vout[sl][..., :-1], dz, out=vout[sl][..., :-1])
+    return out
+
+
+def interp_profiles(coord, var, levels, out=None):
+    """
+    Interpolate many profiles of `var` at once from their vertical
+    coordinate `coord` (like altitude or potential temperature, one
+    row per profile, the same shape as `var`) to the target `levels`
+    (1-D, or one row per profile). nans at the top and bottom of a
+    profile (or anywhere else) are skipped, and levels outside of the
+    valid part of a profile are nan. Each profile of `coord` must be
+    monotonic. Returns an array of shape (nprof, nlevels), written
+    into `out` if it's given.
+
+    Example, temperature on altitude levels every km:
+        interp_profiles(altitude, temperature, np.arange(0, 101))
+    """
+    var = np.atleast_2d(var)
+    coord = np.broadcast_to(coord, var.shape)
+    levels = np.asarray(levels)
+    nlevels = levels.shape[-1]
+    levels = np.broadcast_to(levels, (var.shape[0], nlevels))
+    out = _out_array(var, (var.shape[0], nlevels), out)
+    for sl in _blocks(out):
+        backend.interp_rows(coord[sl], var[sl], levels[sl], out[sl])
+    return out
 
 
 def _logop(func, name=None, doc=None):
@@ -106,3 +206,249 @@ logmedian = np.nanmedian
 logmedian.__name__ = "logmedian"
 logquantile = np.nanquantile
 logquantile.__name__ = "logquantile"
+
+
+class RunningStats(object):
+    """
+    Count, mean, and variance that are updated one chunk of data at a
+    time and can be merged with the results from other chunks,
+    years, or processes (Welford's algorithm, with Chan et al.'s
+    formula for combining two sets of statistics). nans and infs are
+    ignored.
+
+    Example:
+        stats = RunningStats()
+        for chunk in iter_prof_var(2010, "temperature"):
+            stats.update(chunk, axis=0)
+        stats.mean, stats.std()
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = np.nan
+        self._m2 = np.nan
+
+    def _transform(self, x):
+        return np.asarray(x, dtype=float)
+
+    def update(self, x, axis=None):
+        """Add the values in `x`, reduced along `axis` (None for all
+        values). Returns self."""
+        y = self._transform(x)
+        finite = np.isfinite(y)
+        n = finite.sum(axis=axis)
+        y = np.where(finite, y, 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = y.sum(axis=axis) / n
+            dev = np.where(finite, y - np.expand_dims(mean, _axes(y, axis)), 0)
+        m2 = (dev * dev).sum(axis=axis)
+        return self._combine(n, mean, m2)
+
+    def merge(self, other):
+        """Add the statistics accumulated by another RunningStats.
+        Returns self."""
+        return self._combine(other.count, other.mean, other._m2)
+
+    def _combine(self, n_b, mean_b, m2_b):
+        n_a, mean_a, m2_a = self.count, self.mean, self._m2
+        n = n_a + n_b
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = mean_b - mean_a
+            frac = n_b / n
+            mean = np.where(n_a == 0, mean_b, mean_a + delta * frac)
+            m2 = np.where(
+                n_a == 0, m2_b, m2_a + m2_b + delta * delta * n_a * frac
+            )
+        # chunks without any values leave the statistics unchanged
+        self.mean = np.where(n_b == 0, mean_a, mean)
+        self._m2 = np.where(n_b == 0, m2_a, m2)
+        self.count = n
+        return self
+
+    def var(self, ddof=0):
+        """Variance, nan where there are `ddof` or fewer values."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            var = self._m2 / (self.count - ddof)
+        return np.where(self.count > ddof, var, np.nan)
+
+    def std(self, ddof=0):
+        return np.sqrt(self.var(ddof))
+
+
+class LogStats(RunningStats):
+    """
+    RunningStats of log_base(x), for quantities like dust and water
+    ice that span orders of magnitude. `logmean`, `logstd`, and
+    `logvar` give the same results as the functions with the same
+    names, for all of the data that has been added. Values <= 0 are
+    ignored.
+    """
+
+    def __init__(self, base=10):
+        super().__init__()
+        self.base = base
+
+    def _transform(self, x):
+        x = np.asarray(x)
+        y = np.empty(x.shape)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            np.log(x, out=y)
+        y /= np.log(self.base)
+        return y
+
+    def merge(self, other):
+        if other.base != self.base:
+            raise ValueError("LogStats have different bases.")
+        return super().merge(other)
+
+    def _power(self, y):
+        if self.base == np.e:
+            return np.exp(y)
+        return np.power(self.base, y)
+
+    def logmean(self):
+        return self._power(self.mean)
+
+    def logstd(self, ddof=0):
+        return self._power(self.std(ddof))
+
+    def logvar(self, ddof=0):
+        return self._power(self.var(ddof))
+
+
+class LogHistogram(object):
+    """
+    Approximate quantiles from a histogram with logarithmically spaced
+    bins, which can be updated one chunk of data at a time and merged
+    with the histograms of other chunks, years, or processes. There
+    can be a separate histogram for each cell of a grid with shape
+    `shape`, using the same flat cell index as binning.BinnedStats.
+
+    vmin, vmax: the range of the bins (> 0)
+    bins_per_decade: number of bins for each factor of 10
+
+    Error bounds: for values between vmin and vmax, the quantiles are
+    within one bin of the exact quantile of the data, so the relative
+    error is less than 10 ** (1 / bins_per_decade) - 1 (2.3% for the
+    default of 100 bins per decade), and is usually much smaller since
+    the values are interpolated within the bin. Values <= vmin or
+    >= vmax are counted, so the quantile ranks are still correct, but
+    quantiles that fall among them are returned as vmin or vmax. nans
+    and values <= 0 are ignored. The memory used is 8 bytes times the
+    number of cells times the number of bins.
+    """
+
+    def __init__(self, vmin=1e-8, vmax=1e4, bins_per_decade=100, shape=()):
+        ndecade = np.log10(vmax / vmin)
+        self.nbins = int(np.ceil(ndecade * bins_per_decade))
+        self.edges = np.logspace(
+            np.log10(vmin), np.log10(vmax), self.nbins + 1
+        )
+        self.shape = tuple(np.atleast_1d(shape)) if shape != () else ()
+        # one extra bin on each end for values outside of the edges
+        ncell = int(np.prod(self.shape))
+        self.counts = np.zeros((ncell, self.nbins + 2), dtype=np.int64)
+
+    def update(self, x, cell=None):
+        """Add the values in `x` to the histogram, or to the histograms
+        of the cells with flat indexes `cell` (the same shape as `x`;
+        negative indexes are ignored). Returns self."""
+        x = np.asarray(x, dtype=float).ravel()
+        if cell is None:
+            cell = np.zeros(x.shape, dtype=np.intp)
+        else:
+            cell = np.broadcast_to(cell, np.shape(x)).ravel()
+        ok = (cell >= 0) & (x > 0)
+        if not ok.all():
+            x, cell = x[ok], cell[ok]
+        ix = np.searchsorted(self.edges, x, side="right")
+        nb = self.nbins + 2
+        self.counts += np.bincount(
+            cell * nb + ix, minlength=self.counts.size
+        ).reshape(self.counts.shape)
+        return self
+
+    def merge(self, other):
+        """Add the counts from another LogHistogram with the same bins.
+        Returns self."""
+        if self.shape != other.shape or not np.array_equal(
+            self.edges, other.edges
+        ):
+            raise ValueError("LogHistogram bins do not match.")
+        self.counts += other.counts
+        return self
+
+    @property
+    def count(self):
+        return self.counts.sum(axis=-1).reshape(self.shape)
+
+    def quantile(self, q):
+        """Approximate quantile(s) `q` (0-1) of the values in each cell,
+        nan for empty cells. Returns an array with shape
+        np.shape(q) + shape."""
+        q = np.asarray(q, dtype=float)
+        cum = np.cumsum(self.counts, axis=-1)
+        n = cum[:, -1]
+        # rank of each quantile in each cell, shape (nq, ncell), and
+        # > 0 so that q = 0 starts at the first bin with any values
+        rank = np.maximum(q.reshape((-1, 1)) * n, 1e-9)
+        ix = np.minimum((cum < rank[..., None]).sum(axis=-1), self.nbins + 1)
+        icell = np.arange(cum.shape[0])
+        below = np.where(ix > 0, cum[icell, ix - 1], 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            frac = np.clip((rank - below) / self.counts[icell, ix], 0, 1)
+        # interpolate in log space within the bin, and clamp values
+        # outside of the edges to vmin or vmax
+        lo = np.log(self.edges[np.clip(ix - 1, 0, self.nbins)])
+        hi = np.log(self.edges[np.clip(ix, 0, self.nbins)])
+        value = np.exp(lo + np.nan_to_num(frac) * (hi - lo))
+        value = np.where(n > 0, value, np.nan)
+        return value.reshape(q.shape + self.shape)
+
+    def median(self):
+        return self.quantile(0.5)
+
+
+def _axes(x, axis):
+    """The axes reduced by `axis`, for np.expand_dims."""
+    if axis is None:
+        return tuple(range(np.ndim(x)))
+    return axis
+
+
+def _test_logstats(nchunk=10, seed=None):
+    """Compare LogStats updated and merged in chunks to logmean,
+    logstd, and logvar of all of the data."""
+    rng = np.random.default_rng(seed)
+    x = 10 ** rng.normal(-3, 2, size=(nchunk * 1000, 105))
+    x[rng.random(x.shape) < 0.1] = np.nan
+    halves = LogStats(), LogStats()
+    for ix, chunk in enumerate(np.array_split(x, nchunk)):
+        halves[ix % 2].update(chunk, axis=0)
+    stats = halves[0].merge(halves[1])
+    for func in (logmean, logstd, logvar):
+        expected = func(x, axis=0)
+        result = getattr(stats, func.__name__)()
+        assert np.allclose(result, expected, rtol=1e-10), func.__name__
+    assert (stats.count == np.isfinite(x).sum(axis=0)).all()
+    return stats
+
+
+def _test_loghistogram(nchunk=10, bins_per_decade=100, seed=None):
+    """Compare quantiles from LogHistograms updated and merged in
+    chunks to the exact quantiles, for 3 cells."""
+    rng = np.random.default_rng(seed)
+    x = 10 ** rng.normal(-3, 1, size=(nchunk * 10000))
+    cell = rng.integers(0, 3, size=x.shape)
+    halves = [LogHistogram(1e-9, 1e3, bins_per_decade, 3) for _ in "ab"]
+    for ix, sl in enumerate(np.array_split(np.arange(x.size), nchunk)):
+        halves[ix % 2].update(x[sl], cell[sl])
+    hist = halves[0].merge(halves[1])
+    q = np.array([0.01, 0.1, 0.5, 0.9, 0.99])
+    result = hist.quantile(q)
+    expected = np.stack(
+        [np.quantile(x[cell == cc], q) for cc in range(3)], axis=-1
+    )
+    relerr = np.abs(result / expected - 1).max()
+    assert relerr < 10 ** (1 / bins_per_decade) - 1, relerr
+    return relerr
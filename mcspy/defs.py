@@ -1,56 +1,93 @@
 __package__ = "mcspy"
 
-from os import getenv
-from os.path import exists
+from os.path import exists, expanduser
 from collections import OrderedDict
 from configparser import ConfigParser
 
-__all__ = [
+# MCS_DATA_PATH is read from the config file by __getattr__ the first
+# time it's used, which flake8 can't see
+__all__ = [  # noqa: F822
     "MCS_DATA_PATH",
     "header_columns",
     "index_columns",
     "_index_keep_columns",
     "data_columns",
     "mix_keep_cols",
+    "mix_derived_cols",
     "mix_cols",
     "prof_cols",
+    "summary_cols",
+    "summary_groups",
+    "zone_cols",
+    "zone_block_size",
     "set_config",
+    "get_config",
     # "allmcsyears",
 ]
 
 
 # default configureation for config file ~/.mcspy
+_config_file = expanduser("~/.mcspy")
 _default_config = {
-    "mcs_data_path": getenv("HOME") + "/mcsdata",
+    "mcs_data_path": expanduser("~/mcsdata"),
     "most_recent_known_mrom": "MROM_2158",
+    # "numpy", "numba", or "auto" to use numba if it's installed
+    "backend": "auto",
+    # login for the PDS ftp server, the password is your email address
+    "ftp_user": "anonymous",
+    "ftp_password": "anonymous@",
 }
 
-MCS_DATA_PATH = None
+# the contents of the config file, read the first time a setting is used
+_config = None
 
 
 def set_config(key, value):
+    global _config
     config = ConfigParser(defaults=_default_config)
-    config.read(getenv("HOME") + "/.mcspy")
+    config.read(_config_file)
     config.set("DEFAULT", key, value)
-    with open(getenv("HOME") + "/.mcspy", "w") as fout:
+    with open(_config_file, "w") as fout:
         config.write(fout)
+    # forget cached settings so they are re-read on next access
+    _config = None
+    for name in _lazy_settings:
+        globals().pop(name, None)
 
 
-# load cfg file
-if exists(getenv("HOME") + "/.mcspy"):
-    config = ConfigParser(defaults=_default_config)
-    config.read(getenv("HOME") + "/.mcspy")
-else:
-    MCS_DATA_PATH = getenv("HOME") + "/mcsdata/"
-    config = ConfigParser(defaults=_default_config)
-    with open(getenv("HOME") + "/.mcspy", "w") as fout:
-        config.write(fout)
+def get_config(key):
+    """Return the setting `key` from the config file ~/.mcspy, or its
+    default value if the file or setting doesn't exist. The file is
+    only read the first time a setting is needed."""
+    global _config
+    if _config is None:
+        config = ConfigParser(defaults=_default_config)
+        if exists(_config_file):
+            config.read(_config_file)
+        _config = config
+    return _config["DEFAULT"][key]
 
-MCS_DATA_PATH = config["DEFAULT"]["mcs_data_path"]
 
-if not MCS_DATA_PATH.endswith("/"):
-    MCS_DATA_PATH = MCS_DATA_PATH + "/"
-_most_recent_known_mrom = config["DEFAULT"]["most_recent_known_mrom"]
+def _get_mcs_data_path():
+    path = get_config("mcs_data_path")
+    if not path.endswith("/"):
+        path = path + "/"
+    return path
+
+
+# settings from the config file that are loaded on first access
+_lazy_settings = {
+    "MCS_DATA_PATH": _get_mcs_data_path,
+    "_most_recent_known_mrom": lambda: get_config("most_recent_known_mrom"),
+}
+
+
+def __getattr__(name):
+    if name in _lazy_settings:
+        value = _lazy_settings[name]()
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 header_columns = [
@@ -150,6 +187,7 @@ _index_keep_columns = [
     "volume_id",
     "path",
     "filename",
+    "product_creation_time",
     "start_time",
     "stop_time",
     "start_orbit_number",
@@ -285,7 +323,12 @@ mix_date_cols = (
 )
 
 mix_time_cols = ["UTC"] + mix_tab_ref_dt_cols[1::2]
-mix_new_cols = ["datetime", "MY"]
+# time variables calculated from Ls, MY, and the sol of the Mars Year
+# Ls2: Ls + 360 * (MY - 28), continuous across Mars Years
+# msol: mission sol, sols since the start of MY 28
+# MYfrac: MY + fraction of the Mars Year, sol / 668.6
+mix_derived_cols = ["Ls2", "msol", "MYfrac"]
+mix_new_cols = ["datetime", "MY"] + mix_derived_cols
 
 mix_data_cols = [
     "date",
@@ -342,6 +385,9 @@ mix_qual_cols = [
 mix_use_cols = [
     "datetime",
     "MY",
+    "Ls2",
+    "msol",
+    "MYfrac",
     "SCLK",
     "Ls",
     "solar_dist",
@@ -381,6 +427,30 @@ mix_use_cols = [
 mix_keep_cols = mix_use_cols
 mix_cols = mix_use_cols + ["profidint"]
 
+# metadata variables averaged in the per-orbit and per-sol summary
+# tables that are saved when data is imported
+summary_cols = [
+    "Ls2",
+    "lat",
+    "LST",
+    "T_surf",
+    "T_near_surf",
+    "dust_column",
+    "H2Ovap_column",
+    "H2Oice_column",
+    "CO2ice_column",
+    "p_surf",
+]
+# summary table name and the metadata variable it is grouped by
+summary_groups = {"orbit": "orb_num", "sol": "sol"}
+
+# metadata variables with per-block min/max "zone maps", which are
+# saved when data is imported and used to skip blocks of profiles that
+# can't match a range query
+zone_cols = ["datetime", "Ls2", "lat", "lon", "LST", "solar_zen"]
+# number of profiles in each zone map block
+zone_block_size = 1024
+
 prof_cols = [
     "temperature",
     "T_err",
@@ -0,0 +1,291 @@
+__package__ = "mcspy"
+
+import os
+import gzip
+import json
+import numpy as np
+from os.path import exists, dirname, getsize
+from . import calc
+from .defs import mix_cols
+from .util import allyearsdec
+from .loaders import (
+    MCS_DATA_PATH,
+    calc_var_path,
+    prof_var_path,
+    prof_var_shape,
+    iter_prof_var,
+    iter_calc_var,
+    load_mix_var,
+    load_prof_var,
+)
+
+__all__ = [
+    "calc_vars",
+    "register_calc_var",
+    "register_regrid_var",
+    "update_calc_var",
+    "update_calc_vars",
+    "calc_var_is_current",
+    "calc_var_levels",
+]
+
+__doc__ = """
+Registry of derived (calculated) profile variables, which are saved in
+"{year}/calcdata/{year}_{varname}_profiles.npy" so they only have to be
+calculated once.
+
+Each variable is declared with `register_calc_var` with the names of
+its input variables and a function that calculates it from chunks of
+the inputs. Inputs can be profile variables, "pressure", metadata
+index variables (one value per profile, passed as a column), or other
+registered calc variables.
+
+`update_calc_var` calculates a variable for a year in chunks and saves
+it, along with a manifest of the size and modification time of each
+input file. The variable is only recalculated when an input has
+changed, so `load_calc_var` and `load_calc_var_years` are cheap reads
+after the first time.
+"""
+
+# {name: {"inputs": [...], "func": func, "version": version, "doc": doc}}
+calc_vars = {}
+
+
+def register_calc_var(name, inputs, func, version=1, doc=None, params=None):
+    """
+    Declare the calculated variable `name`.
+
+    inputs: list of the names of the input variables
+    func: function called with a chunk of each input (2-D arrays of
+        profiles, or columns for metadata variables) that returns the
+        variable for the chunk, a 2-D array with one row per profile
+    version: change this when `func` changes to recalculate saved data
+    params: optional dict of JSON-compatible settings that are saved in
+        the manifest, so changing them also recalculates saved data
+    """
+    calc_vars[name] = {
+        "inputs": list(inputs),
+        "func": func,
+        "version": version,
+        "doc": doc if doc is not None else func.__doc__,
+        "params": {} if params is None else params,
+    }
+
+
+def register_regrid_var(name, varname, coord, levels, version=1):
+    """
+    Declare the calculated variable `name`, the profile variable
+    `varname` interpolated from the vertical coordinate `coord` (like
+    "altitude" or "theta") to the fixed `levels` with
+    `calc.interp_profiles`. The levels are saved in the manifest and
+    can be read with `calc_var_levels(name)`.
+
+    Example, temperature on isentropic levels:
+        register_regrid_var(
+            "temperature_theta", "temperature", "theta",
+            np.arange(150, 1001, 10),
+        )
+    """
+    levels = np.asarray(levels, dtype=float)
+
+    def regrid(x, y):
+        return calc.interp_profiles(x, y, levels)
+
+    register_calc_var(
+        name,
+        [coord, varname],
+        regrid,
+        version=version,
+        doc=f"{varname} interpolated to fixed {coord} levels",
+        params={"levels": levels.tolist()},
+    )
+
+
+def calc_var_levels(name):
+    """The target levels of a regridded calc variable."""
+    return np.array(calc_vars[name]["params"]["levels"])
+
+
+def _lapse_rate(altitude, temperature):
+    """Temperature lapse rate -dT/dz in K/km."""
+    out = calc.profddz(altitude, temperature)
+    return np.negative(out, out=out)
+
+
+register_calc_var(
+    "theta",
+    ["pressure", "temperature"],
+    calc.potential_temperature,
+    doc="Potential temperature in K, with a reference pressure of 610 Pa.",
+)
+register_calc_var("dTdz", ["altitude", "temperature"], calc.profddz)
+register_calc_var("lapse_rate", ["altitude", "temperature"], _lapse_rate)
+register_regrid_var(
+    "temperature_alt", "temperature", "altitude", np.arange(0, 101, 1)
+)
+
+
+def _manifest_path(year, name):
+    return calc_var_path(year, name)[: -len(".npy")] + "_manifest.json"
+
+
+def _input_path(year, name):
+    """Path of the file that input variable `name` is read from, or
+    None if it doesn't come from a file."""
+    if name == "pressure":
+        return None
+    if name in calc_vars:
+        return calc_var_path(year, name)
+    if name in mix_cols:
+        return MCS_DATA_PATH + f"DATA/{year}/indexdata/{year}_mixvars.npz"
+    if name == "rowidint" and not exists(prof_var_path(year, name)):
+        return _input_path(year, "profidint")
+    return prof_var_path(year, name)
+
+
+def _file_key(fname):
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _make_manifest(year, name):
+    """The manifest that describes the current inputs of `name`."""
+    var = calc_vars[name]
+    files = {}
+    for vn in var["inputs"]:
+        fname = _input_path(year, vn)
+        if fname is not None:
+            files[vn] = _file_key(fname)
+    return {
+        "name": name,
+        "version": var["version"],
+        "params": var["params"],
+        "inputs": files,
+    }
+
+
+def calc_var_is_current(year, name):
+    """Whether the saved calc variable `name` for `year` exists and was
+    calculated from the current versions of its inputs."""
+    fname, mname = calc_var_path(year, name), _manifest_path(year, name)
+    if not (exists(fname) and exists(mname)):
+        return False
+    with open(mname) as fin:
+        saved = json.load(fin)
+    return saved == _make_manifest(year, name)
+
+
+def _iter_inputs(year, name, chunksize, quiet):
+    """Yield lists of chunks of each input of calc variable `name`."""
+    inputs = calc_vars[name]["inputs"]
+    iters = []
+    for vn in inputs:
+        if vn == "pressure":
+            prs = load_prof_var(None, "pressure")
+            iters.append(_repeat(prs))
+        elif vn in calc_vars:
+            iters.append(iter_calc_var(year, vn, chunksize, quiet))
+        elif vn in mix_cols:
+            col = load_mix_var(year, vn, quiet=quiet)
+            iters.append(
+                col[ix:ix+chunksize, None]
+                for ix in range(0, len(col), chunksize)
+            )
+        else:
+            iters.append(iter_prof_var(year, vn, chunksize, quiet))
+    return zip(*iters)
+
+
+def _repeat(x):
+    while True:
+        yield x
+
+
+def _nrows(year, name):
+    """Number of profiles for `year`, from the first input that is a
+    profile or calc variable."""
+    for vn in calc_vars[name]["inputs"]:
+        if vn in calc_vars:
+            return _nrows(year, vn)
+        if vn not in mix_cols and vn != "pressure":
+            return int(np.prod(prof_var_shape(year, vn))) // 105
+    return len(load_mix_var(year, "profidint", quiet=True))
+
+
+def _write_npy_chunks(fname, nrows, chunks):
+    """Write the 2-D chunks in the iterable `chunks`, with `nrows` rows
+    in total, to the gzipped .npy file `fname` without keeping more
+    than one chunk in memory. The file is written to a temporary file
+    and renamed, so a partly written file is never left behind."""
+    os.makedirs(dirname(fname), exist_ok=True)
+    tmp = fname + ".tmp"
+    written = 0
+    try:
+        with gzip.open(tmp, "wb") as fout:
+            for chunk in chunks:
+                chunk = np.ascontiguousarray(chunk)
+                if written == 0:
+                    header = np.lib.format.header_data_from_array_1_0(chunk)
+                    header["shape"] = (nrows,) + chunk.shape[1:]
+                    np.lib.format.write_array_header_1_0(fout, header)
+                fout.write(chunk.data)
+                written += len(chunk)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    if written != nrows:
+        os.remove(tmp)
+        raise IndexError(f"Wrote {written} rows to {fname}, expected {nrows}.")
+    os.replace(tmp, fname)
+
+
+def update_calc_var(
+    year, name, overwrite=False, chunksize=4096, quiet=False
+):
+    """
+    Calculate the calc variable `name` for `year` and save it, unless
+    it has already been saved from the current inputs (or `overwrite`
+    is True). Input calc variables are updated first.
+
+    returns: True if the variable was calculated
+    """
+    var = calc_vars[name]
+    for vn in var["inputs"]:
+        if vn in calc_vars:
+            update_calc_var(year, vn, overwrite, chunksize, quiet)
+    if not overwrite and calc_var_is_current(year, name):
+        return False
+    fname = calc_var_path(year, name)
+    chunks = (
+        var["func"](*args)
+        for args in _iter_inputs(year, name, chunksize, quiet=True)
+    )
+    _write_npy_chunks(fname, _nrows(year, name), chunks)
+    with open(_manifest_path(year, name), "w") as fout:
+        json.dump(_make_manifest(year, name), fout)
+    if not quiet:
+        print(f"wrote {fname} ({getsize(fname)} bytes)")
+    return True
+
+
+@allyearsdec
+def update_calc_vars(
+    years=None, names=None, overwrite=False, chunksize=4096, quiet=False
+):
+    """Update the calc variables `names` (default all registered
+    variables) for `years`. Years without data are skipped. Returns a
+    dict of {year: [names of the variables that were calculated]}."""
+    if names is None:
+        names = list(calc_vars)
+    updated = {}
+    for yy in years:
+        try:
+            updated[yy] = [
+                nn
+                for nn in names
+                if update_calc_var(yy, nn, overwrite, chunksize, quiet)
+            ]
+        except FileNotFoundError:
+            if not quiet:
+                print(f"No data for {yy}")
+    return updated
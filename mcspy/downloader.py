@@ -1,15 +1,26 @@
 __package__ = "mcspy"
-from os import makedirs, unlink
+from os import makedirs, unlink, replace
 from os.path import dirname, exists
 import gzip
-from ftplib import FTP
-from requests import get
+import zlib
+import queue
+import asyncio
+import threading
+from urllib.parse import urljoin, urlsplit
+from ftplib import FTP, all_errors as ftplib_errors
+from requests import Session
 from .util import mcs_tab_path, addext
 from .defs import _most_recent_known_mrom, MCS_DATA_PATH
 
 __all__ = [
     "get_tab_files",
     "batch_get_tab_files",
+    "async_get_tab_files",
+    "get_tab_files_ftp",
+    "fetch_tab_file",
+    "save_tab_file",
+    "FTPPool",
+    "AsyncHTTPPool",
     "get_most_recent_index_http",
     "get_most_recent_index_ftp",
 ]
@@ -29,6 +40,9 @@ def get_tab_files(prodids, dfindex, overwrite=False, use_ftp=False, _pid=""):
     if _pid == "":
         _pid = "{}".format(multiprocessing.current_process().pid)
     downloaded = []
+    # reuse one connection for all of the downloads
+    session = Session()
+    ftppool = FTPPool(size=1)
     for prodid in prodids:
         # get the file path as it is stored on the PDS
         path = mcs_tab_path(prodid, dfindex, volume=True)
@@ -45,59 +59,649 @@ def get_tab_files(prodids, dfindex, overwrite=False, use_ftp=False, _pid=""):
                     PDS_SERVER_PATH + "/" + path,
                     addext(localpath, ".gz"),
                     _pid,
+                    ftppool,
                 )
             else:
                 get_tab_file_http(
-                    PDS_ROOT_URL + "/" + path, addext(localpath, ".gz"), _pid
+                    PDS_ROOT_URL + "/" + path,
+                    addext(localpath, ".gz"),
+                    _pid,
+                    session,
                 )
             downloaded.append(localpath)
             print(f"({_pid}) Done")
         except Exception:
             print(f"({_pid}) Download failed {prodid}")
+    session.close()
+    ftppool.close()
     return downloaded
 
 
-def batch_get_tab_files(prodids, dfindex, overwrite=False, use_ftp=False):
-    from multiprocessing import Pool
+def batch_get_tab_files(
+    prodids, dfindex, overwrite=False, use_ftp=False, concurrency=8
+):
+    """Download many .TAB files and return the list of downloaded
+    files. HTTP downloads use `async_get_tab_files`, with up to
+    `concurrency` keep-alive connections to the server, and FTP
+    downloads use `get_tab_files_ftp` with `concurrency` sessions."""
+    if use_ftp:
+        return get_tab_files_ftp(
+            prodids, dfindex, overwrite, nsessions=concurrency
+        )
+    return asyncio.run(
+        async_get_tab_files(
+            prodids, dfindex, overwrite, concurrency=concurrency
+        )
+    )
+
+
+# HTTP status codes of the redirects that AsyncHTTPPool follows
+_redirect_codes = (301, 302, 303, 307, 308)
+
+
+class AsyncHTTPPool(object):
+    """
+    HTTP/1.1 client for one server that keeps up to `size` keep-alive
+    connections open and reuses them for later requests, so many small
+    files don't each pay for a new TCP connection. At most `size`
+    requests are sent at once. Use it as an async context manager:
+
+        async with AsyncHTTPPool("atmos.nmsu.edu") as pool:
+            status, headers, body = await pool.get("/PDS/data/...")
+    """
+
+    def __init__(self, host, port=80, size=8, timeout=60):
+        self.host = host
+        self.port = port
+        self.size = size
+        # seconds to wait for each read from the server, not for the
+        # whole response, so a large file doesn't time out as long as
+        # it keeps arriving
+        self.timeout = timeout
+        # number of connections that have been opened, for testing
+        self.nconnect = 0
+        self._idle = []
+        self._sem = None
+
+    async def __aenter__(self):
+        self._sem = asyncio.Semaphore(self.size)
+        return self
+
+    async def __aexit__(self, *args):
+        while self._idle:
+            self._close(self._idle.pop())
+
+    async def _connect(self, host=None, port=None, ssl=False):
+        conn = await self._io(
+            asyncio.open_connection(
+                host or self.host, port or self.port, ssl=ssl or None
+            )
+        )
+        self.nconnect += 1
+        return conn
+
+    def _close(self, conn):
+        conn[1].close()
+
+    async def _io(self, aw):
+        return await asyncio.wait_for(aw, self.timeout)
+
+    async def get(self, path, headers=None):
+        """GET `path` and return (status, headers, body), where the
+        header names are lower case."""
+        chunks = []
+        status, hdrs = await self.stream(path, chunks.append, headers)
+        return status, hdrs, b"".join(chunks)
+
+    async def stream(
+        self, path, write, headers=None, on_response=None, max_redirects=5
+    ):
+        """GET `path`, calling `write` with each chunk of the body as it
+        arrives, and `on_response(status, headers)` before the body if
+        it's given. Redirects are followed, to other servers with a
+        connection that isn't kept. Returns (status, headers)."""
+        origin = (self.host, self.port, False)
+        async with self._sem:
+            for _ in range(max_redirects + 1):
+                moved = []
+
+                def response(status, hdrs):
+                    if status in _redirect_codes and "location" in hdrs:
+                        moved.append(hdrs["location"])
+                    elif on_response is not None:
+                        on_response(status, hdrs)
+
+                def body(chunk):
+                    # skip the body of a redirect
+                    if not moved:
+                        write(chunk)
+
+                if origin == (self.host, self.port, False):
+                    status, hdrs = await self._pooled(
+                        path, body, headers, response
+                    )
+                else:
+                    conn = await self._connect(*origin)
+                    try:
+                        status, hdrs, _ = await self._request(
+                            conn, path, body, headers, response, origin[0]
+                        )
+                    finally:
+                        self._close(conn)
+                if not moved:
+                    return status, hdrs
+                scheme = "https" if origin[2] else "http"
+                base = f"{scheme}://{origin[0]}:{origin[1]}{path}"
+                url = urlsplit(urljoin(base, moved[0]))
+                secure = url.scheme == "https"
+                port = url.port or (443 if secure else 80)
+                origin = (url.hostname, port, secure)
+                path = url.path + ("?" + url.query if url.query else "")
+        raise OSError(f"Too many redirects for {path}")
+
+    async def _pooled(self, path, write, headers, on_response):
+        """Send a request on one of the pool's connections."""
+        # a reused connection may have been closed by the server, so
+        # retry once with a new connection
+        for attempt in range(2):
+            reused = bool(self._idle)
+            conn = self._idle.pop() if reused else await self._connect()
+            started = []
+
+            def response(status, hdrs):
+                started.append(status)
+                on_response(status, hdrs)
+
+            try:
+                status, hdrs, keep = await self._request(
+                    conn, path, write, headers, response
+                )
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self._close(conn)
+                if reused and attempt == 0 and not started:
+                    continue
+                raise
+            except BaseException:
+                self._close(conn)
+                raise
+            if keep:
+                self._idle.append(conn)
+            else:
+                self._close(conn)
+            return status, hdrs
+
+    async def _request(
+        self, conn, path, write, headers, on_response, host=None
+    ):
+        reader, writer = conn
+        lines = [
+            f"GET {path} HTTP/1.1",
+            f"Host: {host or self.host}",
+            "Connection: keep-alive",
+        ]
+        lines += [f"{k}: {v}" for k, v in (headers or {}).items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await self._io(writer.drain())
+
+        line = await self._io(reader.readline())
+        if not line:
+            raise ConnectionError("Connection closed by server.")
+        status = int(line.split()[1])
+        hdrs = {}
+        while True:
+            line = await self._io(reader.readline())
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            hdrs[key.strip().lower()] = value.strip()
+
+        on_response(status, hdrs)
+        keep = hdrs.get("connection", "").lower() != "close"
+        if hdrs.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                line = await self._io(reader.readline())
+                size = int(line.split(b";")[0], 16)
+                if size == 0:
+                    await self._io(reader.readline())
+                    break
+                write(await self._io(reader.readexactly(size)))
+                await self._io(reader.readline())
+        elif "content-length" in hdrs:
+            remaining = int(hdrs["content-length"])
+            while remaining > 0:
+                chunk = await self._io(reader.read(min(remaining, 2**16)))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                write(chunk)
+                remaining -= len(chunk)
+        else:
+            # the body ends when the server closes the connection
+            keep = False
+            while True:
+                chunk = await self._io(reader.read(2**16))
+                if not chunk:
+                    break
+                write(chunk)
+        return status, hdrs, keep
+
+
+class _GzipSink(object):
+    """Compress the chunks of a download into a gzip file in a worker
+    thread, so the event loop only has to queue them."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.queue = queue.Queue()
+        self.done = None
+
+    def open(self, mode):
+        self.done = asyncio.get_running_loop().run_in_executor(
+            None, self._drain, mode
+        )
+
+    def write(self, chunk):
+        if self.done is not None:
+            self.queue.put(chunk)
+
+    def _drain(self, mode):
+        with gzip.open(self.fname, mode) as fout:
+            for chunk in iter(self.queue.get, None):
+                fout.write(chunk)
+
+    async def close(self):
+        if self.done is not None:
+            self.queue.put(None)
+            await self.done
+
 
-    starargs = ((x, dfindex, overwrite, use_ftp) for x in prodids)
-    with Pool() as pp:
+async def _async_download(pool, path, local_filepath):
+    """Async version of `download_http`, using an AsyncHTTPPool. The
+    body is compressed into the partial file in a thread as it
+    arrives."""
+    loop = asyncio.get_running_loop()
+    tmp = local_filepath + ".part"
+    offset = await loop.run_in_executor(None, _resume_offset, tmp)
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    sink = _GzipSink(tmp)
+
+    def on_response(status, hdrs):
+        # open the partial file once the response says how to use it
+        mode = _resume_mode(offset, status, hdrs)
+        if mode is not None and status in (200, 206):
+            sink.open(mode)
+
+    try:
+        status, _ = await pool.stream(path, sink.write, headers, on_response)
+    finally:
+        await sink.close()
+    if status not in (200, 206) and not (status == 416 and offset):
+        raise OSError(f"HTTP status {status} for {path}")
+    replace(tmp, local_filepath)
+    return local_filepath
+
+
+async def async_get_tab_files(
+    prodids,
+    dfindex,
+    overwrite=False,
+    concurrency=8,
+    root_url=PDS_ROOT_URL,
+    data_path=None,
+    pool=None,
+):
+    """
+    Download .TAB data files from the PDS with one event loop and a
+    pool of up to `concurrency` keep-alive HTTP connections, and save
+    them gzip'ed. This is a coroutine, use
+    `asyncio.run(async_get_tab_files(...))` or `batch_get_tab_files`
+    outside of an event loop.
+
+    root_url: server and path of the PDS data, without "http://"
+    data_path: local directory to save the files in (MCS_DATA_PATH by
+        default)
+    pool: an open AsyncHTTPPool for the server to use instead of
+        making a new one (then `concurrency` is ignored)
+
+    returns: list of the downloaded files
+    """
+    if isinstance(prodids, str):
+        prodids = [prodids]
+    url = urlsplit("http://" + root_url)
+    base = url.path.rstrip("/")
+    data_path = MCS_DATA_PATH if data_path is None else data_path
+
+    async def get_one(pool, prodid):
+        path = mcs_tab_path(prodid, dfindex, volume=True)
+        localpath = data_path + mcs_tab_path(prodid, dfindex, volume=False)
+        if (exists(localpath) or exists(localpath + ".gz")) and not overwrite:
+            print(f"File already exists: {prodid}")
+            return None
         try:
-            res = pp.starmap(get_tab_files, starargs)
+            makedirs(dirname(localpath), exist_ok=True)
+            await _async_download(pool, f"{base}/{path}", localpath + ".gz")
         except Exception as e:
-            return e
-        return res
+            print(f"Download failed {prodid}: {e}")
+            return None
+        print(f"Downloaded {prodid}")
+        return localpath
 
+    if pool is None:
+        async with AsyncHTTPPool(
+            url.hostname, url.port or 80, size=concurrency
+        ) as pool:
+            res = await asyncio.gather(*(get_one(pool, pp) for pp in prodids))
+    else:
+        res = await asyncio.gather(*(get_one(pool, pp) for pp in prodids))
+    return [fn for fn in res if fn is not None]
 
-def ftp_login():
+
+def ftp_login(host=PDS_ATMOS_HOST, ftp_factory=FTP):
     """Convenience function to return an FTP object connected to the
-    PDS atmos server."""
-    passwd = input('Email (as a "password" for PDS ftp server): ')
-    print(f"Connecting to {PDS_ATMOS_HOST}...")
-    return FTP(PDS_ATMOS_HOST, user="anonymous", passwd=passwd)
+    PDS atmos server, logged in with the "ftp_user" and "ftp_password"
+    settings in ~/.mcspy (by convention, the password for the PDS ftp
+    server is your email address)."""
+    from .defs import get_config
 
+    print(f"Connecting to {host}...")
+    return ftp_factory(
+        host,
+        user=get_config("ftp_user"),
+        passwd=get_config("ftp_password"),
+        timeout=60,
+    )
 
-def get_tab_file_http(server_filepath, local_filepath, _pid=""):
-    """Download the specified file using HTTP. """
-    print(f"({_pid}) Downloading {server_filepath}...")
+
+class FTPPool(object):
+    """
+    Up to `size` logged in FTP sessions that are opened when they're
+    first needed and reused for many downloads, from one or more
+    threads. `ftp_factory` makes the sessions, called like
+    `ftplib.FTP(host, user=..., passwd=..., timeout=...)`.
+
+        with FTPPool(size=4) as pool:
+            pool.download("/PDS/data/...", "local.TAB.gz")
+    """
+
+    def __init__(self, host=PDS_ATMOS_HOST, size=4, ftp_factory=FTP):
+        self.host = host
+        self.size = size
+        self.ftp_factory = ftp_factory
+        # number of sessions that have been opened, for testing
+        self.nconnect = 0
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        while True:
+            try:
+                _close_ftp(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+    def _acquire(self):
+        self._slots.acquire()
+        # another thread may take the last idle session at any time, so
+        # don't wait for one
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            ftp = ftp_login(self.host, self.ftp_factory)
+        except BaseException:
+            self._slots.release()
+            raise
+        self.nconnect += 1
+        return ftp
+
+    def _release(self, ftp, ok=True):
+        if ok:
+            self._idle.put(ftp)
+        else:
+            _close_ftp(ftp)
+        self._slots.release()
+
+    def download(self, server_filepath, local_filepath):
+        """Download `server_filepath` into the gzip'ed file
+        `local_filepath`, with a partial file and resuming like
+        `download_http` (using the FTP REST command). A session that
+        fails is closed and the download is tried once more with a new
+        session."""
+        for attempt in range(2):
+            ftp = self._acquire()
+            try:
+                _ftp_download(ftp, server_filepath, local_filepath)
+            except ftplib_errors:
+                self._release(ftp, ok=False)
+                if attempt == 0:
+                    continue
+                raise
+            except BaseException:
+                self._release(ftp, ok=False)
+                raise
+            self._release(ftp)
+            return local_filepath
+
+
+def _close_ftp(ftp):
     try:
-        r = get("http://" + server_filepath)
-        # check response
-        r.raise_for_status()
-        with gzip.open(addext(local_filepath, ".gz"), "w") as fout:
-            # save as gzip'ed file
-            fout.write(r.content)
-    except Exception as e:
-        unlink(addext(local_filepath, ".gz"))
-        raise Exception from e
+        ftp.quit()
+    except ftplib_errors:
+        ftp.close()
 
 
-def get_tab_file_ftp(server_filepath, local_filepath, _pid=""):
-    """Download the specified file using FTP. """
-    with ftp_login() as ftp:
-        with gzip.open(local_filepath, "w") as fout:
-            print(f"({_pid}) Downloading {server_filepath}...")
-            ftp.retrbinary("RETR {server_filepath}", fout.write)
+def _ftp_download(ftp, server_filepath, local_filepath):
+    tmp = local_filepath + ".part"
+    offset = _resume_offset(tmp)
+    with gzip.open(tmp, "ab" if offset else "wb") as fout:
+        ftp.retrbinary(
+            f"RETR {server_filepath}", fout.write, rest=offset or None
+        )
+    replace(tmp, local_filepath)
+
+
+def get_tab_files_ftp(
+    prodids,
+    dfindex,
+    overwrite=False,
+    nsessions=4,
+    ftp_factory=FTP,
+    host=PDS_ATMOS_HOST,
+    server_path=PDS_SERVER_PATH,
+    data_path=None,
+):
+    """
+    Download .TAB data files from the PDS ftp server with `nsessions`
+    sessions in parallel, which are logged in once and reused.
+
+    data_path: local directory to save the files in (MCS_DATA_PATH by
+        default)
+
+    returns: list of the downloaded files
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if isinstance(prodids, str):
+        prodids = [prodids]
+    data_path = MCS_DATA_PATH if data_path is None else data_path
+
+    def get_one(prodid):
+        path = mcs_tab_path(prodid, dfindex, volume=True)
+        localpath = data_path + mcs_tab_path(prodid, dfindex, volume=False)
+        if (exists(localpath) or exists(localpath + ".gz")) and not overwrite:
+            print(f"File already exists: {prodid}")
+            return None
+        makedirs(dirname(localpath), exist_ok=True)
+        try:
+            pool.download(
+                server_path.rstrip("/") + "/" + path, localpath + ".gz"
+            )
+        except Exception as e:
+            print(f"Download failed {prodid}: {e}")
+            return None
+        print(f"Downloaded {prodid}")
+        return localpath
+
+    with FTPPool(host, nsessions, ftp_factory) as pool:
+        with ThreadPoolExecutor(nsessions) as ex:
+            res = list(ex.map(get_one, prodids))
+    return [fn for fn in res if fn is not None]
+
+
+def _partial_size(tmp):
+    """Number of bytes downloaded so far into the partial gzip file
+    `tmp`, or None if it's missing or nothing in it can be used. If the
+    last gzip member was cut off (the process was killed while it was
+    writing), the file is rewritten with the part that can be
+    decompressed."""
+    if not exists(tmp):
+        return None
+    size = 0
+    try:
+        with gzip.open(tmp, "rb") as fin:
+            while True:
+                chunk = fin.read(2**20)
+                if not chunk:
+                    return size
+                size += len(chunk)
+    except (EOFError, OSError, zlib.error):
+        pass
+    return _salvage_gzip(tmp) or None
+
+
+def _salvage_gzip(fname):
+    """Rewrite the damaged gzip file `fname` with the data that can be
+    decompressed from the start of it. Returns the number of bytes
+    kept."""
+    size = 0
+    with open(fname, "rb") as fin, gzip.open(fname + ".fix", "wb") as fout:
+        dec = zlib.decompressobj(31)
+        try:
+            for chunk in iter(lambda: fin.read(2**20), b""):
+                while chunk:
+                    out = dec.decompress(chunk)
+                    fout.write(out)
+                    size += len(out)
+                    chunk = b""
+                    if dec.eof:
+                        # the next gzip member
+                        chunk = dec.unused_data
+                        dec = zlib.decompressobj(31)
+            out = dec.flush()
+            fout.write(out)
+            size += len(out)
+        except zlib.error:
+            pass
+    replace(fname + ".fix", fname)
+    return size
+
+
+def _resume_offset(tmp):
+    """Where to resume downloading into the partial file `tmp`, which
+    is deleted if it can't be resumed."""
+    offset = _partial_size(tmp)
+    if offset is None and exists(tmp):
+        unlink(tmp)
+    return offset or 0
+
+
+def _resume_mode(offset, status, headers):
+    """File mode for the partial file given the response to a request
+    for bytes `offset`- : "ab" to append the rest, "wb" to start over,
+    or None if the partial file is already complete."""
+    if offset == 0:
+        return "wb"
+    if status == 206 and headers.get("content-range", "").startswith(
+        f"bytes {offset}-"
+    ):
+        return "ab"
+    if status == 416:
+        return None
+    return "wb"
+
+
+def download_http(url, local_filepath, session=None, chunk_size=2**16):
+    """
+    Download `url` into the gzip'ed file `local_filepath` without
+    holding the whole file in memory. The response is compressed in
+    chunks into "`local_filepath`.part", which is renamed into place
+    when it's complete. If a download is interrupted, the next call
+    resumes from the end of the partial file with an HTTP Range
+    request (appended as another gzip member) when the server supports
+    it, and starts over otherwise.
+    """
+    if session is None:
+        with Session() as session:
+            return download_http(url, local_filepath, session, chunk_size)
+    tmp = local_filepath + ".part"
+    offset = _resume_offset(tmp)
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with session.get(url, headers=headers, stream=True, timeout=60) as r:
+        hdrs = {k.lower(): v for k, v in r.headers.items()}
+        mode = _resume_mode(offset, r.status_code, hdrs)
+        if mode is not None:
+            if r.status_code not in (200, 206):
+                r.raise_for_status()
+            with gzip.open(tmp, mode) as fout:
+                for chunk in r.iter_content(chunk_size):
+                    fout.write(chunk)
+    replace(tmp, local_filepath)
+    return local_filepath
+
+
+def fetch_tab_file(prodid, dfindex, session=None, root_url=PDS_ROOT_URL):
+    """Download the .TAB file for `prodid` over HTTP and return its
+    bytes, without saving it. See `save_tab_file`."""
+    url = "http://" + root_url + mcs_tab_path(prodid, dfindex, volume=True)
+    if session is None:
+        with Session() as session:
+            return fetch_tab_file(prodid, dfindex, session, root_url)
+    r = session.get(url, timeout=60)
+    r.raise_for_status()
+    return r.content
+
+
+async def _async_fetch(pool, path):
+    """Async version of `fetch_tab_file`, using an AsyncHTTPPool."""
+    status, _, body = await pool.get(path)
+    if status != 200:
+        raise OSError(f"HTTP status {status} for {path}")
+    return body
+
+
+def save_tab_file(data, local_filepath):
+    """Save the bytes of a downloaded .TAB file gzip'ed to
+    `local_filepath`, through a partial file like `download_http`."""
+    makedirs(dirname(local_filepath), exist_ok=True)
+    tmp = local_filepath + ".part"
+    with gzip.open(tmp, "wb") as fout:
+        fout.write(data)
+    replace(tmp, local_filepath)
+    return local_filepath
+
+
+def get_tab_file_http(server_filepath, local_filepath, _pid="", session=None):
+    """Download the specified file using HTTP, see `download_http`."""
+    print(f"({_pid}) Downloading {server_filepath}...")
+    download_http(
+        "http://" + server_filepath, addext(local_filepath, ".gz"), session
+    )
+
+
+def get_tab_file_ftp(server_filepath, local_filepath, _pid="", pool=None):
+    """Download the specified file using FTP, with a session from the
+    FTPPool `pool` if it's given."""
+    print(f"({_pid}) Downloading {server_filepath}...")
+    if pool is None:
+        with FTPPool(size=1) as pool:
+            return pool.download(server_filepath, local_filepath)
+    return pool.download(server_filepath, local_filepath)
 
 
 def get_most_recent_index_ftp(local_filepath="DATA/CUMINDEX.TAB.gz"):
@@ -114,7 +718,289 @@ def get_most_recent_index_ftp(local_filepath="DATA/CUMINDEX.TAB.gz"):
 def get_most_recent_index_http(local_filepath="CUMINDEX.TAB.gz"):
     """Assume this is the most recent file since it's difficult to search
     with HTTP. """
-    r = get(PDS_ROOT_URL + _most_recent_known_mrom + "/INDEX/CUMINDEX.TAB")
-    r.raise_for_status()
-    with gzip.open(MCS_DATA_PATH + "CUMINDEX.TAB.gz", "w") as fout:
-        fout.write(r.content)
+    download_http(
+        "http://"
+        + PDS_ROOT_URL
+        + _most_recent_known_mrom
+        + "/INDEX/CUMINDEX.TAB",
+        addext(local_filepath, ".gz"),
+    )
+
+
+def _fake_pds_server(nfiles=20, volume="MROM_2001"):
+    """Start a local HTTP/1.1 server in a thread, serving a temporary
+    directory with a fake PDS tree of `nfiles` TAB files. Returns
+    (server, root_url, dfindex, {prodid: file contents}, tmpdir).
+    Call server.shutdown() and tmpdir.cleanup() when done."""
+    import io
+    import time
+    import threading
+    import tempfile
+    import pandas as pd
+    from functools import partial
+    from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+    tmpdir = tempfile.TemporaryDirectory()
+    root = tmpdir.name + "/pds"
+    rows, contents = [], {}
+    for ii in range(nfiles):
+        prodid = f"200701{ii // 24 + 1:02d}{ii % 24:02d}_DDR.TAB"
+        path = f"2007/200701/{prodid[:8]}"
+        contents[prodid] = f"{prodid}\n".encode() * (100 + 37 * ii)
+        makedirs(f"{root}/{volume}/DATA/{path}", exist_ok=True)
+        with open(f"{root}/{volume}/DATA/{path}/{prodid}", "wb") as fout:
+            fout.write(contents[prodid])
+        rows.append((prodid, path, prodid, volume))
+    dfindex = pd.DataFrame(
+        rows, columns=["prodid", "path", "filename", "volume_id"]
+    ).set_index("prodid")
+
+    class Trickle(object):
+        def __init__(self, fin):
+            self.fin = fin
+
+        def read(self, size=-1):
+            time.sleep(0.05)
+            return self.fin.read(256)
+
+        def close(self):
+            self.fin.close()
+
+    class Handler(SimpleHTTPRequestHandler):
+        # HTTP/1.1 so connections are kept alive between requests
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_head(self):
+            # "/moved/..." redirects to "/...", and "/slow/..." sends
+            # "/..." in small pieces with a pause before each one
+            if self.path.startswith("/moved/"):
+                self.send_response(302)
+                self.send_header("Location", self.path[len("/moved"):])
+                self.send_header("Content-Length", "5")
+                self.end_headers()
+                return io.BytesIO(b"moved")
+            if self.path.startswith("/slow/"):
+                self.path = self.path[len("/slow"):]
+                fin = super().send_head()
+                return fin and Trickle(fin)
+            # minimal support for "Range: bytes=N-" requests
+            rng = self.headers.get("Range", "")
+            if not rng.startswith("bytes="):
+                return super().send_head()
+            fname = self.translate_path(self.path)
+            if not exists(fname):
+                return super().send_head()
+            with open(fname, "rb") as fin:
+                data = fin.read()
+            start = int(rng[len("bytes="):].split("-")[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}"
+            )
+            self.send_header("Content-Length", str(len(data) - start))
+            self.end_headers()
+            return io.BytesIO(data[start:])
+
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(Handler, directory=root)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    root_url = f"127.0.0.1:{server.server_address[1]}/"
+    return server, root_url, dfindex, contents, tmpdir
+
+
+def _test_async_download(nfiles=50, concurrency=4):
+    """Download files from a local fake PDS server with
+    `async_get_tab_files` and check their contents and that the
+    connections were reused."""
+    server, root_url, dfindex, contents, tmpdir = _fake_pds_server(nfiles)
+    try:
+        data_path = tmpdir.name + "/mcsdata/"
+
+        host, port = server.server_address
+
+        async def run():
+            async with AsyncHTTPPool(host, port, size=concurrency) as pool:
+                files = await async_get_tab_files(
+                    list(dfindex.index),
+                    dfindex,
+                    root_url=root_url,
+                    data_path=data_path,
+                    pool=pool,
+                )
+            return files, pool.nconnect
+
+        files, nconnect = asyncio.run(run())
+        # every request after the first few reused a connection
+        assert nconnect <= concurrency, nconnect
+        assert len(files) == nfiles, files
+        for prodid, data in contents.items():
+            fname = data_path + mcs_tab_path(prodid, dfindex) + ".gz"
+            with gzip.open(fname, "rb") as fin:
+                assert fin.read() == data, prodid
+        # a second run finds the files and doesn't download them again
+        assert asyncio.run(run())[0] == []
+    finally:
+        server.shutdown()
+        server.server_close()
+        tmpdir.cleanup()
+    return True
+
+
+def _test_redirect_timeout(nfiles=4):
+    """Check that AsyncHTTPPool follows redirects, and that its timeout
+    is for each read and not the whole download."""
+    server, root_url, dfindex, contents, tmpdir = _fake_pds_server(nfiles)
+    try:
+        host, port = server.server_address
+        paths = {
+            prodid: "/" + mcs_tab_path(prodid, dfindex, volume=True)
+            for prodid in dfindex.index
+        }
+
+        async def run():
+            async with AsyncHTTPPool(host, port, size=2, timeout=0.2) as pool:
+                for prodid, path in paths.items():
+                    body = await _async_fetch(pool, "/moved" + path)
+                    assert body == contents[prodid], prodid
+                # about 0.5 s for the whole file, 0.05 s for each piece
+                prodid = dfindex.index[0]
+                body = await _async_fetch(pool, "/slow" + paths[prodid])
+                assert body == contents[prodid], prodid
+            return pool.nconnect
+
+        # the redirects were followed on the pool's connections
+        assert asyncio.run(run()) <= 2
+    finally:
+        server.shutdown()
+        server.server_close()
+        tmpdir.cleanup()
+    return True
+
+
+def _test_resume_download(nfiles=4):
+    """Interrupt downloads from a local fake PDS server halfway and
+    check that `download_http` and `async_get_tab_files` resume them
+    with Range requests. Every other partial file is cut off in the
+    middle of its gzip stream, like after a kill -9."""
+    server, root_url, dfindex, contents, tmpdir = _fake_pds_server(nfiles)
+    try:
+        data_path = tmpdir.name + "/mcsdata/"
+        prodids = list(dfindex.index)
+        for ii, prodid in enumerate(prodids):
+            # a partial file with the first half of the data
+            fname = data_path + mcs_tab_path(prodid, dfindex) + ".gz"
+            makedirs(dirname(fname), exist_ok=True)
+            part = gzip.compress(
+                contents[prodid][: len(contents[prodid]) // 2]
+            )
+            if ii % 2:
+                part = part[: len(part) * 2 // 3]
+            with open(fname + ".part", "wb") as fout:
+                fout.write(part)
+        half = len(prodids) // 2
+        for prodid in prodids[:half]:
+            download_http(
+                f"http://{root_url}"
+                + mcs_tab_path(prodid, dfindex, volume=True),
+                data_path + mcs_tab_path(prodid, dfindex) + ".gz",
+            )
+        asyncio.run(
+            async_get_tab_files(
+                prodids[half:], dfindex, root_url=root_url, data_path=data_path
+            )
+        )
+        for prodid in prodids:
+            fname = data_path + mcs_tab_path(prodid, dfindex) + ".gz"
+            assert not exists(fname + ".part"), prodid
+            with gzip.open(fname, "rb") as fin:
+                assert fin.read() == contents[prodid], prodid
+            # the resumed part was appended as a second gzip member, so
+            # even the cut off files weren't downloaded again from 0
+            with open(fname, "rb") as fin:
+                assert fin.read().count(b"\x1f\x8b\x08") >= 2, prodid
+    finally:
+        server.shutdown()
+        server.server_close()
+        tmpdir.cleanup()
+    return True
+
+
+def _fake_ftp_factory(root):
+    """A stand-in for `ftplib.FTP` that serves files under the local
+    directory `root`, and a list of the sessions it opened."""
+    sessions = []
+
+    class FakeFTP(object):
+        def __init__(self, host, user=None, passwd=None, timeout=None):
+            assert user and passwd
+            self.lock = threading.Lock()
+            self.nretr = 0
+            sessions.append(self)
+
+        def retrbinary(self, cmd, callback, blocksize=8192, rest=None):
+            # one transfer at a time, like a real control connection
+            assert self.lock.acquire(blocking=False), "session in use"
+            try:
+                verb, path = cmd.split(" ", 1)
+                assert verb == "RETR"
+                with open(root + path, "rb") as fin:
+                    fin.seek(rest or 0)
+                    for block in iter(lambda: fin.read(blocksize), b""):
+                        callback(block)
+                self.nretr += 1
+            finally:
+                self.lock.release()
+            return "226 Transfer complete"
+
+        def quit(self):
+            return "221 Goodbye"
+
+        def close(self):
+            pass
+
+    return FakeFTP, sessions
+
+
+def _test_ftp_pool(nfiles=20, nsessions=4):
+    """Download a fake PDS tree through `get_tab_files_ftp` with a fake
+    FTP server and check that a few logged in sessions are reused for
+    all of the files, and that a partial download is resumed."""
+    server, root_url, dfindex, contents, tmpdir = _fake_pds_server(nfiles)
+    server.shutdown()
+    server.server_close()
+    try:
+        data_path = tmpdir.name + "/mcsdata/"
+        prodids = list(dfindex.index)
+        fname = data_path + mcs_tab_path(prodids[0], dfindex) + ".gz"
+        makedirs(dirname(fname), exist_ok=True)
+        with gzip.open(fname + ".part", "wb") as fout:
+            fout.write(contents[prodids[0]][:50])
+        factory, sessions = _fake_ftp_factory(tmpdir.name + "/pds")
+        downloaded = get_tab_files_ftp(
+            prodids,
+            dfindex,
+            nsessions=nsessions,
+            ftp_factory=factory,
+            server_path="/",
+            data_path=data_path,
+        )
+        assert len(downloaded) == nfiles
+        assert 1 <= len(sessions) <= nsessions, len(sessions)
+        assert sum(ss.nretr for ss in sessions) == nfiles
+        for prodid in prodids:
+            fname = data_path + mcs_tab_path(prodid, dfindex) + ".gz"
+            assert not exists(fname + ".part"), prodid
+            with gzip.open(fname, "rb") as fin:
+                assert fin.read() == contents[prodid], prodid
+    finally:
+        tmpdir.cleanup()
+    return True
@@ -0,0 +1,150 @@
+__package__ = "mcspy"
+
+import numpy as np
+
+__all__ = [
+    "prodid_to_prodidint",
+    "profid_to_profidint",
+    "rowid_to_rowidint",
+    "prodidint_to_prodid",
+    "profidint_to_profid",
+    "rowidint_to_rowid",
+    "make_profidint",
+    "make_rowidint",
+    "profile_rowidint",
+    "profidint_to_prodidint",
+    "profidint_to_profnum",
+    "rowidint_to_profidint",
+    "rowidint_to_levnum",
+    "profidint_to_year",
+    "rowidint_to_year",
+]
+
+__doc__ = """
+Integer and string versions of product, profile, and row ID's.
+
+prodid: the name of the TAB file, "YYYYMMDDHH_DDR.TAB"
+profid: prodid and the number of the profile in the file,
+    "YYYYMMDDHH_DDR.TAB:N"
+rowid: profid and the number of the pressure level (1-105),
+    "YYYYMMDDHH_DDR.TAB:N:L"
+
+The integer versions are calculated arithmetically,
+    prodidint = YYYYMMDDHH
+    profidint = prodidint * 10000 + N
+    rowidint = profidint * 1000 + L
+so sorting by the integer ID's sorts by date, profile, and level. The
+string versions are only needed for display and for the profid column
+saved with the metadata index, and they are formatted from the
+integers for whole arrays at once.
+"""
+
+# multipliers to allow up to 9999 profiles per file and 999 levels
+# per profile
+PROF_MULT = 10000
+ROW_MULT = 1000
+# number of pressure levels in each profile
+NLEV = 105
+PRODID_SUFFIX = "_DDR.TAB"
+
+
+def _strarray(x):
+    """Return a numpy unicode array from a string, list of strings, or
+    pandas Series/Index of strings."""
+    if hasattr(x, "to_numpy"):
+        x = x.to_numpy(dtype=str)
+    return np.asarray(x, dtype=str)
+
+
+def prodid_to_prodidint(prodids):
+    """Integer version of the product ID(s) `prodids`, YYYYMMDDHH."""
+    # casting to a 10 character string truncates to the date
+    return _strarray(prodids).astype("U10").astype(np.int64)
+
+
+def profid_to_profidint(profids):
+    """Integer version of the profile ID(s) `profids`."""
+    profids = _strarray(profids)
+    profnum = np.char.rpartition(profids, ":")[..., 2]
+    return make_profidint(
+        prodid_to_prodidint(profids), profnum.astype(np.int64)
+    )
+
+
+def rowid_to_rowidint(rowids):
+    """Integer version of the row ID(s) `rowids`."""
+    parts = np.char.rpartition(_strarray(rowids), ":")
+    return make_rowidint(
+        profid_to_profidint(parts[..., 0]), parts[..., 2].astype(np.int64)
+    )
+
+
+def make_profidint(prodidint, profnum):
+    """Profile ID integer(s) from product ID integer(s) and the profile
+    number(s) `profnum` in the TAB file."""
+    return np.asarray(prodidint, dtype=np.int64) * PROF_MULT + np.asarray(
+        profnum, dtype=np.int64
+    )
+
+
+def make_rowidint(profidint, levnum):
+    """Row ID integer(s) from profile ID integer(s) and the pressure
+    level number(s) `levnum`, 1-105."""
+    return np.asarray(profidint, dtype=np.int64) * ROW_MULT + np.asarray(
+        levnum, dtype=np.int64
+    )
+
+
+def profile_rowidint(profidint, nlev=NLEV):
+    """Row ID integers for every level of each profile in `profidint`.
+    Returns an array with shape (len(profidint), nlev)."""
+    profidint = np.asarray(profidint, dtype=np.int64).reshape((-1, 1))
+    return make_rowidint(profidint, np.arange(1, nlev + 1))
+
+
+def profidint_to_prodidint(profidint):
+    return np.asarray(profidint) // PROF_MULT
+
+
+def profidint_to_profnum(profidint):
+    return np.asarray(profidint) % PROF_MULT
+
+
+def rowidint_to_profidint(rowidint):
+    return np.asarray(rowidint) // ROW_MULT
+
+
+def rowidint_to_levnum(rowidint):
+    return np.asarray(rowidint) % ROW_MULT
+
+
+def profidint_to_year(profidint):
+    """Earth year of the data file for each profile ID integer."""
+    return profidint_to_prodidint(profidint) // 1000000
+
+
+def rowidint_to_year(rowidint):
+    """Earth year of the data file for each row ID integer."""
+    return profidint_to_year(rowidint_to_profidint(rowidint))
+
+
+def prodidint_to_prodid(prodidint):
+    """Product ID strings from product ID integers."""
+    return np.char.add(np.asarray(prodidint).astype(str), PRODID_SUFFIX)
+
+
+def profidint_to_profid(profidint):
+    """Profile ID strings from profile ID integers."""
+    prodid = prodidint_to_prodid(profidint_to_prodidint(profidint))
+    return np.char.add(
+        np.char.add(prodid, ":"),
+        profidint_to_profnum(profidint).astype(str),
+    )
+
+
+def rowidint_to_rowid(rowidint):
+    """Row ID strings from row ID integers."""
+    profid = profidint_to_profid(rowidint_to_profidint(rowidint))
+    return np.char.add(
+        np.char.add(profid, ":"), rowidint_to_levnum(rowidint).astype(str)
+    )
@@ -1,6 +1,6 @@
 __package__ = "mcspy"
 import gzip as _gzip
-from os import makedirs as _makedirs
+from os import makedirs as _makedirs, stat as _stat
 from os.path import exists as _exists, dirname as _dirname
 from pathlib import Path as _Path
 import numpy as np
@@ -9,17 +9,32 @@ from .loaders import (
     load_mix_var,
     load_prof_var,
     load_mix_dframe,
+    load_mix_vars,
+    prof_var_path,
+    prof_var_shape,
+    summary_path,
+    zone_map_path,
 )
-from .util import local_data_path, addext
-from .defs import mix_cols, prof_cols, MCS_DATA_PATH
+from .util import local_data_path, addext, allyearsdec, calc_time_vars
+from .ids import rowidint_to_year, rowidint_to_profidint
+from .ids import prodid_to_prodidint, profidint_to_prodidint
+from .defs import mix_cols, prof_cols, mix_derived_cols, MCS_DATA_PATH
+from .defs import summary_cols, summary_groups, zone_cols, zone_block_size
 
 __all__ = [
     "collect_yearly_vars",
     "find_missing_tab_files",
     "import_downloaded_files",
+    "import_tab_files",
+    "finish_import",
+    "drop_products",
     "check_index_profiles",
     "sort_prof_data",
     "sort_mix_data",
+    "drop_rowidint_file",
+    "backfill_time_vars",
+    "save_summaries",
+    "save_zone_maps",
 ]
 _others = [
     "save_prof_var",
@@ -117,13 +132,27 @@ def save_mix_dframe(mix, save_path=None):
     print(f"saved {fname}, {mix.shape}")
 
 
-def save_prof_df(dfprof):
-    year = dfprof["profid"].str.slice(None, 4).iloc[0]
-    for vv in prof_cols:
+def save_prof_df(dfprof, implicit_rowid=False):
+    """Save the columns of the profile DataFrame `dfprof` to the
+    profile data files. With `implicit_rowid`, the rowidint column is
+    not saved, see `_append_prof_df`."""
+    year = rowidint_to_year(dfprof["rowidint"].iloc[0])
+    for vv in _stored_prof_cols(implicit_rowid):
         if vv in dfprof:
             save_prof_var(dfprof[vv].to_numpy(), year, vv)
 
 
+def _stored_prof_cols(implicit_rowid):
+    """The profile variables that are written to disk."""
+    if implicit_rowid:
+        return [vv for vv in prof_cols if vv != "rowidint"]
+    return prof_cols
+
+
+def _has_rowidint_file(year):
+    return _exists(prof_var_path(year, "rowidint"))
+
+
 def _append_prof_var(var, year, varname):
     """Append profile data passed in `var` for the variable `varname`
     and year `year` to a numpy array file. If the file does not exist,
@@ -180,13 +209,22 @@ def _append_mix_dfvars(df):
             _append_mix_var(mix[vv].to_numpy(), year, vv)
 
 
-def _append_prof_df(dfprof):
+def _append_prof_df(dfprof, implicit_rowid=False):
     """Append the data from columns in the profile DataFrame `dfprof`
-    to the respective data files."""
+    to the respective data files.
+    implicit_rowid: don't write the rowidint profile array. Row ID's
+    are then calculated from the metadata variable profidint when they
+    are loaded. For a year that already has profile data, the storage
+    mode of the existing files is used so they keep the same length."""
     if len(dfprof) == 0:
         return
-    year = dfprof["profid"].str.slice(None, 4).iloc[0]
-    for vv in prof_cols:
+    year = rowidint_to_year(dfprof["rowidint"].iloc[0])
+    # keep using the storage mode of an existing year
+    if _exists(prof_var_path(year, "temperature")):
+        if implicit_rowid != (not _has_rowidint_file(year)):
+            implicit_rowid = not implicit_rowid
+            print(f"using implicit_rowid={implicit_rowid} like {year}")
+    for vv in _stored_prof_cols(implicit_rowid):
         if vv in dfprof:
             _append_prof_var(dfprof[vv].to_numpy(), year, vv)
 
@@ -246,29 +284,37 @@ def _get_missing_prodids(year):
 def check_index_profiles(year, raise_for_false=True):
     """
     Check index and profile ID variables for consistency. Make sure sizes and
-    values match.
+    values match. If the year has no rowidint file, the row ID's are
+    implied by profidint, so only the number of stored profiles is checked.
     """
     err = None
     msg = ""
     profids = load_mix_var(str(year), "profidint")
-    rowids = load_prof_var(str(year), "rowidint")
-    if profids.shape[0] != rowids.shape[0]:
+    if _has_rowidint_file(year):
+        rowids = load_prof_var(str(year), "rowidint")
+        nprof = rowids.shape[0]
+    else:
+        rowids = None
+        nprof = np.prod(prof_var_shape(year, "temperature")) // 105
+    if profids.shape[0] != nprof:
         msg = "Index and profile sizes do not match."
         err = IndexError
-    lx = profids == (rowids[:, 0] / 1e3).astype(int)
-    if not lx.all():
-        msg = "Profile ID's and row ID's are inconsistent."
-        err = ValueError
+    elif rowids is not None:
+        lx = profids == rowidint_to_profidint(rowids[:, 0])
+        if not lx.all():
+            msg = "Profile ID's and row ID's are inconsistent."
+            err = ValueError
     if not (np.sort(profids) == profids).all():
         msg = "Profile ID's are not sorted."
         err = AssertionError
-    if not (np.sort(rowids) == rowids).all():
+    if rowids is not None and not (np.sort(rowids) == rowids).all():
         msg = "Row ID's are not sorted."
         err = AssertionError
     if err is None:
         return True
     if raise_for_false:
         raise (err(msg))
+    return False
 
 
 def _get_new_prodids(year):
@@ -284,40 +330,117 @@ def _get_new_prodids(year):
     return file_prodids[~file_prodids.isin(imported_prodids)]
 
 
-def import_downloaded_files(year):
-    new_prodids = _get_new_prodids(year)
+def import_downloaded_files(year, implicit_rowid=False):
+    """Parse any TAB files for `year` that haven't been imported yet
+    and append them to the yearly data files.
+    implicit_rowid: don't store the rowidint profile array, see
+    `_append_prof_df`."""
+    return import_tab_files(
+        year, _get_new_prodids(year), implicit_rowid=implicit_rowid
+    )
+
+
+def import_tab_files(year, prodids, dfindex=None, implicit_rowid=False):
+    """Parse the downloaded TAB files for the product ID's `prodids`
+    (strings or integers) from `year` and append them to the yearly
+    data files, then sort the data and update the summary tables and
+    zone maps. The products must not have been imported already, see
+    `drop_products`."""
+    new_prodids = pd.Series(prodid_to_prodidint(prodids), dtype="int64")
     ymms = (new_prodids // 1000).unique()
     for ym in ymms:
         pids = new_prodids[new_prodids // 1000 == ym].astype(str) + "_DDR.TAB"
-        dfm, dfp = _load_tab_files_int(pids.tolist())
+        dfm, dfp = _load_tab_files_int(pids.tolist(), dfindex)
         if len(dfm) == 0 and len(dfp) == 0:
             continue
         if len(dfm) != len(dfp) // 105:
             raise ValueError("Index and profile data shapes don't match.")
         _append_mix_dframe(dfm)
-        _append_prof_df(dfp)
-    print("Sorting index data...")
-    sort_mix_data(year)
+        _append_prof_df(dfp, implicit_rowid=implicit_rowid)
+    return finish_import(year)
+
+
+def finish_import(year):
+    """Sort the data for `year` after new files have been appended,
+    check it, and update the summary tables and zone maps."""
+    # sort the profiles first, without a rowidint file their order is
+    # found from the unsorted metadata index
     print("Sorting profile data...")
     sort_prof_data(year)
+    print("Sorting index data...")
+    if not sort_mix_data(year):
+        save_summaries(years=[year])
+        save_zone_maps(years=[year])
     return check_index_profiles(year)
 
 
+def drop_products(year, prodids):
+    """Delete the profiles from the product ID's `prodids` (strings or
+    integers) from the stored data for `year`, so new versions of the
+    TAB files can be imported with `import_tab_files`. Returns the
+    number of profiles that were deleted."""
+    check_index_profiles(year)
+    mix = load_mix_dframe(year)
+    # the profile files are in the same (sorted) order as the index
+    keep = ~np.isin(
+        profidint_to_prodidint(mix["profidint"].to_numpy()),
+        prodid_to_prodidint(prodids),
+    )
+    ndrop = int((~keep).sum())
+    if ndrop == 0:
+        return 0
+    if not keep.any():
+        raise ValueError(
+            f"Can't delete every profile from {year}, delete its data "
+            + "directory instead."
+        )
+    mix = mix.loc[keep]
+    save_mix_dframe(mix)
+    for vv in mix_cols:
+        if vv in mix:
+            save_mix_var(mix[vv].to_numpy(), year, vv)
+    for vv in prof_cols:
+        if _exists(prof_var_path(year, vv)):
+            save_prof_var(load_prof_var(year, vv)[keep], year, vv)
+    save_summaries(years=[year])
+    save_zone_maps(years=[year])
+    return ndrop
+
+
 def sort_mix_data(year):
+    """Sort the metadata index for `year` by profile ID. When it has to
+    be rewritten, the summary tables and zone maps are saved again.
+    Returns True if it was rewritten."""
     _mix = load_mix_dframe(year)
     mix = _mix.sort_values("profidint")
     if (_mix.values == mix.values).all():
-        return
+        return False
     save_mix_dframe(mix)
     for vv in mix_cols:
         if vv in mix:
             save_mix_var(mix[vv], year, vv)
+    save_summaries(years=[year])
+    save_zone_maps(years=[year])
+    return True
 
 
 def sort_prof_data(year):
-    rowidint = load_prof_var(year, "rowidint")
-    ix = np.argsort(rowidint.flatten()).reshape(-1, 105)
-    save_prof_var(rowidint.flatten()[ix], year, "rowidint")
+    """Sort the profile data files for `year` by row ID. The profiles
+    are reordered as whole rows, so the levels in each profile keep
+    their order. Without a rowidint file, the profiles are assumed to
+    be stored in the same order as the metadata index, so this must
+    be run before `sort_mix_data`."""
+    if _has_rowidint_file(year):
+        rowidint = load_prof_var(year, "rowidint")
+        profidint = rowidint_to_profidint(rowidint[:, 0])
+    else:
+        rowidint = None
+        profidint = load_mix_var(year, "profidint")
+    ix = np.argsort(profidint, kind="stable")
+    if (ix == np.arange(ix.size)).all():
+        return
+    if rowidint is not None:
+        save_prof_var(rowidint[ix], year, "rowidint")
     for vv in prof_cols:
         if vv == "rowidint":
             continue
@@ -325,8 +448,129 @@ def sort_prof_data(year):
             var = load_prof_var(year, vv)
         except FileNotFoundError:
             continue
-        prof = var.flatten()[ix]
-        save_prof_var(prof, year, vv)
+        save_prof_var(var[ix], year, vv)
+
+
+def drop_rowidint_file(year):
+    """Convert an imported year to implicit row ID storage by deleting
+    its rowidint profile file, after checking that the row ID's in it
+    are the ones implied by the profidint metadata variable. Row ID's
+    can still be loaded with `load_prof_var(year, "rowidint")`."""
+    from os import unlink
+    from .loaders import load_rowidint
+
+    if not _has_rowidint_file(year):
+        return
+    check_index_profiles(year)
+    rowidint = load_prof_var(year, "rowidint")
+    if not (rowidint == load_rowidint(year)).all():
+        raise ValueError(f"Row ID's for {year} are not implied by profidint.")
+    unlink(prof_var_path(year, "rowidint"))
+    print(f"deleted {prof_var_path(year, 'rowidint')}")
+
+
+@allyearsdec
+def backfill_time_vars(years=None, overwrite=False):
+    """Calculate and save the derived time variables in
+    `defs.mix_derived_cols` (Ls2, msol, MYfrac) for years that were
+    imported before they were added to the metadata index. Years that
+    already have them are skipped unless `overwrite` is True."""
+    for year in years:
+        fn = local_data_path(f"DATA/{year}/indexdata/{year}_mixvars.npz")
+        if not _exists(fn):
+            continue
+        with np.load(fn) as fin:
+            if not overwrite and all(vv in fin for vv in mix_derived_cols):
+                print(f"{year} already has {mix_derived_cols}")
+                continue
+        mix = load_mix_dframe(year)
+        tvars = calc_time_vars(mix["Ls"], mix["MY"], datetime=mix["datetime"])
+        for vv in mix_derived_cols:
+            mix[vv] = tvars[vv].astype("float32")
+        save_mix_dframe(mix)
+        for vv in mix_derived_cols:
+            save_mix_var(mix[vv].to_numpy(), year, vv)
+        save_zone_maps(years=[year])
+
+
+@allyearsdec
+def save_summaries(years=None):
+    """Save the per-orbit and per-sol summary tables for `years`, with
+    the number of profiles, the first and last profile time, and the
+    mean of each variable in `defs.summary_cols` for each orbit and
+    each mission sol. They are small enough to load for the whole
+    mission with `load_summary_years`. Years that haven't been
+    imported are skipped."""
+    for year in years:
+        fn = local_data_path(f"DATA/{year}/indexdata/{year}_mixvars.npz")
+        if not _exists(fn):
+            continue
+        mix = pd.DataFrame(
+            load_mix_vars(
+                year,
+                ["datetime", "orb_num", "msol"] + summary_cols,
+                quiet=True,
+                output_tuple=False,
+            )
+        )
+        mix["sol"] = np.floor(mix["msol"])
+        for name, col in summary_groups.items():
+            grp = mix.groupby(col)
+            summ = grp[summary_cols].mean()
+            summ.insert(0, "nprof", grp.size())
+            summ.insert(1, "datetime_start", grp["datetime"].min())
+            summ.insert(2, "datetime_end", grp["datetime"].max())
+            fname = summary_path(year, name)
+            _makedirs(_dirname(fname), exist_ok=True)
+            np.savez_compressed(
+                fname,
+                **{col: summ.index.to_numpy()},
+                **{k: summ[k].to_numpy() for k in summ.columns},
+            )
+            print(f"wrote {fname}")
+
+
+@allyearsdec
+def save_zone_maps(years=None, block=zone_block_size):
+    """Save the zone maps for `years`: the min and max of each variable
+    in `defs.zone_cols` for each block of `block` profiles, in the
+    order they are stored. Loaders and queries use them to skip
+    blocks that can't match a range (see `loaders.zone_blocks`). This
+    must be run again whenever the metadata index is rewritten, which
+    the importer functions do, otherwise `loaders.load_zone_map`
+    ignores the out of date zone map."""
+    for year in years:
+        fn = local_data_path(f"DATA/{year}/indexdata/{year}_mixvars.npz")
+        if not _exists(fn):
+            continue
+        mix = load_mix_vars(year, zone_cols, quiet=True, output_tuple=False)
+        nprof = len(mix[zone_cols[0]])
+        starts = np.arange(0, nprof, block)
+        # the modification time of the metadata index the zone map was
+        # made from, so load_zone_map can tell when it's out of date
+        arrays = {
+            "block": block,
+            "nprof": nprof,
+            "mix_mtime": _stat(fn).st_mtime_ns,
+        }
+        for vn in zone_cols:
+            var = np.asarray(mix[vn])
+            if var.dtype.kind == "M":
+                var = var.astype("datetime64[ns]").astype(np.int64)
+            if var.dtype.kind == "f":
+                # reduceat doesn't skip nans, so use +-inf for them
+                arrays[f"{vn}_min"] = np.minimum.reduceat(
+                    np.where(np.isnan(var), np.inf, var), starts
+                )
+                arrays[f"{vn}_max"] = np.maximum.reduceat(
+                    np.where(np.isnan(var), -np.inf, var), starts
+                )
+            else:
+                arrays[f"{vn}_min"] = np.minimum.reduceat(var, starts)
+                arrays[f"{vn}_max"] = np.maximum.reduceat(var, starts)
+        fname = zone_map_path(year)
+        np.savez(fname, **arrays)
+        print(f"wrote {fname}")
 
 
 def find_missing_tab_files(dfindex):
@@ -351,7 +595,7 @@ def find_missing_tab_files(dfindex):
     return missing_prodids
 
 
-def collect_yearly_vars(dfindex, MIX=True, PROF=True):
+def collect_yearly_vars(dfindex, MIX=True, PROF=True, implicit_rowid=False):
     """Read the MCS TAB data files and save the metadata and profile
     data to binary files to be easily read in the future.
 
@@ -367,6 +611,8 @@ def collect_yearly_vars(dfindex, MIX=True, PROF=True):
     Parameters
     ----------
     dfindex : DataFrame from the PDS index file loaded by `reload_index`.
+    implicit_rowid : don't store the rowidint profile array, see
+        `_append_prof_df`.
     """
     # read max 10 days at a time between saves
     # loading files gets slower as the dataframes increase in size
@@ -381,7 +627,11 @@ def collect_yearly_vars(dfindex, MIX=True, PROF=True):
         if MIX:
             _append_mix_dframe(dfmix)
         if PROF:
-            _append_prof_df(dfprof)
+            _append_prof_df(dfprof, implicit_rowid=implicit_rowid)
+    if MIX:
+        years = dfindex.start_time.dt.year.unique().tolist()
+        save_summaries(years=years)
+        save_zone_maps(years=years)
 
 
 def _load_tab_files_int(prodids, dfindex=None, MIX=True, PROF=True):
@@ -1,8 +1,10 @@
 __package__ = "mcspy"
 
-from os import makedirs
+from os import getpid, makedirs, replace, stat, unlink
 from os.path import exists
 import gzip
+import threading
+import numpy as np
 from .downloader import (
     get_most_recent_index_ftp,
     get_most_recent_index_http,
@@ -26,10 +28,15 @@ indexing = [
     "lxdfimg",
     "lxdfLsN",
     "reload_index",
+    "get_index",
     "qday",
     "qtempe",
     "qimg",
     "qmarci_mdgm",
+    "rday",
+    "rnight",
+    "rtempe",
+    "lxranges",
 ]
 
 
@@ -49,6 +56,15 @@ qgds_MY28 = "Ls > 269 & Ls < 300 & MY == 28"
 qgds_MY34 = "Ls > 185 & Ls < 250 & MY == 34"
 
 
+# RANGES
+# for lxranges and the `select` argument of binning.binned_stats and
+# binning.climatology, {variable: (min, max)} with inclusive limits,
+# None for no limit (see loaders.in_range)
+rday = {"solar_zen": (None, 90)}
+rnight = {"LST": (None, 0.4)}
+rtempe = {"lat": (43, 47.8), "lon": (-83.3, -70)}
+
+
 # VARIABLE-BASED INDEX FUNCTIONS
 # create logical indices based on one or more input variables
 
@@ -90,6 +106,35 @@ def lxmarci_mdgm(Ls2):
     return (Ls2 > 132.1) & (Ls2 < 832)
 
 
+def lxranges(year, ranges):
+    """
+    Logical index of the profiles in `year` with min <= value <= max
+    for every {variable: (min, max)} in `ranges`. The zone map for the
+    year is used to skip blocks of profiles that can't match, so only
+    the variables in `ranges` are loaded and they're only compared in
+    the remaining blocks.
+    """
+    from .loaders import load_mix_var, load_zone_map, zone_rows, in_range
+
+    zmap = load_zone_map(year)
+    lx = zone_rows(year, ranges, zmap)
+    if lx is not None and not lx.any():
+        return lx
+    ix = None if lx is None else np.flatnonzero(lx)
+    ok = True
+    for vn, (lo, hi) in ranges.items():
+        var = load_mix_var(year, vn, quiet=True)
+        if ix is not None:
+            var = var[ix]
+        ok = ok & in_range(var, lo, hi)
+        if lx is None:
+            lx = np.ones(len(var), dtype=bool)
+    if ix is None:
+        return lx & ok
+    lx[ix] = ok
+    return lx
+
+
 # MIX INDEXING FUNCTIONS
 # convenience functions for creating logical DataFrame indexes from
 # the metadata index DataFrame
@@ -131,13 +176,38 @@ def lxdfLsN(mix, Ls, N):
 
 # INDEX LOADER
 # to load the index of all data files and orbit numbers
-def reload_index(download=False, allow_download=True):
+# product_creation_time is kept as a string, it's only compared to
+# find reprocessed files
+_index_string_columns = [
+    "volume_id",
+    "path",
+    "filename",
+    "product_creation_time",
+]
+_index_time_columns = ["start_time", "stop_time"]
+_index_orbit_columns = ["start_orbit_number", "stop_orbit_number"]
+
+# the parsed index, loaded on first access of `dfindex`
+_dfindex = None
+# whether `get_index` found no index file, so it isn't looked for (and
+# reported missing) again until `reload_index` is called
+_index_missing = False
+
+
+def reload_index(download=False, allow_download=True, use_cache=True):
     """Load the cumulative index file that lists every TAB data
-    file in the PDS archive """
+    file in the PDS archive.
+    use_cache: read the parsed index from the binary sidecar file
+    CUMINDEX.TAB.gz.npz when it matches the size and modification
+    time of CUMINDEX.TAB.gz, and write the sidecar when it doesn't.
+    """
+    global _index_missing
+    _index_missing = False
     dftypes = {
         "volume_id": "string",
         "path": "string",
         "filename": "string",
+        "product_creation_time": "string",
         "start_orbit_number": "int64",
         "stop_orbit_number": "int64",
     }
@@ -145,7 +215,7 @@ def reload_index(download=False, allow_download=True):
     if not exists(MCS_DATA_PATH + "DATA/CUMINDEX.TAB.gz") or download:
         if exists(MCS_DATA_PATH + "DATA/CUMINDEX.TAB") and not download:
             # if uncompressed version, compress it
-            with open(MCS_DATA_PATH + "DATA/CUMINDEX.TAB", "r") as fin:
+            with open(MCS_DATA_PATH + "DATA/CUMINDEX.TAB", "rb") as fin:
                 with gzip.open(
                     MCS_DATA_PATH + "DATA/CUMINDEX.TAB.gz", "w"
                 ) as fout:
@@ -167,30 +237,116 @@ def reload_index(download=False, allow_download=True):
                 get_most_recent_index_http(
                     MCS_DATA_PATH + "DATA/CUMINDEX.TAB.gz"
                 )
+    fname = MCS_DATA_PATH + "DATA/CUMINDEX.TAB.gz"
+    if use_cache:
+        dfindex = _read_index_cache(fname)
+        if dfindex is not None:
+            return dfindex
     # read index file into pandas DataFrame
     dfindex = pd.read_csv(
-        MCS_DATA_PATH + "DATA/CUMINDEX.TAB.gz",
+        fname,
         header=None,
         dtype=dftypes,
-        parse_dates=["start_time", "stop_time"],
         names=index_columns,
-        infer_datetime_format=True,
         usecols=_index_keep_columns,
     ).rename_axis(index="mcsnum")
     # make start and stop times datetimes
-    for cn in ["start_time", "stop_time"]:
-        dfindex[cn] = pd.to_datetime(dfindex[cn])
+    for cn in _index_time_columns:
+        dfindex[cn] = pd.to_datetime(dfindex[cn]).astype("datetime64[ns]")
     # downcast integers
-    for cn in ["start_orbit_number", "stop_orbit_number"]:
+    for cn in _index_orbit_columns:
         dfindex[cn] = pd.to_numeric(dfindex[cn], downcast="unsigned")
     # make string columns pd.StringDtype
-    for cn in ["volume_id", "path", "filename"]:
+    for cn in _index_string_columns:
         dfindex[cn] = dfindex[cn].astype("string")
     # set filename, what I call Product ID, to be the index
     dfindex = dfindex.set_index("filename", drop=False).rename_axis(
         index="prodid"
     )
+    if use_cache:
+        _write_index_cache(fname, dfindex)
     return dfindex
 
 
-dfindex = reload_index(allow_download=False)
+def _index_cache_key(fname):
+    """Size and modification time (ns) of the index file, used to
+    decide whether the binary sidecar is still valid."""
+    st = stat(fname)
+    return np.array([st.st_size, st.st_mtime_ns], dtype="int64")
+
+
+def _read_index_cache(fname):
+    """Load the parsed index from the sidecar file `fname`.npz.
+    Returns None if the sidecar is missing, unreadable, or was made
+    from a different version of `fname`."""
+    cname = fname + ".npz"
+    if not exists(cname):
+        return None
+    try:
+        with np.load(cname, allow_pickle=False) as fin:
+            if not (fin["_key"] == _index_cache_key(fname)).all():
+                return None
+            dfindex = pd.DataFrame(
+                {cn: fin[cn] for cn in _index_keep_columns}
+            )
+    except Exception:
+        return None
+    for cn in _index_time_columns:
+        dfindex[cn] = dfindex[cn].astype("datetime64[ns]")
+    for cn in _index_string_columns:
+        dfindex[cn] = dfindex[cn].astype("string")
+    dfindex = dfindex.rename_axis(index="mcsnum")
+    return dfindex.set_index("filename", drop=False).rename_axis(
+        index="prodid"
+    )
+
+
+def _write_index_cache(fname, dfindex):
+    """Save the parsed index columns next to `fname` as an
+    uncompressed .npz file, keyed on the size and modification time
+    of `fname`. Failing to write the cache is not an error."""
+    cname = fname + ".npz"
+    cols = {}
+    for cn in _index_keep_columns:
+        if cn in _index_string_columns:
+            cols[cn] = dfindex[cn].to_numpy(dtype=str)
+        elif cn in _index_time_columns:
+            cols[cn] = dfindex[cn].to_numpy(dtype="datetime64[ns]")
+        else:
+            cols[cn] = dfindex[cn].to_numpy()
+    # write to a temporary file so that readers never see a partially
+    # written cache, with a name of its own in case several processes
+    # (or threads) write the cache at once
+    tmp = f"{cname}.{getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "wb") as fout:
+            np.savez(fout, _key=_index_cache_key(fname), **cols)
+        replace(tmp, cname)
+    except OSError:
+        if exists(tmp):
+            unlink(tmp)
+
+
+def get_index(reload=False):
+    """Return the cumulative index DataFrame, loading it the first
+    time it is needed. This is what `dfindex` refers to."""
+    global _dfindex, _index_missing
+    if _dfindex is None and _index_missing and not reload:
+        return pd.DataFrame()
+    if _dfindex is None or reload:
+        dfindex = reload_index(allow_download=False)
+        if len(dfindex) == 0:
+            # don't hold on to an empty index, the file might be
+            # downloaded later with reload_index
+            _index_missing = True
+            return dfindex
+        _dfindex = dfindex
+    return _dfindex
+
+
+def __getattr__(name):
+    # load dfindex lazily so that importing mcspy doesn't parse
+    # CUMINDEX.TAB
+    if name == "dfindex":
+        return get_index()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,12 +1,15 @@
 __package__ = "mcspy"
 
-from os.path import basename
+import os
+from os.path import basename, exists
 import gzip
 import numpy as np
 import pandas as pd
 import mcspy.util as util
 from .util import addext, rowidint_to_rowid
-from .defs import MCS_DATA_PATH
+from . import ids
+from .defs import MCS_DATA_PATH, mix_derived_cols, summary_groups
+from .defs import zone_cols
 
 __all__ = [
     "load_mix_dframe",
@@ -15,8 +18,20 @@ __all__ = [
     "load_mix_var_years",
     "load_prof_var",
     "load_prof_var_years",
+    "load_rowidint",
+    "iter_prof_var",
+    "iter_prof_vars",
+    "calc_var_path",
     "load_calc_var",
+    "iter_calc_var",
     "load_calc_var_years",
+    "summary_path",
+    "zone_map_path",
+    "load_zone_map",
+    "zone_blocks",
+    "zone_rows",
+    "load_summary",
+    "load_summary_years",
     "load_H2Oice",
     "load_H2Oice_err",
     "load_H2Ovap",
@@ -101,6 +116,8 @@ def load_mix_var(year, varname, mixfile_path=None, OLDMIX=False, quiet=False):
                 print("Loading from {fname}")
                 var = fin[varname]
         except KeyError:
+            if varname in mix_derived_cols:
+                return _calc_derived_mix_var(year, varname, quiet=quiet)
             print("Can't load mix archive, falling back to .npy file")
             var = load_mix_var(year, varname, True)
 
@@ -130,7 +147,13 @@ def load_mix_vars(
             fname = MCS_DATA_PATH + f"DATA/{year}/indexdata/{year}_mixvars.npz"
             with np.load(fname, allow_pickle=False) as fin:
                 for name in varnames:
+                    if name in mix_derived_cols and name not in fin:
+                        vars[name] = None
+                        continue
                     vars[name] = fin[name]
+            for name in varnames:
+                if vars[name] is None:
+                    vars[name] = _calc_derived_mix_var(year, name, quiet)
         except KeyError as e:
             print(e)
             return
@@ -148,6 +171,16 @@ def load_mix_vars(
     return vars
 
 
+def _calc_derived_mix_var(year, varname, quiet=False):
+    """Calculate one of the derived time variables in
+    `defs.mix_derived_cols` for a year that was imported before they
+    were saved. Use `importer.backfill_time_vars` to save them."""
+    if not quiet:
+        print(f"{varname} is not saved for {year}, calculating it...")
+    Ls, MY, dt = load_mix_vars(year, ["Ls", "MY", "datetime"], quiet=quiet)
+    return util.calc_time_vars(Ls, MY, datetime=dt)[varname]
+
+
 def load_prof_dframe(year):
     """
     Loads the profile data from `year` and returns a DataFrame.
@@ -156,6 +189,8 @@ def load_prof_dframe(year):
 
     fname = MCS_DATA_PATH + f"DATA/{year}/profdata/{year}_*_profiles.npy"
     varnames = [basename(x)[5:-13] for x in glob(fname)]
+    if "rowidint" not in varnames:
+        varnames.append("rowidint")
     df = pd.DataFrame()
     for vn in varnames:
         df[vn] = load_prof_var(year, vn).flatten()
@@ -196,13 +231,15 @@ def load_prof_var(year, varname, quiet=False):
     """Reads the profile data variable `varname` from `year` from
     the numpy array file "{year}/profdata/{year}_{varname}_profiles.npy"
     and returns a single 2-D array. If `varname` == "pressure", the
-    returned array is shape (105,1)."""
+    returned array is shape (105,1). If `varname` == "rowidint" and
+    the year was imported without a rowidint file, the row ID's are
+    calculated from the "profidint" metadata variable."""
     # handle pressure separately
     if varname == "pressure" or "varname" == "prs":
         return 610 * np.exp(-0.125 * (np.arange(105) - 9)).reshape((1, 105))
-    fname = (
-        MCS_DATA_PATH + f"DATA/{year}/profdata/{year}_{varname}_profiles.npy"
-    )
+    fname = prof_var_path(year, varname)
+    if varname == "rowidint" and not exists(fname):
+        return load_rowidint(year, quiet=quiet)
     # load data
     with gzip.open(fname, "rb") as fout:
         var = np.load(fout).reshape((-1, 105))
@@ -211,25 +248,142 @@ def load_prof_var(year, varname, quiet=False):
     return var
 
 
+def prof_var_path(year, varname):
+    """Path of the numpy array file for profile variable `varname`."""
+    return (
+        MCS_DATA_PATH + f"DATA/{year}/profdata/{year}_{varname}_profiles.npy"
+    )
+
+
+def prof_var_shape(year, varname):
+    """Shape of the array stored for the profile variable `varname`
+    in `year`, read from the file header without loading the data."""
+    with gzip.open(prof_var_path(year, varname), "rb") as fin:
+        shape, _, _ = _read_npy_header(fin)
+    return shape
+
+
+def _read_npy_header(fin):
+    """Read the header of a .npy file from the open file `fin`.
+    Returns (shape, fortran_order, dtype) and leaves `fin` at the
+    start of the data."""
+    version = np.lib.format.read_magic(fin)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(fin)
+    return np.lib.format.read_array_header_2_0(fin)
+
+
+def load_rowidint(year, quiet=False):
+    """Calculate the row ID integers for `year` from the profile ID
+    integers in the metadata index. This gives the same array that is
+    stored in the rowidint file, which is optional since its values
+    are determined by profidint and the level number."""
+    profidint = load_mix_var(year, "profidint", quiet=quiet)
+    return ids.profile_rowidint(profidint)
+
+
+def _iter_npy_rows(fname, chunksize=4096, rows=None):
+    """Read the 2-D array in the gzipped .npy file `fname` in chunks
+    of `chunksize` rows. 1-D arrays are read as rows of 105 values.
+    Chunks without any of the `rows` (a boolean array) are skipped
+    over, and yielded as None."""
+    with gzip.open(fname, "rb") as fin:
+        shape, _, dtype = _read_npy_header(fin)
+        ncol = shape[1] if len(shape) == 2 else 105
+        nrow = int(np.prod(shape)) // ncol
+        if rows is not None and len(rows) != nrow:
+            raise IndexError(f"{fname} doesn't have {len(rows)} rows.")
+        for ix in range(0, nrow, chunksize):
+            nn = min(chunksize, nrow - ix)
+            if rows is not None and not rows[ix:ix+nn].any():
+                fin.seek(nn * ncol * dtype.itemsize, 1)
+                yield None
+                continue
+            buf = bytearray(nn * ncol * dtype.itemsize)
+            fin.readinto(buf)
+            yield np.frombuffer(buf, dtype=dtype).reshape((nn, ncol))
+
+
+def iter_prof_var(year, varname, chunksize=4096, quiet=True, rows=None):
+    """Read the profile data variable `varname` from `year` in chunks
+    of `chunksize` profiles, without loading the whole file. Yields
+    2-D arrays of shape (<= chunksize, 105). If `rows` is given (a
+    boolean array with one value per profile), chunks without any of
+    those profiles aren't read and are yielded as None."""
+    fname = prof_var_path(year, varname)
+    if varname == "rowidint" and not exists(fname):
+        profidint = load_mix_var(year, "profidint", quiet=quiet)
+        for ix in range(0, len(profidint), chunksize):
+            if rows is not None and not rows[ix:ix+chunksize].any():
+                yield None
+                continue
+            yield ids.profile_rowidint(profidint[ix:ix+chunksize])
+        return
+    yield from _iter_npy_rows(fname, chunksize, rows)
+    if not quiet:
+        print(f"read {fname}")
+
+
+def iter_prof_vars(year, varnames, chunksize=4096, quiet=True, rows=None):
+    """Read several profile data variables from `year` in chunks of
+    `chunksize` profiles. Yields dicts of 2-D arrays, or None for the
+    chunks skipped because of `rows` (see `iter_prof_var`)."""
+    iters = [
+        iter_prof_var(year, vn, chunksize, quiet, rows) for vn in varnames
+    ]
+    for chunks in zip(*iters):
+        if chunks[0] is None:
+            yield None
+            continue
+        yield dict(zip(varnames, chunks))
+
+
+def calc_var_path(year, varname):
+    """Path of the numpy array file for calculated variable `varname`."""
+    return (
+        MCS_DATA_PATH + f"DATA/{year}/calcdata/{year}_{varname}_profiles.npy"
+    )
+
+
 def load_calc_var(year, varname, quiet=False):
     """Reads the calculated profile variable `varname` from `year` from the
     numpy array file "{year}/calcdata/{year}_{varname}_profiles.npy" and
     returns a single 2-D array. If `varname` == "pressure", the returned array
-    is shape (105,1)."""
+    is shape (105,1). Variables in the `mcspy.derived` registry are
+    calculated and saved first if the file doesn't exist or its inputs
+    have changed."""
     # handle pressure separately
     if varname == "pressure" or "varname" == "prs":
         return 610 * np.exp(-0.125 * (np.arange(105) - 9)).reshape((1, 105))
-    fname = (
-        MCS_DATA_PATH + f"DATA/{year}/calcdata/{year}_{varname}_profiles.npy"
-    )
+    from . import derived
+
+    if varname in derived.calc_vars:
+        derived.update_calc_var(year, varname, quiet=quiet)
+    fname = calc_var_path(year, varname)
     # load data
     with gzip.open(fname, "rb") as fout:
-        var = np.load(fout).reshape((-1, 105))
+        var = np.load(fout)
+    # regridded variables can have a different number of levels
+    if var.ndim != 2:
+        var = var.reshape((-1, 105))
     if not quiet:
         print(f"loaded {fname}")
     return var
 
 
+def iter_calc_var(year, varname, chunksize=4096, quiet=True):
+    """Read the calculated variable `varname` from `year` in chunks of
+    `chunksize` profiles. Yields 2-D arrays."""
+    from . import derived
+
+    if varname in derived.calc_vars:
+        derived.update_calc_var(year, varname, quiet=quiet)
+    fname = calc_var_path(year, varname)
+    yield from _iter_npy_rows(fname, chunksize)
+    if not quiet:
+        print(f"read {fname}")
+
+
 @util.allyearsdec
 def load_prof_var_years(years=None, varname="temperature", quiet=False):
     """Reads the profile data variable `varname` from `years`
@@ -266,6 +420,141 @@ def load_calc_var_years(years=None, varname="temperature", quiet=False):
     return np.concatenate(dat, axis=0)
 
 
+def summary_path(year, name="orbit"):
+    """Path of the "orbit" or "sol" summary table for `year`."""
+    return MCS_DATA_PATH + f"DATA/{year}/summary/{year}_{name}_summary.npz"
+
+
+def load_summary(year, name="orbit", quiet=False):
+    """Load the per-orbit ("orbit") or per-sol ("sol") summary table for
+    `year` as a DataFrame, indexed by orbit number or mission sol, with
+    the number of profiles, the first and last profile time, and the
+    mean of the variables in `defs.summary_cols`. Saved by
+    `importer.save_summaries`."""
+    fname = summary_path(year, name)
+    with np.load(fname, allow_pickle=False) as fin:
+        summ = pd.DataFrame({k: fin[k] for k in fin.files})
+    if not quiet:
+        print(f"loaded {fname}")
+    return summ.set_index(summary_groups[name])
+
+
+@util.allyearsdec
+def load_summary_years(years=None, name="orbit", quiet=False):
+    """Load the summary tables for `years` as one DataFrame. Years
+    without a summary table are skipped. Orbits that span the end of
+    a year appear in both years' tables."""
+    summs = []
+    for yy in years:
+        if exists(summary_path(yy, name)):
+            summs.append(load_summary(yy, name, quiet))
+    return pd.concat(summs)
+
+
+def zone_map_path(year):
+    """Path of the zone map (per-block min/max) file for `year`."""
+    return MCS_DATA_PATH + f"DATA/{year}/indexdata/{year}_zonemap.npz"
+
+
+def _mix_nprof(fname):
+    """Number of profiles in the metadata index file `fname`, read from
+    the header of its profidint array."""
+    with np.load(fname, allow_pickle=False) as fin:
+        with fin.zip.open("profidint.npy") as fmember:
+            return _read_npy_header(fmember)[0][0]
+
+
+def load_zone_map(year):
+    """Load the zone map for `year`, a dict with the block size
+    "block", the number of profiles "nprof", and (min, max) arrays
+    with one value per block for each variable in `defs.zone_cols`.
+    Returns None if the year doesn't have a zone map, or if the zone
+    map is out of date because the metadata index was changed after
+    it was saved, so callers fall back to reading everything."""
+    fname = zone_map_path(year)
+    mixname = MCS_DATA_PATH + f"DATA/{year}/indexdata/{year}_mixvars.npz"
+    if not (exists(fname) and exists(mixname)):
+        return None
+    with np.load(fname, allow_pickle=False) as fin:
+        if "mix_mtime" in fin:
+            if int(fin["mix_mtime"]) != os.stat(mixname).st_mtime_ns:
+                return None
+        zmap = {"block": int(fin["block"]), "nprof": int(fin["nprof"])}
+        for vn in zone_cols:
+            if f"{vn}_min" in fin:
+                zmap[vn] = (fin[f"{vn}_min"], fin[f"{vn}_max"])
+    if zmap["nprof"] != _mix_nprof(mixname):
+        return None
+    return zmap
+
+
+def _zone_value(varname, value):
+    """Convert a range limit to the units stored in the zone map."""
+    if varname == "datetime" and value is not None:
+        return np.datetime64(value, "ns").astype(np.int64)
+    return value
+
+
+def in_range(var, lo, hi):
+    """Boolean array, True where lo <= var <= hi. Either limit can be
+    None for no limit, and limits for datetime arrays can be anything
+    np.datetime64 accepts. This is the range convention of `lxranges`,
+    `zone_blocks`, and the `select` argument of `binned_stats`."""
+    var = np.asarray(var)
+    if var.dtype.kind == "M":
+        lo = None if lo is None else np.datetime64(lo)
+        hi = None if hi is None else np.datetime64(hi)
+    ok = np.ones(var.shape, dtype=bool)
+    with np.errstate(invalid="ignore"):
+        if lo is not None:
+            ok &= var >= lo
+        if hi is not None:
+            ok &= var <= hi
+    return ok
+
+
+def zone_blocks(year, ranges, zmap=None):
+    """
+    Which blocks of profiles in `year` might have values in `ranges`,
+    a dict of {variable: (min, max)} where either limit can be None.
+    Limits are inclusive, and variables without a zone map are
+    ignored, so a block that is False definitely has no matching
+    profiles but a block that is True might not have any either.
+    Returns a boolean array with one value per block, or None if the
+    year doesn't have a zone map.
+    """
+    if zmap is None:
+        zmap = load_zone_map(year)
+    if zmap is None:
+        return None
+    nblock = -(-zmap["nprof"] // zmap["block"])
+    ok = np.ones(nblock, dtype=bool)
+    for vn, (lo, hi) in ranges.items():
+        if vn not in zmap:
+            continue
+        vmin, vmax = zmap[vn]
+        lo, hi = _zone_value(vn, lo), _zone_value(vn, hi)
+        # blocks that are all nan have limits of +-inf and never match
+        with np.errstate(invalid="ignore"):
+            if lo is not None:
+                ok &= vmax >= lo
+            if hi is not None:
+                ok &= vmin <= hi
+    return ok
+
+
+def zone_rows(year, ranges, zmap=None):
+    """Boolean array with one value per profile in `year`, True for
+    the profiles in blocks that `zone_blocks` can't rule out. Returns
+    None if the year doesn't have a zone map."""
+    if zmap is None:
+        zmap = load_zone_map(year)
+    ok = zone_blocks(year, ranges, zmap)
+    if ok is None:
+        return None
+    return np.repeat(ok, zmap["block"])[: zmap["nprof"]]
+
+
 # convenience functions to load several variables
 load_temperature = load_prof_var_years
 load_temperature_err = lambda: load_prof_var_years(varname="T_err")  # noqa
@@ -283,4 +572,4 @@ load_MY = lambda: load_mix_var_years(varname="MY")  # noqa
 load_LST = lambda: load_mix_var_years(varname="LST")  # noqa
 load_lat = lambda: load_mix_var_years(varname="lat")  # noqa
 load_lon = lambda: load_mix_var_years(varname="lon")  # noqa
-load_Ls2 = lambda: load_Ls() + 360 * (load_MY() - 28)  # noqa
+load_Ls2 = lambda: load_mix_var_years(varname="Ls2")  # noqa
@@ -1,6 +1,7 @@
 from datetime import datetime
 import numpy as np
 import pandas as pd
+from . import backend
 
 try:
     from astropy.time import Time
@@ -9,7 +10,14 @@ try:
 except Exception:
     _useastropy = False
 
-__all__ = ["myls2utc", "utc2myls"]
+__all__ = [
+    "myls2utc",
+    "utc2myls",
+    "utc2mysol",
+    "datetime2jd",
+    "jd2datetime64",
+    "ymdhms2datetime64",
+]
 
 __doc__ = """
 Adapted from JavaScript version by Aymeric Spiga(?)
@@ -25,18 +33,32 @@ With the fix turned on (_FIX=True), the discrepency is down to
 RMS < 0.00071 degrees when running myls2utc(utc2myls(x)). This was
 optimized by adjusting the parameters below. Use of astropy has
 negligible impact on the discrepency.
+
+Arrays of datetime64 values are converted to Julian dates with numpy
+(`datetime2jd`) whether or not astropy is installed. This agrees with
+astropy to within 1e-9 days except on days with a leap second.
+With _LS_TABLE=True, jd2myls interpolates Ls from a table
+(`sol2ls_interp`) that is within 1e-5 degrees (about 2e-7 in
+practice) of solving Kepler's equation with `sol2ls`.
 """
 
 _FIX = True
+# use a lookup table for sol -> Ls in jd2myls
+_LS_TABLE = True
 _off2j = -0.099773362  # -0.03837437*2.6
 _off2myls = -0.065236429  # -0.03837437*1.7
 _perifix = 0.003
 
 
-def myls2utc(MY, Ls):
+def myls2utc(MY, Ls, datetime64=True):
+    """Convert Mars Year `MY` and solar longitude `Ls` to UTC.
+    Returns a datetime64[ns] array, or with `datetime64`=False, the
+    output of `jd2utc` (year, month, day, hour, minute, second)."""
     # 1. Get julian date
     jdate = myls2jd(MY, Ls)
     # 2. Convert to Earth Gregorian date
+    if datetime64:
+        return jd2datetime64(jdate)
     return jd2utc(jdate, scale="utc")
 
 
@@ -45,6 +67,12 @@ def utc2myls(time, scale="utc"):
     return jd2myls(jdate)
 
 
+def utc2mysol(time, scale="utc"):
+    """Mars Year and sol of the Mars Year for the UTC time(s) `time`."""
+    jdate = utc2jd(time, scale)
+    return jd2mysol(jdate)
+
+
 def sol2ls(sol):
     year_day = 668.6  # number of sols in a martian year
     peri_day = 485.35  # perihelion date
@@ -63,21 +91,16 @@ def sol2ls(sol):
 
     # Solve Kepler equation zx0 - e *sin(zx0) = xref
     # Using Newton iterations
-    zx0 = xref + e_ellip * np.sin(xref)
     if isscalar(sol):
+        zx0 = xref + e_ellip * np.sin(xref)
         while np.abs(zdx) >= 1e-9:
             zdx = -(zx0 - e_ellip * np.sin(zx0) - xref) / (
                 1.0 - e_ellip * np.cos(zx0)
             )
             zx0 = zx0 + zdx
     else:
-        lx = np.abs(zdx) >= 1e-9
-        while np.any(lx):
-            zdx = -(zx0 - e_ellip * np.sin(zx0) - xref) / (
-                1.0 - e_ellip * np.cos(zx0)
-            )
-            zx0 = zx0 + zdx
-            lx = np.abs(zdx) >= 1e-9
+        # numpy or numba version, see mcspy.backend
+        zx0 = backend.kepler_newton(xref, e_ellip, 1e-9)
     lx = zanom < 0
     if np.any(lx):
         zx0 = np.where(lx, -zx0, zx0)
@@ -102,10 +125,77 @@ def sol2ls(sol):
     return Ls
 
 
+# sol -> Ls lookup table for one Mars year, made the first time it's used
+_ls_table = None
+# number of intervals in the table
+_ls_table_size = 2 ** 14
+# maximum allowed interpolation error in degrees, well below the
+# 0.00071 degree RMS discrepency of the conversions (see __doc__)
+_ls_table_tol = 1e-5
+
+
+def _make_ls_table(n=_ls_table_size):
+    """Tabulate Ls on `n`+1 evenly spaced sols over one Mars year.
+    Ls is unwrapped so it increases from Ls(0) to Ls(0) + 360 and can
+    be linearly interpolated. Returns the sol spacing, the table, and
+    the bound on the interpolation error in degrees."""
+    year_day = 668.6
+    sols = np.linspace(0, year_day, n + 1)
+    Ls = np.rad2deg(np.unwrap(np.deg2rad(sol2ls(sols))))
+    h = sols[1] - sols[0]
+    # error of linear interpolation is at most h**2/8 * max|Ls''|
+    err = np.abs(np.diff(Ls, 2)).max() / 8
+    # and check the error at the midpoints against the exact values
+    mid = sols[:-1] + h / 2
+    exact = np.rad2deg(np.unwrap(np.deg2rad(sol2ls(mid))))
+    exact = exact + 360 * np.round((Ls[0] - exact[0]) / 360)
+    err = max(err, np.abs((Ls[:-1] + Ls[1:]) / 2 - exact).max())
+    if err > _ls_table_tol:
+        raise ValueError(
+            f"Ls table error {err} is larger than {_ls_table_tol}."
+        )
+    return h, Ls, err
+
+
+def sol2ls_interp(sol):
+    """Fast version of `sol2ls` that interpolates a precomputed table
+    instead of solving Kepler's equation. The difference from `sol2ls`
+    is less than `_ls_table_tol` degrees (the bound is calculated when
+    the table is made and stored in `_ls_table[2]`)."""
+    global _ls_table
+    if _ls_table is None:
+        _ls_table = _make_ls_table()
+    h, table, _ = _ls_table
+    x = np.mod(sol, 668.6) / h
+    nan = np.isnan(x)
+    if np.any(nan):
+        x = np.where(nan, 0, x)
+    ix = np.minimum(np.asarray(x).astype(int), table.size - 2)
+    Ls = table[ix]
+    Ls = np.mod(Ls + (x - ix) * (table[ix + 1] - Ls), 360)
+    if np.any(nan):
+        Ls = np.where(nan, np.nan, Ls)
+    return Ls
+
+
 def utc2jd(time, scale="utc"):
     """
-    Only works with arrays if using astropy.
+    Julian date of `time`, where `scale` is the time scale of `time`
+    and of the returned Julian date. Arrays of datetimes (numpy
+    datetime64, pandas Series or DatetimeIndex) and tuples of
+    (year, month, day, hour, minute, second) arrays are converted with
+    `datetime2jd`, which doesn't need astropy. Other input, like
+    strings, uses astropy if it is available.
     """
+    if _isdatetime64(time) or (
+        isinstance(time, tuple) and not isscalar(time[0])
+    ):
+        if scale not in _tai_offsets:
+            raise ValueError(f"scale can be one of {list(_tai_offsets)}.")
+        if isinstance(time, tuple):
+            time = ymdhms2datetime64(*time)
+        return datetime2jd(time)
+
     if _useastropy:
         try:
             return Time(time, scale=scale).jd
@@ -157,13 +247,104 @@ def utc2jd(time, scale="utc"):
         d = {k: int(v) for k, v in d.items() if k != "microsecond"}
         time = datetime(**d)
 
-    jdate = pd.to_datetime(time).to_julian_date()
+    jdate = pd.to_datetime(time)
+    if isscalar(jdate):
+        return jdate.to_julian_date()
+    return datetime2jd(jdate)
+
+
+# Julian date of 1970-01-01T00:00:00, the datetime64 epoch
+_jd_epoch = 2440587.5
+_ns_per_day = 86400 * 10 ** 9
+# offsets from TAI to each time scale, in seconds (UTC uses leap seconds)
+_tai_offsets = {"utc": None, "tai": 0.0, "tt": 32.184}
+
 
+def datetime2jd(time, scale="utc"):
+    """
+    Vectorized conversion from UTC datetimes to Julian dates that
+    doesn't use astropy. `time` can be anything that numpy can convert
+    to datetime64[ns], including pandas Series and DatetimeIndex, and
+    NaT becomes nan.
+
+    scale: the time scale of the returned Julian dates, one of "utc",
+    "tai", or "tt". For "tai" and "tt" the leap seconds (TAI-UTC) from
+    `leapsec` are added, using 10 s for dates before 1972.
+
+    For UTC, the results match astropy's Time(time, scale="utc").jd to
+    within 1e-9 days (0.1 ms), except during days that end in a leap
+    second, which astropy stretches to 86401 s (difference < 1 s).
+    """
+    if scale not in _tai_offsets:
+        raise ValueError(f"scale can be one of {list(_tai_offsets)}.")
+    ns = np.asarray(time, dtype="datetime64[ns]")
+    nat = np.isnat(ns)
+    ns = ns.view("int64")
+    if scale != "utc":
+        ns = ns + (
+            (_tai_utc_ns(ns) + _tai_offsets[scale]) * 1e9
+        ).astype("int64")
+    # split days and fractions of days to keep precision
+    days, frac = np.divmod(ns, _ns_per_day)
+    jdate = (days + _jd_epoch) + frac / _ns_per_day
+    if nat.any():
+        jdate = np.where(nat, np.nan, jdate)
+    if jdate.ndim == 0:
+        return float(jdate)
     return jdate
 
 
-def jd2myls(jdate):
-    # Convert a Julian date to corresponding "sol" and "Ls"
+def jd2datetime64(jdate):
+    """
+    Vectorized conversion from UTC Julian dates to datetime64[ns],
+    the inverse of `datetime2jd`. nan becomes NaT. Float64 Julian
+    dates near the present have a resolution of about 40 microseconds,
+    so that is the precision of the result.
+    """
+    jdate = np.asarray(jdate, dtype=float) - _jd_epoch
+    nan = np.isnan(jdate)
+    if nan.any():
+        jdate = np.where(nan, 0, jdate)
+    # split days and fractions of days to keep precision
+    days = np.floor(jdate)
+    ns = days.astype("int64") * _ns_per_day + np.round(
+        (jdate - days) * _ns_per_day
+    ).astype("int64")
+    time = ns.view("datetime64[ns]")
+    if nan.any():
+        time = np.where(nan, np.datetime64("NaT"), time)
+    if time.ndim == 0:
+        return time[()]
+    return time
+
+
+def ymdhms2datetime64(year, month, day, hour=0, minute=0, second=0):
+    """Vectorized conversion of arrays of year, month, day, hour,
+    minute, and (fractional) second to datetime64[ns]."""
+    months = (
+        (np.asarray(year, dtype="int64") - 1970) * 12
+        + np.asarray(month, dtype="int64")
+        - 1
+    )
+    date = months.astype("datetime64[M]").astype("datetime64[ns]")
+    ns = (
+        (np.asarray(day, dtype="int64") - 1) * 86400.0
+        + np.asarray(hour) * 3600.0
+        + np.asarray(minute) * 60.0
+        + np.asarray(second)
+    ) * 1e9
+    return date + np.round(ns).astype("timedelta64[ns]")
+
+
+def _isdatetime64(time):
+    """Whether `time` is an array or pandas object of datetimes."""
+    dtype = getattr(time, "dtype", None)
+    return dtype is not None and np.dtype(dtype).kind == "M"
+
+
+def jd2mysol(jdate):
+    """Convert a Julian date to the corresponding Mars Year and the
+    sol of that Mars Year (sols since Ls = 0)."""
     jdate_ref = 2.442765667e6  # 19/12/1975 4:00:00, such that Ls=0
     # jdate_ref is also the begining of Martian Year "12"
     MY_ref = 12
@@ -228,32 +409,28 @@ def jd2myls(jdate):
 
     sol = (jdate - jdate_ref) * earthday / marsday
 
-    MY = MY_ref
     # Compute Martian Year #, along with sol value
     # sol being computed modulo the number of sols in a martian year
-    if isscalar(jdate):
-        while sol >= marsyear:
-            sol = sol - marsyear
-            MY = MY + 1
-        while sol < 0.0:
-            sol = sol + marsyear
-            MY = MY - 1
-    else:
-        lx = sol >= marsyear
-        while np.any(lx):  # sol >= marsyear:
-            sol = np.where(lx, sol - marsyear, sol)
-            MY = np.where(lx, MY + 1, MY)
-            lx = sol >= marsyear
-        lx = sol < 0.0
-        while np.any(lx):  # sol < 0.0:
-            sol = np.where(lx, sol + marsyear, sol)
-            MY = np.where(lx, MY - 1, MY)
-            lx = sol < 0.0
+    nyear = np.floor(sol / marsyear)
+    sol = sol - nyear * marsyear
+    MY = MY_ref + nyear
+    if not np.isnan(MY).any():
+        MY = MY.astype(int)
+
+    return MY, sol
+
+
+def jd2myls(jdate):
+    # Convert a Julian date to corresponding "sol" and "Ls"
+    MY, sol = jd2mysol(jdate)
 
     # convert sol number to Ls
     # sols_per_MY = 668.6 # number of sols in a martian year
     # Ls = sol/sols_per_MY*360
-    Ls = sol2ls(sol)
+    if _LS_TABLE:
+        Ls = sol2ls_interp(sol)
+    else:
+        Ls = sol2ls(sol)
 
     return MY, Ls
 
@@ -358,13 +535,8 @@ def jd2utc(jdate, scale="utc"):
     month = imp
     day = ij
 
-    try:
-        from logging import warning
-
-        warning("Values for hour, minute, and second are untested.")
-    except Exception:
-        pass
-    # experimental, untested
+    # hour, minute, and second are checked against jd2datetime64 by
+    # _test_myls2utc
     rr = (jdate - ijj) * 24 + 12
     hour = np.floor(rr)
     mm = (rr - hour) * 60
@@ -379,14 +551,8 @@ def _test_myls_utc(nt=500, plot=True, seed=None):
     tests = np.stack(
         (np.random.randint(0, 45, nt), np.random.random(nt) * 360), axis=0,
     )
-    if _useastropy:
-        utc = myls2utc(*tests)
-        results = np.array(utc2myls(utc))
-    else:
-        utc = myls2utc(*tests)
-        results = np.array(
-            [utc2myls(j) for j in np.transpose(utc)]
-        ).transpose()
+    utc = myls2utc(*tests)
+    results = np.array(utc2myls(utc))
     diffs = myls2ls(results - tests)
     diffs[diffs > 5] = diffs[diffs > 5] - 360
     diffs[diffs < -5] = 360 + diffs[diffs < -5]
@@ -408,6 +574,57 @@ def _test_myls_utc(nt=500, plot=True, seed=None):
     return tests, utc, diffs, results
 
 
+def _test_myls2utc(nt=1000000, seed=None):
+    """
+    Compare the datetime64 output of myls2utc with the older
+    year/month/day/hour/minute/second output of jd2utc, and with
+    astropy if it's available, for `nt` random MY and Ls values.
+    Raises AssertionError if any time differs by more than 1 ms (for
+    astropy, excluding days that end with a leap second).
+    Returns the maximum differences in seconds and the run times.
+    """
+    from time import perf_counter
+
+    global _useastropy
+    rng = np.random.default_rng(seed)
+    MY = rng.integers(24, 40, nt)
+    Ls = rng.random(nt) * 360
+    res = {}
+
+    t0 = perf_counter()
+    utc = myls2utc(MY, Ls)
+    res["time_datetime64"] = perf_counter() - t0
+
+    # jd2utc without astropy
+    useastropy = _useastropy
+    _useastropy = False
+    try:
+        t0 = perf_counter()
+        ymdhms = myls2utc(MY, Ls, datetime64=False)
+        res["time_ymdhms"] = perf_counter() - t0
+    finally:
+        _useastropy = useastropy
+    diff = (utc - ymdhms2datetime64(*ymdhms)) / np.timedelta64(1, "s")
+    res["maxdiff_ymdhms"] = np.abs(diff).max()
+
+    if _useastropy:
+        t0 = perf_counter()
+        autc = Time(myls2jd(MY, Ls), format="jd", scale="utc")
+        autc = autc.to_value("datetime64")
+        res["time_astropy"] = perf_counter() - t0
+        diff = (utc - autc) / np.timedelta64(1, "s")
+        # astropy has 86401 s in days that end with a leap second
+        day = utc.astype("datetime64[D]").astype("datetime64[ns]")
+        day = day.view("int64")
+        leap = _tai_utc_ns(day) != _tai_utc_ns(day + _ns_per_day)
+        res["maxdiff_astropy"] = np.abs(diff[~leap]).max()
+
+    for k, v in res.items():
+        if k.startswith("maxdiff") and v > 1e-3:
+            raise AssertionError(f"{k} is {v} s")
+    return res
+
+
 def isscalar(x):
     return not hasattr(x, "__len__")
 
@@ -426,70 +643,128 @@ def _tovec(*args):
     return tuple(args)
 
 
-def load_leapsec(date=None, index="date"):
-    import io
-
-    def format_lstable(lines):
-        import re
-
-        lls = []
-        for ll in lines:
-            try:
-                ll = ll.strip()
-                lls.append(
-                    re.sub(
-                        r"(\d+)\s+(\d+)\s+(\d{4})",
-                        lambda x: "{}-{}-{}".format(*x.groups()),
-                        ll,
-                    )
-                )
-            except Exception:
-                lls.append(ll)
-        return "\n".join(lls)
-
-    def check_expired(lines, date):
-        try:
-            for ll in lines:
-                if "expire" in ll:
-                    break
-            ix = ll.index("on") + 3
-            texp = pd.to_datetime(ll[ix:])
-            if texp < datetime.now() or texp < date:
-                import requests
-
-                lsurl = (
-                    "https://hpiers.obspm.fr/iers/bul/bulc/"
-                    + "Leap_Second.dat"
-                )
-                print(
-                    "Leapsecond table is outdated, attempting to "
-                    + "fetch new table..."
-                )
-                print(lsurl)
-                req = requests.get(lsurl)
-                lines = req.text.split("\n")
-        except Exception as e:
-            print("Error: " + str(e))
-        return lines
+# LEAP SECONDS
+# The leap second table is parsed once per process, from the file
+# saved by update_leapsec if there is one, otherwise from the copy in
+# `leapsec` below. The network is only used by update_leapsec.
+_leapsec_url = "https://hpiers.obspm.fr/iers/bul/bulc/Leap_Second.dat"
+_leapsec_file = "Leap_Second.dat"
+# (dates of each change in ns since 1970, TAI-UTC in s, expiry date)
+_leapsec_table = None
+_leapsec_warned = False
+
+
+def _parse_leapsec(text):
+    """Parse the text of a Leap_Second.dat file. Returns an int64 array
+    with the dates (ns since 1970) TAI-UTC changed, the values of
+    TAI-UTC in seconds, starting with 10 s before the first date, and
+    the expiration date of the table as a datetime64."""
+    # the data rows in the IERS file are indented
+    rows = [
+        ll.split() for ll in text.split("\n") if ll.strip()[:1].isdigit()
+    ]
+    dates = ymdhms2datetime64(
+        [r[3] for r in rows], [r[2] for r in rows], [r[1] for r in rows]
+    )
+    # TAI-UTC was 10 s at the start of 1972
+    offsets = np.concatenate(([10.0], [float(r[4]) for r in rows]))
+    expires = np.datetime64("NaT")
+    for ll in text.split("\n"):
+        if "expire" in ll:
+            ix = ll.index(" on ") + 4
+            expires = np.datetime64(pd.to_datetime(ll[ix:].strip()))
+            break
+    return dates.view("int64"), offsets, expires
+
+
+def leapsec_table(reload=False):
+    """Return the leap second table (dates, tai_utc, expires), parsing
+    it the first time it's needed. See `_parse_leapsec`."""
+    global _leapsec_table
+    if _leapsec_table is None or reload:
+        from os.path import exists
+        from .defs import MCS_DATA_PATH
+
+        text = leapsec
+        fname = MCS_DATA_PATH + _leapsec_file
+        if exists(fname):
+            with open(fname, "r") as fin:
+                text = fin.read()
+        _leapsec_table = _parse_leapsec(text)
+    return _leapsec_table
+
+
+def update_leapsec(url=_leapsec_url, save=True, timeout=30):
+    """Download the current leap second table from `url`, use it for
+    the rest of the session, and with `save`, save it to
+    MCS_DATA_PATH/Leap_Second.dat so it is used from now on.
+    This is the only function that fetches the table from the network.
+    """
+    global _leapsec_table
+    import requests
+
+    print(f"Fetching leap second table from {url}...")
+    req = requests.get(url, timeout=timeout)
+    req.raise_for_status()
+    table = _parse_leapsec(req.text)
+    if len(table[0]) == 0:
+        raise ValueError(f"No leap seconds found in {url}.")
+    if save:
+        from .defs import MCS_DATA_PATH
+
+        with open(MCS_DATA_PATH + _leapsec_file, "w") as fout:
+            fout.write(req.text)
+    _leapsec_table = table
+    return table
+
+
+def _tai_utc_ns(ns):
+    """TAI-UTC in seconds for UTC times `ns`, in nanoseconds since
+    1970."""
+    global _leapsec_warned
+    dates, offsets, expires = leapsec_table()
+    if not _leapsec_warned and not np.isnat(expires):
+        latest = np.max(ns, initial=np.iinfo("int64").min)
+        if latest > expires.astype("datetime64[ns]").view("int64"):
+            from warnings import warn
+
+            warn(
+                f"The leap second table expired on {expires}, "
+                + "use update_leapsec() to download a new one."
+            )
+            _leapsec_warned = True
+    return offsets[np.searchsorted(dates, ns, side="right")]
 
+
+def tai_utc(time):
+    """TAI-UTC in seconds for the UTC datetimes in `time` (anything
+    numpy can convert to datetime64[ns]), looked up for the whole array
+    at once. 10 s is used for dates before 1972."""
+    ns = np.asarray(time, dtype="datetime64[ns]")
+    return _tai_utc_ns(ns.view("int64"))
+
+
+def load_leapsec(date=None, index="date", allow_download=False):
+    """Return the leap second table as a DataFrame with columns MJD,
+    date, and tai_utc, indexed by `index` and forward filled at
+    `date` (default is now). The table is only downloaded if it
+    has expired and `allow_download` is True."""
     if date is None:
         date = datetime.now()
-    else:
-        date = pd.to_datetime(date)
-    lines = check_expired(leapsec.split("\n"), date)
-    lines = format_lstable(lines)
-    buf = io.StringIO(lines)
-    df = pd.read_table(
-        buf,
-        skiprows=14,
-        header=None,
-        names=["MJD", "date", "tai_utc"],
-        sep=r"\s+",
-        infer_datetime_format=True,
+    dates, offsets, expires = leapsec_table()
+    if allow_download and not np.isnat(expires):
+        if expires < np.datetime64(datetime.now()) or expires < np.max(
+            np.asarray(pd.to_datetime(date), dtype="datetime64[ns]")
+        ):
+            dates, offsets, expires = update_leapsec()
+    dates = dates.view("datetime64[ns]")
+    df = pd.DataFrame(
+        {
+            "MJD": datetime2jd(dates) - 2400000.5,
+            "date": dates,
+            "tai_utc": offsets[1:],
+        }
     )
-    buf.close()
-
-    df["date"] = pd.to_datetime(df["date"], dayfirst=True)
     df = df.set_index(index)
     try:
         return df.reindex(pd.to_datetime(date), method="ffill")
@@ -540,3 +815,62 @@ leapsec = """#  Value of TAI-UTC in second valid beetween the initial value unti
 57204.0    1  7 2015       36
 57754.0    1  1 2017       37
 """
+
+# a copy of the IERS file, with its indented data rows, for
+# _test_parse_leapsec
+_leapsec_iers = """#  Value of TAI-UTC in second valid beetween the initial value until
+#  the epoch given on the next line. The last line reads that NO
+#  leap second was introduced since the corresponding date
+#  Updated through IERS Bulletin 69 issued in January 2025
+#
+#
+#  File expires on 28 December 2025
+#
+#
+#    MJD        Date        TAI-UTC (s)
+#           day month year
+#    ---    --------------   ------
+#
+    41317.0    1  1 1972       10
+    41499.0    1  7 1972       11
+    41683.0    1  1 1973       12
+    42048.0    1  1 1974       13
+    42413.0    1  1 1975       14
+    42778.0    1  1 1976       15
+    43144.0    1  1 1977       16
+    43509.0    1  1 1978       17
+    43874.0    1  1 1979       18
+    44239.0    1  1 1980       19
+    44786.0    1  7 1981       20
+    45151.0    1  7 1982       21
+    45516.0    1  7 1983       22
+    46247.0    1  7 1985       23
+    47161.0    1  1 1988       24
+    47892.0    1  1 1990       25
+    48257.0    1  1 1991       26
+    48804.0    1  7 1992       27
+    49169.0    1  7 1993       28
+    49534.0    1  7 1994       29
+    50083.0    1  1 1996       30
+    50630.0    1  7 1997       31
+    51179.0    1  1 1999       32
+    53736.0    1  1 2006       33
+    54832.0    1  1 2009       34
+    56109.0    1  7 2012       35
+    57204.0    1  7 2015       36
+    57754.0    1  1 2017       37
+"""
+
+
+def _test_parse_leapsec():
+    """Check that the IERS Leap_Second.dat format and the built in copy
+    are both parsed."""
+    dates, offsets, expires = _parse_leapsec(_leapsec_iers)
+    assert len(dates) == 28, len(dates)
+    assert dates[0] == np.datetime64("1972-01-01", "ns").view("int64")
+    assert dates[-1] == np.datetime64("2017-01-01", "ns").view("int64")
+    assert offsets[0] == 10 and offsets[-1] == 37, offsets
+    assert expires == np.datetime64("2025-12-28"), expires
+    builtin = _parse_leapsec(leapsec)
+    assert (builtin[0] == dates).all() and (builtin[1] == offsets).all()
+    return True
@@ -7,15 +7,10 @@ from os.path import (
 )
 import numpy as np
 import pandas as pd
-from .marsdate import utc2myls
-from .downloader import get_tab_files
-from .util import (
-    mcs_tab_path,
-    add_prof_profid,
-    add_prof_rowid,
-    make_profidint,
-    make_rowidint,
-)
+from .marsdate import utc2mysol
+from .downloader import fetch_tab_file, save_tab_file
+from .util import mcs_tab_path, calc_time_vars
+from . import ids
 from .defs import (
     MCS_DATA_PATH,
     mix_keep_cols,
@@ -34,9 +29,12 @@ __all__ = [
 
 def load_tab_file(prodid, dfindex=None, download=True, **kwargs):
     """Load the data from the raw text file. Downloads the file if it
-    isn't found locally.
+    isn't found locally, and then parses the downloaded bytes while a
+    gzip'ed copy is saved instead of reading it back from disk.
     Returns a DataFrame with metadata and a DataFrame with the actual
     profile data."""
+    from concurrent.futures import ThreadPoolExecutor
+
     # get the absolute path
     path = mcs_tab_path(prodid, dfindex, absolute=True,)
     if not exists(path):
@@ -44,31 +42,42 @@ def load_tab_file(prodid, dfindex=None, download=True, **kwargs):
         if exists(path + ".gz"):
             path = path + ".gz"
         elif download:
-            # if no compressed version, try downloading
-            get_tab_files(
-                prodid, dfindex,
-            )
-            path = path + ".gz"
+            # if no compressed version, download it
+            print(f"Downloading {prodid}...")
+            data = fetch_tab_file(prodid, dfindex)
+            with ThreadPoolExecutor(1) as ex:
+                saved = ex.submit(save_tab_file, data, path + ".gz")
+                res = parse_tab_file(data, prodid=prodid, **kwargs)
+                saved.result()
+            return res
     # parse the TAB file and return two DataFrames
     return parse_tab_file(path, **kwargs)
 
 
 def parse_tab_file(
-    fn, meta=True, data=True, mix_keep_cols=mix_keep_cols,
+    fn, meta=True, data=True, mix_keep_cols=mix_keep_cols, prodid=None,
 ):
     """Given a TAB file name, parse the MCS file and return the
     metadata (location, Ls, LST, etc) and the profiles in two DataFrames.
+    fn: the file name, or the contents of the file (gzip'ed or not) as
+        bytes or a file-like object
     meta: whether to return the metadata DataFrame
     data: whether to return the profile data DataFrame
     mix_keep_cols: columns to keep in the metadata (default value is
     set above)
+    prodid: the product ID, which is found from the file name by
+        default and is needed for bytes and unnamed file-like objects
     """
 
     # read file, separating the metadata lines from the profile data lines
     (mdlines, dats,) = _read_lists(fn)
 
     # product ID (prodid) is the name of the TAB file
-    prodid = basename(fn.replace(".gz", ""))
+    if prodid is None:
+        name = fn if isinstance(fn, str) else getattr(fn, "name", None)
+        if not isinstance(name, str):
+            raise ValueError("prodid is needed to parse a TAB file buffer")
+        prodid = basename(name.replace(".gz", ""))
 
     mdl = {}
     for (k, (a, b),) in mix_date_col_lookup.items():
@@ -94,10 +103,15 @@ def parse_tab_file(
             dfmd[k].replace(np.nan, pd.NaT)
     """
 
+    # make integer profile ID's from the date in the file name and the
+    # profile number in the file
+    prodidint = ids.prodid_to_prodidint(prodid)
+    profidint = ids.make_profidint(prodidint, np.arange(len(dfmd)))
     # make product ID column
     dfmd["prodid"] = prodid
     # make profile ID column and make it the dataframe index
-    dfmd["profid"] = dfmd["prodid"] + ":" + dfmd.index.astype(str)
+    dfmd["profid"] = ids.profidint_to_profid(profidint)
+    dfmd["profidint"] = profidint
     dfmd = dfmd.set_index("profid")
 
     # find retrievals that are marked as "bad"
@@ -106,8 +120,6 @@ def parse_tab_file(
     )  # indicates bad retrievals
     # store number of retrievals in file before removing bad ones
     nlen = len(lx)
-    # get profile IDs of "bad" retrievals
-    badprofids = dfmd[lx].index
     # remove bad rows from the metadata index dataframe
     dfmd = dfmd[~lx]
     # remove the quality marker row
@@ -126,15 +138,15 @@ def parse_tab_file(
     dfmd["UTC"] = pd.to_timedelta(dfmd["UTC"])
     # make a datetime column with the actual UTC time
     dfmd["datetime"] = dfmd["date"] + dfmd["UTC"]
-    # use the datetime column to calculate the Mars Year and Ls for
-    # each retrieval
-    mycls = np.transpose(utc2myls(dfmd["datetime"]))
-    df = pd.DataFrame(mycls, columns=["MY", "cLs"], index=dfmd.index)
-    dfmd = dfmd.join(df)
+    # use the datetime column to calculate the Mars Year and sol for
+    # each retrieval, and the derived time variables
+    MY, sol = utc2mysol(dfmd["datetime"])
+    dfmd["MY"] = MY
+    for k, v in calc_time_vars(dfmd["Ls"], MY, sol).items():
+        dfmd[k] = v
 
     # drop extra columns
-    dfmd = dfmd[mix_keep_cols]
-    dfmd["profidint"] = make_profidint(dfmd)
+    dfmd = dfmd[mix_keep_cols + ["profidint"]]
 
     # deal with the profile data
     if data:
@@ -148,29 +160,28 @@ def parse_tab_file(
             na_values=-9999.0,
         )
 
-        # add a column with the profile number (number from the top
-        # of the file)
-        prof_num = (
-            np.tile(np.array(range(nlen)), (105, 1),).transpose().flatten()
-        )
+        # add columns with the profile number (number from the top
+        # of the file) and the pressure level number (1-105)
+        prof_num = np.repeat(np.arange(nlen), 105)
         # this file has two bad profiles
         # 2006121500_DDR.TAB 4348 (34230, 15) (34020,)
+        dats["prsnum"] = np.tile(np.arange(1, 106), nlen)
         dats["prof_num"] = prof_num
-        dats["prodid"] = prodid
-        # make profile ID column from prof_num
-        dats = add_prof_profid(dats)
-        # add row ID and make it the index
-        dats = add_prof_rowid(dats)
-        dats = dats.set_index("rowid")
+        # make integer profile and row ID's, string versions can be made
+        # from these with util.add_prof_profid and util.add_prof_rowid
+        dats["profidint"] = ids.make_profidint(prodidint, prof_num)
+        dats["rowidint"] = ids.make_rowidint(
+            dats["profidint"].to_numpy(), dats["prsnum"].to_numpy()
+        )
+        dats = dats.set_index(
+            pd.Index(dats["rowidint"].to_numpy(), name="rowidint")
+        )
 
         # drop bad rows
-        dats = dats[~(dats["profid"].isin(badprofids))]
+        dats = dats[~np.repeat(lx.to_numpy(), 105)]
         # remove quality flag column
         dats.pop("1")
 
-        # make integer row ID
-        dats["rowidint"] = make_rowidint(dats.index)
-
         # return DataFrames
         if meta:
             return dfmd, dats
@@ -178,6 +189,29 @@ def parse_tab_file(
     return dfmd
 
 
+def _read_text(fn):
+    """The text of a TAB file from its file name, its contents as
+    bytes, or a file-like object. Gzip'ed contents are recognized from
+    the first two bytes."""
+    if hasattr(fn, "read"):
+        fn = fn.read()
+        if isinstance(fn, str):
+            return fn
+    if isinstance(fn, (bytes, bytearray, memoryview)):
+        fn = bytes(fn)
+        if fn[:2] == b"\x1f\x8b":
+            fn = gzip.decompress(fn)
+        return fn.decode("ascii")
+    # read the file
+    if not isabs(fn):
+        fn = MCS_DATA_PATH + fn
+    if fn.endswith("gz"):
+        with gzip.open(fn, "rb") as fin:
+            return fin.read().decode("ascii")
+    with open(fn, "r") as fin:
+        return fin.read()
+
+
 def _read_lists(fn):
     """_read_lists is a function to help parse_mcs_file by reading
     the actual TAB file, separating the metadata rows from the profile
@@ -186,15 +220,7 @@ def _read_lists(fn):
        mdlines: list of metadata lines
        dats: list of profile data lines
     """
-    # read the file
-    if not isabs(fn):
-        fn = MCS_DATA_PATH + fn
-    if fn.endswith("gz"):
-        with gzip.open(fn, "rb") as fin:
-            lines = fin.read().decode("ascii").replace('"', "").split("\n")
-    else:
-        with open(fn, "r") as fin:
-            lines = fin.read().replace('"', "").split("\n")
+    lines = _read_text(fn).replace('"', "").split("\n")
     for ix in range(len(lines)):
         if lines[0].startswith("#"):
             lines = lines[1:]
@@ -211,3 +237,18 @@ def _read_lists(fn):
         for n in range(len(lines) // 106)
     ]
     return mdlines, dats
+
+
+def _test_parse_sources(fn):
+    """Check that parsing the TAB file `fn` from its name, its bytes
+    (compressed and not), and a file object gives the same data."""
+    prodid = basename(fn.replace(".gz", ""))
+    opener = gzip.open if fn.endswith(".gz") else open
+    with opener(fn, "rb") as fin:
+        raw = fin.read()
+    expected = parse_tab_file(fn)
+    sources = [raw, gzip.compress(raw), io.BytesIO(raw)]
+    for source in sources:
+        for df0, df1 in zip(expected, parse_tab_file(source, prodid=prodid)):
+            pd.testing.assert_frame_equal(df0, df1)
+    return True
@@ -0,0 +1,278 @@
+__package__ = "mcspy"
+
+import os
+import asyncio
+from os.path import exists
+from urllib.parse import urlsplit
+import pandas as pd
+from .defs import MCS_DATA_PATH
+from .util import mcs_tab_path
+from .downloader import PDS_ROOT_URL, AsyncHTTPPool, _async_fetch
+from .downloader import save_tab_file
+
+__all__ = [
+    "ingest",
+    "async_ingest",
+]
+
+__doc__ = """
+Download, parse, and import TAB files in one pass with overlapping
+stages, instead of downloading everything, then parsing everything,
+then appending to the yearly files.
+
+    download workers -> [queue] -> parser processes -> [queue] -> writer
+
+- `concurrency` download coroutines share one AsyncHTTPPool and keep
+  each file in memory.
+- `nparsers` processes parse the downloaded bytes with
+  `parsing.parse_tab_file`, while threads save gzip'ed copies of them,
+  so the files aren't written and then read back before parsing. Files
+  that are already on disk are parsed from disk.
+- A single writer thread appends the parsed files to the yearly data
+  files in batches of `batch_size` files per year, so each yearly file
+  is rewritten once per batch and not once per TAB file. A batch is
+  also written early when the parsed files waiting in all of the
+  batches take up more than `batch_bytes`.
+
+The queues between the stages, and the threads saving the downloaded
+files, hold at most `queue_size` files, so a slow stage makes the
+stages before it wait instead of piling up downloaded or parsed files
+in memory, and the batches waiting to be written hold at most about
+`batch_bytes`. At the end each year that was written to is sorted and
+its summaries and zone maps are updated, like
+`importer.import_tab_files`.
+"""
+
+
+def _parse_tab(source, prodid):
+    """Parse a TAB file (a file name or the downloaded bytes) in a
+    parser process and shrink the DataFrames before they are sent back
+    to the writer."""
+    from .parsing import parse_tab_file
+    from .importer import _shrink_df
+
+    dfm, dfp = parse_tab_file(source, prodid=prodid)
+    return _shrink_df(dfm), _shrink_df(dfp)
+
+
+def _archive(prodid, data, local_filepath):
+    """Save a gzip'ed copy of a downloaded file, returning the product
+    ID if it failed."""
+    try:
+        save_tab_file(data, local_filepath)
+    except Exception as e:
+        print(f"Saving failed {prodid}: {e}")
+        return prodid
+    return None
+
+
+def _frame_bytes(dfm, dfp):
+    """Memory used by the parsed DataFrames of a file."""
+    return int(dfm.memory_usage().sum() + dfp.memory_usage().sum())
+
+
+def _write_batch(batch, implicit_rowid):
+    """Append a list of (prodid, dfmix, dfprof) from one year to the
+    yearly data files."""
+    from .importer import _append_mix_dframe, _append_prof_df
+
+    dfm = [bb[1] for bb in batch if len(bb[1])]
+    dfp = [bb[2] for bb in batch if len(bb[2])]
+    if not dfm:
+        return
+    dfm, dfp = pd.concat(dfm), pd.concat(dfp)
+    if len(dfm) != len(dfp) // 105:
+        raise ValueError("Index and profile data shapes don't match.")
+    _append_mix_dframe(dfm)
+    _append_prof_df(dfp, implicit_rowid=implicit_rowid)
+
+
+async def async_ingest(
+    prodids,
+    dfindex,
+    concurrency=8,
+    nparsers=None,
+    queue_size=16,
+    batch_size=240,
+    batch_bytes=2**29,
+    overwrite=False,
+    keep_files=True,
+    implicit_rowid=False,
+    root_url=PDS_ROOT_URL,
+    pool=None,
+):
+    """
+    Download, parse, and import the TAB files for `prodids` with the
+    staged pipeline described in the module docstring. This is a
+    coroutine, use `ingest` outside of an event loop. The products
+    must not have been imported already, see `importer.drop_products`.
+
+    concurrency: number of download workers and HTTP connections
+    nparsers: number of parser processes, by default the CPU count
+    queue_size: number of files each queue between stages holds
+    batch_size: number of files appended to a year at once
+    batch_bytes: memory the parsed files waiting to be written can use,
+        above it the largest batch is written early
+    overwrite: download files that are already on disk again
+    keep_files: save gzip'ed copies of the downloaded files, which is
+        done in threads while the parser processes parse the bytes
+    root_url: server and path of the PDS data, without "http://"
+    pool: an open AsyncHTTPPool to download with
+
+    returns: dict of lists of the product ID's that were "downloaded"
+        and "imported", the ones that "failed", and the ones that were
+        imported but couldn't be saved ("unsaved")
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from .importer import finish_import
+
+    if isinstance(prodids, str):
+        prodids = [prodids]
+    url = urlsplit("http://" + root_url)
+    base = url.path.rstrip("/")
+    loop = asyncio.get_running_loop()
+    todo = asyncio.Queue()
+    for prodid in prodids:
+        todo.put_nowait(prodid)
+    parse_q = asyncio.Queue(maxsize=queue_size)
+    write_q = asyncio.Queue(maxsize=queue_size)
+    result = {"downloaded": [], "imported": [], "failed": [], "unsaved": []}
+
+    async def download(pool):
+        while not todo.empty():
+            prodid = todo.get_nowait()
+            localpath = MCS_DATA_PATH + mcs_tab_path(prodid, dfindex)
+            if not overwrite and exists(localpath):
+                await parse_q.put((prodid, localpath))
+                continue
+            if not overwrite and exists(localpath + ".gz"):
+                await parse_q.put((prodid, localpath + ".gz"))
+                continue
+            path = mcs_tab_path(prodid, dfindex, volume=True)
+            try:
+                data = await _async_fetch(pool, f"{base}/{path}")
+            except Exception as e:
+                print(f"Download failed {prodid}: {e}")
+                result["failed"].append(prodid)
+                continue
+            result["downloaded"].append(prodid)
+            # the bytes are parsed while the compressed copy is saved,
+            # with at most queue_size files waiting to be saved
+            if keep_files:
+                await archive_slots.acquire()
+                fut = loop.run_in_executor(
+                    archiver, _archive, prodid, data, localpath + ".gz"
+                )
+                archiving.add(fut)
+                fut.add_done_callback(archived)
+            await parse_q.put((prodid, data))
+
+    def archived(fut):
+        archiving.discard(fut)
+        archive_slots.release()
+        if not fut.cancelled() and fut.result() is not None:
+            result["unsaved"].append(fut.result())
+
+    async def parse(parsers):
+        while True:
+            item = await parse_q.get()
+            if item is None:
+                return
+            prodid, source = item
+            try:
+                dfm, dfp = await loop.run_in_executor(
+                    parsers, _parse_tab, source, prodid
+                )
+            except Exception as e:
+                print(f"Parsing failed {prodid}: {e}")
+                result["failed"].append(prodid)
+                continue
+            await write_q.put((prodid, dfm, dfp))
+
+    async def write(writer):
+        batches = {}
+        # memory used by each year's batch
+        nbytes = {}
+        years = []
+        while True:
+            item = await write_q.get()
+            if item is None:
+                break
+            year = item[0][:4]
+            batches.setdefault(year, []).append(item)
+            nbytes[year] = nbytes.get(year, 0) + _frame_bytes(*item[1:])
+            if len(batches[year]) < batch_size:
+                if sum(nbytes.values()) <= batch_bytes:
+                    continue
+                year = max(nbytes, key=nbytes.get)
+            del nbytes[year]
+            await flush(writer, batches.pop(year), year, years)
+        for year, batch in batches.items():
+            await flush(writer, batch, year, years)
+        for year in years:
+            await loop.run_in_executor(writer, finish_import, year)
+
+    async def flush(writer, batch, year, years):
+        await loop.run_in_executor(
+            writer, _write_batch, batch, implicit_rowid
+        )
+        if year not in years:
+            years.append(year)
+        result["imported"] += [bb[0] for bb in batch]
+        print(f"Imported {len(batch)} files into {year}")
+
+    async def run(pool):
+        downloaders = [
+            asyncio.create_task(download(pool)) for _ in range(concurrency)
+        ]
+        parsing = [asyncio.create_task(parse(parsers)) for _ in range(nparse)]
+        writing = asyncio.create_task(write(writer))
+
+        async def feed():
+            await asyncio.gather(*downloaders)
+            for _ in parsing:
+                await parse_q.put(None)
+            await asyncio.gather(*parsing)
+            await write_q.put(None)
+
+        feeding = asyncio.create_task(feed())
+        tasks = downloaders + parsing + [writing, feeding]
+        try:
+            # stop everything if the writer fails, instead of waiting
+            # for the other stages to fill up the queues
+            done, _ = await asyncio.wait(
+                [feeding, writing], return_when=asyncio.FIRST_EXCEPTION
+            )
+            for task in done:
+                task.result()
+            await asyncio.gather(*archiving)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    nparse = nparsers or os.cpu_count() or 1
+    # the archive saves that haven't finished
+    archiving = set()
+    archive_slots = asyncio.Semaphore(queue_size)
+    parsers = ProcessPoolExecutor(nparse)
+    writer = ThreadPoolExecutor(1)
+    archiver = ThreadPoolExecutor(2)
+    try:
+        if pool is None:
+            async with AsyncHTTPPool(
+                url.hostname, url.port or 80, size=concurrency
+            ) as pool:
+                await run(pool)
+        else:
+            await run(pool)
+    finally:
+        for executor in (parsers, writer, archiver):
+            executor.shutdown()
+    return result
+
+
+def ingest(prodids, dfindex, **kwargs):
+    """Download, parse, and import the TAB files for `prodids`, see
+    `async_ingest` for the arguments."""
+    return asyncio.run(async_ingest(prodids, dfindex, **kwargs))
@@ -0,0 +1,365 @@
+__package__ = "mcspy"
+
+from os import replace, unlink
+from os.path import exists, basename
+import numpy as np
+import pandas as pd
+from .defs import MCS_DATA_PATH
+from .ids import prodidint_to_prodid, profidint_to_prodidint
+
+__all__ = [
+    "sync",
+    "plan_sync",
+    "load_manifest",
+    "save_manifest",
+    "manifest_path",
+]
+
+__doc__ = """
+Keep the local data current with the PDS archive.
+
+A manifest in "DATA/sync_manifest.npz" records, for every product ID
+that has been downloaded or imported, the volume and product creation
+time it had in the index and whether it has been downloaded and
+imported. `sync` downloads the newest CUMINDEX.TAB, compares it to the
+manifest with a few vectorized lookups instead of checking every file
+on disk, and then downloads and imports only the new products and the
+ones that have been reprocessed (a different volume or creation time).
+
+The first sync without a manifest builds one from the TAB files on disk
+and the imported profile ID's, which does walk the data directory once.
+"""
+
+# index columns that identify a version of a product
+_key_cols = ["volume_id", "product_creation_time"]
+_manifest_cols = _key_cols + ["downloaded", "imported"]
+
+
+def manifest_path():
+    return MCS_DATA_PATH + "DATA/sync_manifest.npz"
+
+
+def _empty_manifest():
+    return pd.DataFrame(
+        {
+            "volume_id": np.array([], dtype=object),
+            "product_creation_time": np.array([], dtype=object),
+            "downloaded": np.array([], dtype=bool),
+            "imported": np.array([], dtype=bool),
+        },
+        index=pd.Index([], dtype=object, name="prodid"),
+    )
+
+
+def load_manifest():
+    """The sync manifest as a DataFrame indexed by product ID, or None
+    if there isn't one yet."""
+    fname = manifest_path()
+    if not exists(fname):
+        return None
+    with np.load(fname) as fin:
+        manifest = pd.DataFrame(
+            {
+                cn: fin[cn].astype(object) if cn in _key_cols else fin[cn]
+                for cn in _manifest_cols
+            },
+            index=pd.Index(fin["prodid"].astype(object), name="prodid"),
+        )
+    return manifest
+
+
+def save_manifest(manifest):
+    """Save the sync manifest, through a temporary file so an
+    interrupted sync never leaves a partly written manifest."""
+    fname = manifest_path()
+    cols = {
+        cn: manifest[cn].to_numpy(dtype=str if cn in _key_cols else bool)
+        for cn in _manifest_cols
+    }
+    with open(fname + ".tmp", "wb") as fout:
+        np.savez(fout, prodid=manifest.index.to_numpy(dtype=str), **cols)
+    replace(fname + ".tmp", fname)
+
+
+def _latest_products(dfindex):
+    """The index with one row per product ID. Reprocessed products are
+    listed again in later volumes, the last row is the current one."""
+    return dfindex.loc[~dfindex.index.duplicated(keep="last")]
+
+
+def _mark(manifest, latest, prodids, **flags):
+    """Record the current index key of `prodids` in the manifest and
+    set the columns in `flags`. Returns the updated manifest."""
+    prodids = pd.Index(prodids, dtype=object)
+    add = prodids.difference(manifest.index)
+    if len(add):
+        new = _empty_manifest().reindex(add)
+        new["downloaded"] = False
+        new["imported"] = False
+        manifest = pd.concat([manifest, new])
+    for cn in _key_cols:
+        manifest.loc[prodids, cn] = latest.loc[prodids, cn].to_numpy(
+            dtype=str
+        )
+    for cn, value in flags.items():
+        manifest.loc[prodids, cn] = value
+    return manifest
+
+
+def _bootstrap_manifest(latest):
+    """Make a manifest from the TAB files on disk and the imported
+    profile ID's, assuming they are the versions in the index."""
+    from .importer import find_existing_tab_files
+    from .loaders import load_mix_var
+
+    local = pd.Index(
+        [
+            basename(fn)[:-3] if fn.endswith(".gz") else basename(fn)
+            for fn in find_existing_tab_files(PATHS=True)
+        ]
+    )
+    imported = []
+    for year in pd.unique(latest.index.str[:4]):
+        try:
+            profidint = load_mix_var(year, "profidint", quiet=True)
+        except FileNotFoundError:
+            continue
+        imported.append(
+            prodidint_to_prodid(np.unique(profidint_to_prodidint(profidint)))
+        )
+    imported = pd.Index(np.concatenate(imported) if imported else [])
+    manifest = _empty_manifest()
+    known = latest.index[latest.index.isin(local.union(imported))]
+    manifest = _mark(manifest, latest, known)
+    manifest["downloaded"] = manifest.index.isin(local)
+    manifest["imported"] = manifest.index.isin(imported)
+    return manifest
+
+
+def plan_sync(dfindex, manifest):
+    """
+    Compare the index `dfindex` with the sync manifest.
+
+    returns: dict of sorted lists of product ID's,
+        "new": in the index but not the manifest
+        "changed": a different volume or creation time than the
+            manifest
+        "removed": in the manifest but no longer in the index
+        "download": to download, new, changed, and earlier failures
+        "import": to import, the downloads and any downloaded products
+            that haven't been imported
+    """
+    latest = _latest_products(dfindex)
+    known = latest.index.isin(manifest.index)
+    old = manifest.reindex(latest.index[known])
+    changed = np.zeros(len(old), dtype=bool)
+    for cn in _key_cols:
+        changed |= old[cn].to_numpy(dtype=str) != latest.loc[
+            known, cn
+        ].to_numpy(dtype=str)
+    new = latest.index[~known]
+    changed = old.index[changed]
+    download = new.union(changed).union(
+        old.index[~old["downloaded"].to_numpy(dtype=bool)]
+    )
+    imports = download.union(
+        old.index[~old["imported"].to_numpy(dtype=bool)]
+    )
+    removed = manifest.index[~manifest.index.isin(latest.index)]
+    return {
+        "new": sorted(new),
+        "changed": sorted(changed),
+        "removed": sorted(removed),
+        "download": sorted(download),
+        "import": sorted(imports),
+    }
+
+
+def _is_local(prodids, dfindex):
+    """Whether each of `prodids` has a TAB or TAB.gz file on disk."""
+    from .util import mcs_tab_path
+
+    if len(prodids) == 0:
+        return np.zeros(0, dtype=bool)
+    paths = mcs_tab_path(pd.Index(prodids), dfindex, absolute=True)
+    return np.array([exists(fn) or exists(fn + ".gz") for fn in paths])
+
+
+def _remove_stale_tab(files):
+    """Delete the uncompressed TAB files left over from the old version
+    of products that were downloaded again as TAB.gz files, which
+    would otherwise be read instead of the new ones."""
+    for fn in files:
+        if exists(fn) and exists(fn + ".gz"):
+            unlink(fn)
+
+
+def _update_index():
+    """Download the newest CUMINDEX.TAB, like `reload_index`."""
+    from .downloader import (
+        get_most_recent_index_ftp,
+        get_most_recent_index_http,
+    )
+
+    fname = MCS_DATA_PATH + "DATA/CUMINDEX.TAB.gz"
+    try:
+        get_most_recent_index_ftp(fname)
+    except Exception:
+        get_most_recent_index_http(fname)
+
+
+def sync(
+    dfindex=None,
+    update_index=True,
+    download=True,
+    use_ftp=False,
+    concurrency=8,
+    implicit_rowid=False,
+    dry_run=False,
+):
+    """
+    Bring the local data up to date with the PDS index.
+
+    dfindex: the index to sync with, by default the newest CUMINDEX.TAB
+        is downloaded (unless `update_index` is False) and loaded
+    download: download the new and changed products, otherwise only
+        products that are already on disk are imported
+    use_ftp, concurrency: see `downloader.batch_get_tab_files`
+    implicit_rowid: see `importer.import_tab_files`
+    dry_run: only compare the index and the manifest
+
+    returns: the dict from `plan_sync`, with the lists of product ID's
+        that were "downloaded" and "imported" and the ones that
+        "failed" to download
+    """
+    from .downloader import batch_get_tab_files
+    from .importer import drop_products, import_tab_files
+
+    if dfindex is None:
+        from .indexing import reload_index
+
+        if update_index and not dry_run:
+            _update_index()
+        dfindex = reload_index(allow_download=False)
+    latest = _latest_products(dfindex)
+    manifest = load_manifest()
+    if manifest is None:
+        print("No sync manifest, making one from the local files...")
+        manifest = _bootstrap_manifest(latest)
+        if not dry_run:
+            save_manifest(manifest)
+    plan = plan_sync(latest, manifest)
+    print(
+        f"{len(plan['new'])} new, {len(plan['changed'])} changed, "
+        + f"{len(plan['removed'])} removed products, "
+        + f"{len(plan['download'])} to download, "
+        + f"{len(plan['import'])} to import"
+    )
+    plan.update(downloaded=[], imported=[], failed=[])
+    if dry_run:
+        return plan
+
+    if download and plan["download"]:
+        changed = set(plan["changed"])
+        fresh = [pid for pid in plan["download"] if pid not in changed]
+        if fresh:
+            batch_get_tab_files(
+                fresh, latest, use_ftp=use_ftp, concurrency=concurrency
+            )
+        redone = []
+        if plan["changed"]:
+            redone = batch_get_tab_files(
+                plan["changed"],
+                latest,
+                overwrite=True,
+                use_ftp=use_ftp,
+                concurrency=concurrency,
+            )
+            _remove_stale_tab(redone)
+        # the old files of changed products are still there if they
+        # couldn't be downloaded again, so only the ones that were
+        # downloaded count
+        redone = {basename(fn) for fn in redone}
+        ok = [
+            pid in redone if pid in changed else local
+            for pid, local in zip(
+                plan["download"], _is_local(plan["download"], latest)
+            )
+        ]
+        done = [pid for pid, tf in zip(plan["download"], ok) if tf]
+        plan["failed"] = [
+            pid for pid, tf in zip(plan["download"], ok) if not tf
+        ]
+        plan["downloaded"] = done
+        manifest = _mark(manifest, latest, done, downloaded=True)
+        save_manifest(manifest)
+
+    todo = pd.Index(plan["import"])
+    # changed products that weren't downloaded again only have the old
+    # version on disk
+    old_only = todo.isin(plan["changed"]) & ~todo.isin(plan["downloaded"])
+    todo = todo[
+        _is_local(todo, latest) & ~todo.isin(plan["failed"]) & ~old_only
+    ]
+    # products that were found on disk without downloading them
+    if len(todo):
+        manifest = _mark(
+            manifest,
+            latest,
+            todo[~todo.isin(manifest.index)],
+            downloaded=True,
+        )
+    for year in pd.unique(todo.str[:4]):
+        pids = todo[todo.str.startswith(year)]
+        stale = pids[manifest.loc[pids, "imported"].to_numpy(dtype=bool)]
+        if len(stale):
+            print(f"Deleting {len(stale)} reprocessed products from {year}")
+            drop_products(year, stale)
+            manifest.loc[stale, "imported"] = False
+            save_manifest(manifest)
+        import_tab_files(
+            year, pids, dfindex=latest, implicit_rowid=implicit_rowid
+        )
+        manifest = _mark(manifest, latest, pids, imported=True)
+        save_manifest(manifest)
+        plan["imported"] += list(pids)
+    return plan
+
+
+def _test_sync_plan():
+    """Check `plan_sync` on a small made up index and manifest."""
+    prodids = [f"20070101{hh:02d}_DDR.TAB" for hh in range(6)]
+    dfindex = pd.DataFrame(
+        {
+            "volume_id": ["MROM_2001"] * 6 + ["MROM_2002"],
+            "product_creation_time": ["2011"] * 6 + ["2012"],
+        },
+        # the product from hour 4 was reprocessed in a later volume
+        index=pd.Index(prodids + prodids[4:5], name="prodid"),
+    )
+    manifest = pd.DataFrame(
+        {
+            "volume_id": ["MROM_2001"] * 6,
+            "product_creation_time": ["2011"] * 6,
+            "downloaded": [True, True, True, False, True, True],
+            "imported": [True, True, False, False, True, True],
+        },
+        index=pd.Index(prodids[:5] + ["2006123123_DDR.TAB"], name="prodid"),
+    )
+    plan = plan_sync(dfindex, manifest)
+    assert plan["new"] == prodids[5:], plan
+    assert plan["changed"] == prodids[4:5], plan
+    assert plan["removed"] == ["2006123123_DDR.TAB"], plan
+    assert plan["download"] == prodids[3:], plan
+    assert plan["import"] == prodids[2:], plan
+    # recording the downloads and imports leaves nothing to do
+    manifest = _mark(
+        manifest,
+        _latest_products(dfindex),
+        prodids,
+        downloaded=True,
+        imported=True,
+    )
+    plan = plan_sync(dfindex, manifest)
+    assert plan["download"] == plan["import"] == [], plan
+    return True
@@ -2,6 +2,7 @@ __package__ = "mcspy"
 
 import numpy as np
 from .defs import MCS_DATA_PATH
+from . import ids
 import pandas as pd
 
 __all__ = [
@@ -16,6 +17,8 @@ __all__ = [
     "make_rowidint",
     "rowidint_to_rowid",
     "calc_Ls2",
+    "calc_time_vars",
+    "allyears",
     "allyearsdec",
     "lxload",
 ]
@@ -25,6 +28,27 @@ def calc_Ls2(Ls, MY):
     return Ls + 360 * (MY - 28)
 
 
+def calc_time_vars(Ls, MY, sol=None, datetime=None):
+    """
+    Calculate the derived time variables in `defs.mix_derived_cols`
+    from Ls, Mars Year, and the sol of the Mars Year, `sol`. If `sol`
+    is None, it is calculated from the UTC times `datetime`.
+
+    returns: dict of numpy arrays
+    """
+    sols_per_MY = 668.6
+    if sol is None:
+        from .marsdate import utc2mysol
+
+        _, sol = utc2mysol(datetime)
+    Ls, MY, sol = (np.asarray(x) for x in (Ls, MY, sol))
+    return {
+        "Ls2": calc_Ls2(Ls, MY),
+        "msol": sol + sols_per_MY * (MY - 28),
+        "MYfrac": MY + sol / sols_per_MY,
+    }
+
+
 def local_data_path(pth, ext=""):
     from pathlib import Path
 
@@ -86,8 +110,18 @@ def add_prof_prsnum(prof):
 
 
 def add_prof_rowid(prof):
+    """Add a string "rowid" column to the profile DataFrame `prof`,
+    formatted from its "rowidint" column if it has one."""
     if "rowid" in prof:
         return prof
+    if "rowidint" in prof:
+        pp = prof.copy()
+        pp["rowid"] = pd.Series(
+            ids.rowidint_to_rowid(pp["rowidint"].to_numpy()),
+            index=pp.index,
+            dtype="string",
+        )
+        return pp
     pp = prof.copy()
     pp = add_prof_profid(add_prof_prsnum(pp))
     pp["rowid"] = (pp.profid + ":" + pp.prsnum.astype(str)).astype("string")
@@ -95,42 +129,53 @@ def add_prof_rowid(prof):
 
 
 def add_prof_profid(prof):
+    """Add a string "profid" column to the profile DataFrame `prof`,
+    formatted from its "profidint" or "rowidint" column if it has one."""
     if "profid" in prof:
         return prof
     pp = prof.copy()
-    pp["profid"] = (pp["prodid"] + ":" + pp.prof_num.astype(str)).astype(
-        "string"
+    if "profidint" in pp:
+        profidint = pp["profidint"].to_numpy()
+    elif "rowidint" in pp:
+        profidint = ids.rowidint_to_profidint(pp["rowidint"].to_numpy())
+    else:
+        pp["profid"] = (
+            pp["prodid"] + ":" + pp.prof_num.astype(str)
+        ).astype("string")
+        return pp
+    pp["profid"] = pd.Series(
+        ids.profidint_to_profid(profidint), index=pp.index, dtype="string"
     )
     return pp
 
 
+def _idseries(ix, name):
+    """Get the column or index `name` from a DataFrame or Series `ix`."""
+    if isinstance(ix, pd.DataFrame):
+        if name not in ix:
+            ix = ix.reset_index()
+        ix = ix[name]
+    return ix
+
+
 def make_prodidint(ix):
     """
     Make a integer version of prodid.
     ix: a series or a DataFrame with a column or index named "prodid"
 
-    returns: pandas integer Series of profidint
+    returns: numpy integer array of prodidint
     """
-    ix = ix.copy()
-    # make an integer version of profile ID
-    # date identifies the data file, multipy by 1e4 to allow
-    # up to 9999 profiles per data file
-    # profile number in the data file
-    if isinstance(ix, pd.DataFrame):
-        if "prodid" not in ix:
-            ix = ix.reset_index()
-        ix = ix["prodid"]
-    elif not isinstance(ix, pd.Series):
-        ix = pd.Series(ix)
-    ix = ix.str.slice(None, 10).astype(int)
-    return ix.values
+    return ids.prodid_to_prodidint(_idseries(ix, "prodid"))
 
 
 def prodidint_to_prodid(pidi):
-    if not isinstance(pidi, (pd.Series)):
-        pidi = pd.Series(pidi, name="profid")
-    pidi = pidi.astype(str).astype("string") + "_DDR.TAB"
-    return pidi
+    index = pidi.index if isinstance(pidi, pd.Series) else None
+    return pd.Series(
+        ids.prodidint_to_prodid(np.asarray(pidi)),
+        index=index,
+        name="prodid",
+        dtype="string",
+    )
 
 
 def make_profidint(mix):
@@ -138,71 +183,46 @@ def make_profidint(mix):
     Make a integer version of profid.
     mix: a series or a DataFrame with a column or index named "profid"
 
-    returns: pandas integer Series of profidint
+    returns: numpy integer array of profidint
     """
-    mix = mix.copy()
-    # make an integer version of profile ID
     # date identifies the data file, multipy by 1e4 to allow
     # up to 9999 profiles per data file
-    # profile number in the data file
-    if isinstance(mix, pd.DataFrame):
-        if "profid" not in mix:
-            mix = mix.reset_index()
-        mix = mix["profid"]
-    elif not isinstance(mix, pd.Series):
-        mix = pd.Series(mix)
-    mix = mix.str.slice(None, 10).astype(int) * 10000 + mix.str.slice(
-        19, None
-    ).astype(int)
-    return mix.values
+    return ids.profid_to_profidint(_idseries(mix, "profid"))
 
 
 def profidint_to_profid(pidi):
     """
     Make profid index from profidint. This is the inverse
-    of make_profidint_mix_df.
+    of make_profidint.
     pidi: integer arraylike or pandas Series
 
     returns: pandas Series of profid strings
     """
-    if not isinstance(pidi, (pd.Series)):
-        pidi = pd.Series(pidi, name="profid")
-    pidi = pidi.astype(str).astype("string")
-    date = pidi.str.slice(None, 10)
-    profnum = pidi.str.slice(10, None)
-    profnum = profnum.str.replace("0", " ").str.lstrip().str.replace(" ", "0")
-    profnum[~profnum.str.isnumeric()] = "0"
-    profid = (date + "_DDR.TAB:" + profnum).astype("string")
-    profid.name = "profid"
-    return profid
+    index = pidi.index if isinstance(pidi, pd.Series) else None
+    return pd.Series(
+        ids.profidint_to_profid(np.asarray(pidi)),
+        index=index,
+        name="profid",
+        dtype="string",
+    )
 
 
 def make_rowidint(prof):
-    rid = pd.Series(prof)
-    rowidint = rid.str[:10].astype(int)
-    rid2 = rid.str[19:].str.split(":")
-    rid2a = rid2.apply(lambda x: x[0]).astype(int)
-    rid2b = rid2.apply(lambda x: x[1]).astype(int)
-    rowidint = rowidint * 10000 + rid2a
-    rowidint = rowidint * 1000 + rid2b
-    return rowidint.values
+    """Make an integer version of the row ID strings in `prof`.
+
+    returns: numpy integer array of rowidint
+    """
+    return ids.rowid_to_rowidint(prof)
 
 
 def rowidint_to_rowid(rowidint):
-    if not isinstance(rowidint, pd.Series):
-        rowidint = pd.Series(rowidint)
-    rownum = rowidint % 1000
-    profnum = rowidint // 1000 % 10000
-    prodidint = rowidint // 1000 // 10000
-    rid = (
-        prodidint.astype(str)
-        + "_DDR.TAB:"
-        + profnum.astype(str)
-        + ":"
-        + rownum.astype(str)
+    index = rowidint.index if isinstance(rowidint, pd.Series) else None
+    return pd.Series(
+        ids.rowidint_to_rowid(np.asarray(rowidint)),
+        index=index,
+        name="rowid",
+        dtype="string",
     )
-    rid.name = "rowid"
-    return rid.astype("string")
 
 
 def addext(fn, ext):
@@ -212,28 +232,30 @@ def addext(fn, ext):
     return fn
 
 
+# years used when a _years function is called without years
+allyears = (
+    2006,
+    2007,
+    2008,
+    2009,
+    2010,
+    2011,
+    2012,
+    2013,
+    2014,
+    2015,
+    2016,
+    2017,
+    2018,
+    2019,
+)
+
+
 # decorator for _years functions
 def allyearsdec(f):
-    ays = (
-        2006,
-        2007,
-        2008,
-        2009,
-        2010,
-        2011,
-        2012,
-        2013,
-        2014,
-        2015,
-        2016,
-        2017,
-        2018,
-        2019,
-    )
-
     def func(years=None, **kwargs):
         if years is None:
-            return f(years=ays, **kwargs)
+            return f(years=allyears, **kwargs)
         else:
             return f(years=years, **kwargs)
 